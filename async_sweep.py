@@ -0,0 +1,159 @@
+import asyncio
+import logging
+
+import aiohttp
+
+import metrics
+from onionoo import LOOKUP_BATCH, ONIONOO_DETAILS, RELAY_FIELDS, STREAM_CHUNK, RelayStreamParser, index_relays, relay_cache
+from onionoo_client import RETRIES_TOTAL, RETRY_STATUSES, onionoo_client, retry_after
+from relay_index import relay_index
+from sweep import SWEEP_FINGERPRINTS, SWEEP_SECONDS, apply_sweep
+
+
+# Default limits of the asynchronous sweep
+CONCURRENCY = 10
+REQUEST_TIMEOUT = 30
+
+
+class AsyncSweeper:
+    """
+    Asynchronous sweep engine that checks the subscribed relays with bounded concurrency.
+
+    The fingerprints missing from the shared relay cache are fetched through a pooled aiohttp
+    session, either as concurrent batched `lookup` requests or, when there are more of them than
+    `concurrency` batches can hold, as one download of the whole details document, which is
+    parsed as a stream keeping only the watched relays.
+    Every request has its own timeout, so a slow response only affects the fingerprints it covers.
+    Connection errors, timeouts and the RETRY_STATUSES answers are attempted again with the retry policy
+    of `client`, after its jittered backoff or the `Retry-After` delay, without holding a slot meanwhile.
+    The subscriptions are taken from the in-memory `index`, so the database is only written.
+    The sweeps share the circuit `breaker` of the Onionoo client: while it is open they are paused,
+    and a sweep whose requests all fail counts as one failure.
+
+    Usage:
+        async with AsyncSweeper() as sweeper:
+            await sweeper.run(conn, notify)
+    """
+
+    def __init__(self, base_url=ONIONOO_DETAILS, concurrency=CONCURRENCY, timeout=REQUEST_TIMEOUT,
+                 batch_size=LOOKUP_BATCH, cache=relay_cache, index=relay_index, client=onionoo_client, breaker=None):
+        self.base_url = base_url
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.cache = cache
+        self.index = index
+        self.client = client
+        self.breaker = breaker or client.breaker
+        self._session = None
+        self._semaphore = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        self._session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._session.close()
+
+    async def run(self, conn, notify, fence=None):
+        """
+        Checks the status of every subscribed relay and notifies the users of the transitions.
+
+        Args:
+            conn (sqlite3.Connection): The connection to the database, owned by the calling thread.
+            notify (callable): A non-blocking function taking (user_id, message) that queues a MarkdownV2 message.
+            fence (callable): The check made before the results are written, see `apply_sweep`.
+
+        Returns:
+            int: The number of distinct fingerprints checked during the sweep.
+
+        Raises:
+            sqlite3.Error: If the relay states cannot be stored.
+
+        Note:
+            Errors are logged with the logging module. A fingerprint whose request failed or timed out
+            keeps its last known state until a later sweep fetches it.
+            While the circuit to Onionoo is open, the sweep is skipped and 0 is returned.
+            The transitions are found and stored by `apply_sweep`.
+        """
+        with SWEEP_SECONDS.time():
+            count = await self._sweep(conn, notify, fence)
+        SWEEP_FINGERPRINTS.set(count)
+        return count
+
+    async def _sweep(self, conn, notify, fence):
+        fingerprints = self.index.fingerprints()
+        if not fingerprints:
+            return 0
+
+        relays = self.cache.get_fresh(fingerprints)
+        missing = [key for key in fingerprints if key not in relays]
+
+        if missing and not self.breaker.allow():
+            logging.error("Onionoo circuit open, sweep paused for %.0f seconds", self.breaker.retry_after())
+            return 0
+
+        if len(missing) > self.batch_size * self.concurrency:
+            batches = [None]
+        else:
+            batches = [missing[i:i + self.batch_size] for i in range(0, len(missing), self.batch_size)]
+
+        results = await asyncio.gather(*(self._fetch(batch, missing) for batch in batches))
+        published = None
+
+        if batches and all(result is None for result in results):
+            self.breaker.record_failure()
+        elif batches:
+            self.breaker.record_success()
+
+        for batch, result in zip(batches, results):
+            if result is None:
+                continue
+            fetched, batch_published = result
+            fetched = {key: fetched.get(key) for key in (missing if batch is None else batch)}
+            self.cache.update(fetched)
+            relays.update(fetched)
+            published = max(published or "", batch_published or "") or None
+
+        apply_sweep(conn, self.index, relays, notify, published, fence)
+
+        return len(fingerprints)
+
+    async def _fetch(self, batch, watched):
+        # A batch of None stands for the whole details document, which is parsed as a stream
+        params = {"type": "relay", "fields": ",".join(RELAY_FIELDS)}
+        if batch is not None:
+            params["lookup"] = ",".join(batch)
+
+        for attempt in range(self.client.retries + 1):
+            last = attempt == self.client.retries
+            async with self._semaphore:
+                try:
+                    with metrics.upstream("onionoo", "details" if batch is None else "lookup"):
+                        async with self._session.get(self.base_url, params=params) as response:
+                            if response.status in RETRY_STATUSES and not last:
+                                reason, delay = str(response.status), retry_after(response)
+                            else:
+                                response.raise_for_status()
+                                if batch is not None:
+                                    data = await response.json(content_type=None)
+                                    return index_relays(data.get("relays", [])), data.get("relays_published")
+
+                                parser = RelayStreamParser(watched)
+                                async for chunk in response.content.iter_chunked(STREAM_CHUNK):
+                                    parser.feed(chunk)
+                                return parser.close(), parser.published
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                    if last:
+                        logging.error("Error fetching the relay details: %r", e)
+                        return None
+                    reason, delay = "timeout" if isinstance(e, asyncio.TimeoutError) else "connection", None
+                except (aiohttp.ClientError, ValueError) as e:
+                    logging.error("Error fetching the relay details: %r", e)
+                    return None
+
+            # Waiting outside of the semaphore, so that the other batches go on meanwhile
+            RETRIES_TOTAL.inc(reason)
+            await asyncio.sleep(self.client.delay(attempt, delay))
@@ -0,0 +1,62 @@
+"""
+Measures sweep time against a local stub Onionoo server that adds latency to every response,
+comparing sequential per-fingerprint requests with the asynchronous sweep engine.
+Beyond `batch * concurrency` missing fingerprints the engine downloads the whole details document.
+
+Usage:
+    python benchmarks/bench_async_sweep.py [fingerprints ...]
+"""
+import asyncio
+import os
+import sys
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from async_sweep import AsyncSweeper
+from fixtures import make_index
+from onionoo import RelayCache
+from stub_onionoo import StubOnionoo, make_relays
+
+RELAYS = 8000
+LATENCY = 0.05
+
+
+def sequential_sweep(rows, url):
+    # One blocking request per fingerprint, as the original run_thread did
+    for user_id, fingerprint in rows:
+        requests.get(f"{url}?search={fingerprint}").json()
+
+
+async def async_sweep(rows, url, batch_size):
+    conn, index = make_index(rows)
+    async with AsyncSweeper(base_url=url, batch_size=batch_size, cache=RelayCache(ttl=0), index=index) as sweeper:
+        await sweeper.run(conn, lambda user_id, message: None)
+
+
+def main(sizes):
+    stub = StubOnionoo(make_relays(RELAYS), latency=LATENCY).start()
+
+    print(f"{'fingerprints':>12} {'mode':>16} {'requests':>9} {'seconds':>9}")
+    for size in sizes:
+        rows = [(i, relay["fingerprint"]) for i, relay in enumerate(stub.relays[:size])]
+        modes = {
+            "sequential": lambda: sequential_sweep(rows, stub.url),
+            "async, batch=1": lambda: asyncio.run(async_sweep(rows, stub.url, 1)),
+            "async, batch=100": lambda: asyncio.run(async_sweep(rows, stub.url, 100)),
+        }
+
+        for mode, sweep in modes.items():
+            stub.reset()
+            start = time.perf_counter()
+            sweep()
+            elapsed = time.perf_counter() - start
+            print(f"{size:>12} {mode:>16} {stub.requests:>9} {elapsed:>9.3f}")
+
+    stub.stop()
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [10, 100, 1000])
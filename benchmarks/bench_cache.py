@@ -0,0 +1,59 @@
+"""
+Measures the upstream requests caused by repeated "Status Nodes" presses and sweeps
+going through the shared relay cache, one fingerprint at a time and batched, against a local
+stub Onionoo server.
+
+Usage:
+    python benchmarks/bench_cache.py [presses]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from onionoo import RelayCache
+from stub_onionoo import StubOnionoo, make_relays
+
+RELAYS = 2000
+WATCHED = 50
+
+
+def main(presses):
+    stub = StubOnionoo(make_relays(RELAYS)).start()
+    fingerprints = [relay["fingerprint"] for relay in stub.relays[:WATCHED]]
+
+    print(f"{'scenario':>22} {'requests':>9} {'304':>5} {'hits':>7} {'misses':>7} {'seconds':>9}")
+    for name, ttl in (("status, cold cache", 3600), ("status, expired ttl", 0)):
+        cache = RelayCache(base_url=stub.url, ttl=ttl)
+        stub.reset()
+        start = time.perf_counter()
+        for i in range(presses):
+            cache.lookup(fingerprints[i % WATCHED])
+        report(name, stub, cache, time.perf_counter() - start)
+
+    # "Status Nodes" of a user watching every relay, with one batched lookup per press
+    cache = RelayCache(base_url=stub.url, ttl=0)
+    stub.reset()
+    start = time.perf_counter()
+    for _ in range(10):
+        cache.lookup_many(fingerprints)
+    report("10 batched, expired", stub, cache, time.perf_counter() - start)
+
+    cache = RelayCache(base_url=stub.url, ttl=0)
+    stub.reset()
+    start = time.perf_counter()
+    for _ in range(10):
+        cache.lookup_all(fingerprints)
+    report("10 sweeps, expired ttl", stub, cache, time.perf_counter() - start)
+
+    stub.stop()
+
+
+def report(name, stub, cache, elapsed):
+    stats = cache.stats()
+    print(f"{name:>22} {stub.requests:>9} {stub.not_modified:>5} {stats['hits']:>7} {stats['misses']:>7} {elapsed:>9.3f}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -0,0 +1,89 @@
+"""
+Compares watching the relays of a few large operators one fingerprint at a time with one 'contact:'
+subscription per operator: the subscription rows stored, the Onionoo requests of a sweep and its time,
+with the members expanded through Onionoo or from the local mirror.
+
+Usage:
+    python benchmarks/bench_groups.py [users_per_operator] [latency_ms]
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+from async_sweep import AsyncSweeper
+from fixtures import make_index
+from mirror import RelayMirror
+from onionoo import RelayCache, fetch_group_members
+from stub_onionoo import StubOnionoo, make_relays
+from sweep import expand_groups, run_mirror_sweep
+
+RELAYS = 8000
+# Contacts 'operator10' to 'operator19', none of which is a substring of another
+OPERATORS = [f"operator{i}" for i in range(10, 20)]
+
+
+def subscription_rows(conn):
+    return sum(conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+               for table in ("subscriptions", "group_subscriptions"))
+
+
+def fetch_sweep(conn, index, url, groups):
+    if groups:
+        expand_groups(conn, index, lambda kind, value: fetch_group_members(kind, value, base_url=url))
+
+    async def sweep():
+        async with AsyncSweeper(base_url=url, cache=RelayCache(ttl=0), index=index) as sweeper:
+            await sweeper.run(conn, lambda user_id, message: None)
+
+    asyncio.run(sweep())
+
+
+def main(users, latency):
+    stub = StubOnionoo(make_relays(RELAYS), latency=latency).start()
+    members = {contact: [relay["fingerprint"] for relay in stub.relays if relay["contact"] == contact] for contact in OPERATORS}
+    subscribers = [(user_id, OPERATORS[user_id % len(OPERATORS)]) for user_id in range(users * len(OPERATORS))]
+
+    # Every subscriber lists the relays of its operator
+    per_relay = make_index([(user_id, fingerprint) for user_id, contact in subscribers for fingerprint in members[contact]])
+
+    # Every subscriber names its operator once
+    conn, index = make_index([])
+    with conn:
+        for user_id, contact in subscribers:
+            database.add_group_subscription(conn, user_id, "contact", contact)
+    index.load(conn)
+
+    mirrored, mirrored_index = make_index([])
+    with mirrored:
+        for user_id, contact in subscribers:
+            database.add_group_subscription(mirrored, user_id, "contact", contact)
+    mirrored_index.load(mirrored)
+    mirror = RelayMirror(base_url=stub.url)
+    mirror.refresh(mirrored)
+
+    modes = {
+        "per relay": (per_relay[0], lambda: fetch_sweep(*per_relay, stub.url, False)),
+        "contact": (conn, lambda: fetch_sweep(conn, index, stub.url, True)),
+        "contact, mirror": (mirrored, lambda: run_mirror_sweep(mirrored, lambda user_id, message: None,
+                                                               mirror=mirror, index=mirrored_index, refresh=False)),
+    }
+
+    print(f"{len(subscribers)} users watching {len(OPERATORS)} operators of ~{RELAYS // 50} relays")
+    print(f"{'mode':>16} {'rows':>8} {'requests':>9} {'seconds':>9}")
+    for mode, (db, sweep) in modes.items():
+        stub.reset()
+        start = time.perf_counter()
+        sweep()
+        elapsed = time.perf_counter() - start
+        print(f"{mode:>16} {subscription_rows(db):>8} {stub.requests:>9} {elapsed:>9.3f}")
+
+    stub.stop()
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(int(args[0]) if args else 100, (float(args[1]) if len(args) > 1 else 50) / 1000)
@@ -0,0 +1,106 @@
+"""
+Records 30 days of hourly sweeps of watched relays into the uptime history, a few of which go down
+and come back each hour, and reports the time to record a sweep, the samples stored by the
+delta encoding versus one row per relay and sweep, and the latency of the "Availability" command
+answered from the rollups versus summing a table of raw samples.
+Fails if the rollups disagree with the raw samples.
+
+Usage:
+    python benchmarks/bench_history.py [relays] [days]
+"""
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+import history
+from rendering import format_history
+from stub_onionoo import make_relays
+
+HOUR = 3600
+# Share of the relays changing state at every sweep
+CHURN = 0.01
+QUERIES = 200
+START = 1704067200
+
+
+def raw_availability(conn, fingerprint, since):
+    # One row per relay and sweep, the layout the rollups replace
+    return conn.execute('''SELECT COUNT(*), SUM(running), SUM(bandwidth), SUM(consensus_weight) FROM raw_samples
+                           WHERE fingerprint = ? AND observed >= ?''', (fingerprint, since)).fetchone()
+
+
+def latency(query, fingerprints):
+    timings = []
+    for fingerprint in fingerprints:
+        start = time.perf_counter()
+        query(fingerprint)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings), max(timings)
+
+
+def main(count, days):
+    rng = random.Random(1)
+    relays = {relay["fingerprint"]: relay for relay in make_relays(count)}
+    fingerprints = list(relays)
+
+    conn = database.connect(":memory:")
+    database.create_schema(conn)
+    conn.execute('''CREATE TABLE raw_samples (fingerprint TEXT, observed INTEGER, running INTEGER, bandwidth INTEGER,
+                    consensus_weight INTEGER, PRIMARY KEY (fingerprint, observed)) WITHOUT ROWID''')
+
+    sweeps = days * 24
+    recorded = appended = 0.0
+    for sweep in range(sweeps):
+        for fingerprint in rng.sample(fingerprints, max(1, int(count * CHURN))):
+            relays[fingerprint]["running"] = not relays[fingerprint]["running"]
+        published = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(START + sweep * HOUR))
+
+        start = time.perf_counter()
+        with conn:
+            appended += history.record_sweep(conn, relays, published)
+        recorded += time.perf_counter() - start
+
+        with conn:
+            conn.executemany('INSERT INTO raw_samples VALUES (?, ?, ?, ?, ?)',
+                             ((fingerprint, START + sweep * HOUR, running, bandwidth, weight)
+                              for fingerprint, running, bandwidth, weight in history.observations(relays)))
+
+    def count_rows(table):
+        return conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+
+    print(f"{count} relays, {sweeps} hourly sweeps, {CHURN:.0%} of the relays changing state per sweep")
+    print(f"record a sweep: {recorded / sweeps * 1000:.2f} ms, {appended / sweeps:.1f} samples appended per sweep")
+    print(f"\n{'table':>14} {'rows':>9}")
+    print(f"{'raw, 1/sweep':>14} {count_rows('raw_samples'):>9}")
+    for table in ("relay_samples", "relay_rollups", "relay_outages"):
+        print(f"{table:>14} {count_rows(table):>9}")
+    print(f"{'no delta, 48h':>14} {count * min(sweeps, database.SAMPLE_RETENTION // HOUR):>9}   rows the raw samples would keep for the same retention")
+
+    now = START + sweeps * HOUR
+    sample = rng.sample(fingerprints, min(QUERIES, count))
+    print(f"\n{'query':>22} {'p50 ms':>8} {'max ms':>8}")
+    for label, span, _ in history.WINDOWS:
+        p50, worst = latency(lambda fingerprint: raw_availability(conn, fingerprint, now - span), sample)
+        print(f"{'raw ' + label:>22} {p50:>8.3f} {worst:>8.3f}")
+    p50, worst = latency(lambda fingerprint: history.relay_history(conn, fingerprint, now), sample)
+    print(f"{'rollups, all windows':>22} {p50:>8.3f} {worst:>8.3f}")
+
+    # Both layouts count the same sweeps over the last 30 days, which start at a day boundary
+    ok = True
+    for fingerprint in sample:
+        rollup = history.relay_history(conn, fingerprint, now)["windows"][-1][1:3]
+        ok &= tuple(rollup) == tuple(raw_availability(conn, fingerprint, now - now % 86400 - 30 * 86400)[:2])
+
+    print(f"\n{format_history(sample[0], history.relay_history(conn, sample[0], now), now)}")
+    if not ok:
+        sys.exit("the rollups disagree with the raw samples")
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(int(args[0]) if args else 2000, int(args[1]) if len(args) > 1 else 30)
@@ -0,0 +1,136 @@
+"""
+Compares the original sweep, which writes the state of every watched relay, with the incremental
+sweep, which only writes and notifies the relays whose digest has changed and those subscribed to
+since the last sweep, at 100k subscriptions and a growing share of relays changing state per consensus.
+A share of new subscriptions is added before every sweep as well. The time of the uptime history,
+which records every watched relay in both cases, is reported apart.
+Fails if both sweeps do not send the same alerts.
+
+Usage:
+    python benchmarks/bench_incremental.py [subscriptions] [sweeps]
+"""
+import os
+import random
+import sys
+import time
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+import history
+from fixtures import make_index, relay_running
+from stub_onionoo import make_relays
+from sweep import apply_sweep, transition_message
+
+RELAYS = 8000
+RELAYS_PER_USER = 5
+CHURNS = (0.001, 0.01, 0.1)
+# New subscriptions before every sweep, as a share of the existing ones
+SUBSCRIBING = 0.01
+START = 1704067200
+
+
+def legacy_apply_sweep(conn, index, relays, notify, published=None):
+    # The sweep before the dirty set: every fetched relay is compared, written and updated in the index,
+    # telling the new watchers of a relay already down as the incremental sweep does
+    arrivals = index.pop_arrivals(relays)
+    if published is not None and published == index.consensus:
+        return []
+
+    now = datetime.now(timezone.utc).isoformat(timespec="seconds")
+    transitions = []
+    states = []
+    for key, relay in relays.items():
+        running = relay_running(relay)
+        state = index.state(key)
+        if running != (True if state is None else state.running):
+            transitions.append((key, running))
+        elif key in arrivals and running is not True:
+            for user_id in arrivals[key]:
+                notify(user_id, transition_message(key, running))
+        last_restarted = relay.get("last_restarted") if relay else None
+        states.append((key, running, now if running else None, last_restarted, published))
+
+    with conn:
+        database.save_relay_states(conn, states)
+        history.record_sweep(conn, relays, published)
+    index.update_states(states, published)
+
+    for key, running in transitions:
+        for user_id in index.subscribers(key):
+            notify(user_id, transition_message(key, running))
+    return transitions
+
+
+def run(apply, subscriptions, churn, sweeps):
+    """
+    Returns the seconds per sweep spent out of and in the history, the relay states written per sweep and the alerts sent.
+    """
+    rng = random.Random(1)
+    relays = {relay["fingerprint"]: relay for relay in make_relays(RELAYS)}
+    fingerprints = list(relays)
+    users = subscriptions // RELAYS_PER_USER
+    conn, index = make_index([(user_id, fingerprint) for user_id in range(users)
+                              for fingerprint in rng.sample(fingerprints, RELAYS_PER_USER)])
+    alerts = []
+    notify = lambda user_id, message: alerts.append((user_id, message))
+
+    # The first sweep stores every relay, the following ones are the steady state
+    apply(conn, index, relays, notify, time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(START)))
+    alerts.clear()
+
+    recording = [0.0]
+    written = [0]
+    record_sweep, save_relay_states = history.record_sweep, database.save_relay_states
+
+    def timed_record(*args):
+        start = time.perf_counter()
+        result = record_sweep(*args)
+        recording[0] += time.perf_counter() - start
+        return result
+
+    def counted_save(conn, states):
+        written[0] += len(states)
+        return save_relay_states(conn, states)
+
+    history.record_sweep, database.save_relay_states = timed_record, counted_save
+    total = 0.0
+    try:
+        for i in range(1, sweeps + 1):
+            for fingerprint in rng.sample(fingerprints, int(RELAYS * churn)):
+                relays[fingerprint]["running"] = not relays[fingerprint]["running"]
+            with conn:
+                for user_id in rng.sample(range(users), int(subscriptions * SUBSCRIBING)):
+                    fingerprint = rng.choice(fingerprints)
+                    if database.add_subscriptions(conn, user_id, [fingerprint]):
+                        index.add(user_id, fingerprint)
+
+            published = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(START + i * 3600))
+            start = time.perf_counter()
+            apply(conn, index, relays, notify, published)
+            total += time.perf_counter() - start
+    finally:
+        history.record_sweep, database.save_relay_states = record_sweep, save_relay_states
+
+    return (total - recording[0]) / sweeps, recording[0] / sweeps, written[0] / sweeps, sorted(alerts)
+
+
+def main(subscriptions, sweeps):
+    print(f"{subscriptions} subscriptions of {RELAYS} relays, {SUBSCRIBING:.0%} new subscriptions per sweep, {sweeps} sweeps")
+    print(f"{'churn':>6} {'sweep':>12} {'ms/sweep':>9} {'history ms':>11} {'states':>7} {'alerts':>7}")
+    ok = True
+    for churn in CHURNS:
+        results = {}
+        for name, apply in (("full", legacy_apply_sweep), ("incremental", apply_sweep)):
+            elapsed, recording, states, alerts = results[name] = run(apply, subscriptions, churn, sweeps)
+            print(f"{churn:>6.1%} {name:>12} {elapsed * 1000:>9.2f} {recording * 1000:>11.2f} {states:>7.0f} {len(alerts):>7}")
+        ok &= results["full"][3] == results["incremental"][3]
+
+    if not ok:
+        sys.exit("the incremental sweep sent different alerts")
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(int(args[0]) if args else 100000, int(args[1]) if len(args) > 1 else 10)
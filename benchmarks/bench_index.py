@@ -0,0 +1,103 @@
+"""
+Measures the memory and lookup time of the in-memory relay index against dictionaries of strings,
+the legacy NodeList strings per user and the (user_id, fingerprint) lists per relay that the sweeps
+used to build from SQLite, at up to a million subscriptions.
+
+Usage:
+    python benchmarks/bench_index.py [subscriptions ...]
+"""
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from relay_index import RelayIndex
+
+RELAYS = 8000
+RELAYS_PER_USER = 5
+
+
+def make_rows(subscriptions, seed=1):
+    """
+    Yields (user_id, fingerprint) rows with a new string per row, as read from SQLite.
+    """
+    rng = random.Random(seed)
+    relays = [rng.getrandbits(160) for _ in range(RELAYS)]
+
+    for i in range(subscriptions):
+        yield 10 ** 9 + i // RELAYS_PER_USER, format(relays[rng.randrange(RELAYS)], "040X")
+
+
+def node_lists(rows):
+    # Legacy layout: one space-separated string per user, no reverse lookup
+    users = {}
+    for user_id, fingerprint in rows:
+        users[user_id] = f"{users[user_id]} {fingerprint}" if user_id in users else fingerprint
+    return users
+
+
+def subscription_lists(rows):
+    # Layout of the former collect_subscriptions: (user_id, fingerprint) pairs per relay
+    subscriptions = {}
+    for user_id, fingerprint in rows:
+        subscriptions.setdefault(fingerprint, []).append((user_id, fingerprint))
+    return subscriptions
+
+
+def relay_index(rows):
+    index = RelayIndex()
+    for user_id, fingerprint in rows:
+        index.add(user_id, fingerprint)
+    return index
+
+
+def measure(build, size):
+    # Only the memory still held by the structure is counted, not the rows it was built from
+    tracemalloc.start()
+    start = time.perf_counter()
+    structure = build(make_rows(size))
+    elapsed = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return structure, memory, elapsed
+
+
+def main(sizes):
+    print(f"{'subscriptions':>13} {'layout':>13} {'MiB':>8} {'bytes/sub':>10} {'build s':>8} {'sweep ms':>9} {'user us':>8}")
+    for size in sizes:
+        users = [10 ** 9 + i for i in range(0, size // RELAYS_PER_USER, max(1, size // RELAYS_PER_USER // 1000))]
+
+        for layout, build in (("node lists", node_lists), ("subscr. lists", subscription_lists), ("relay index", relay_index)):
+            structure, memory, elapsed = measure(build, size)
+
+            # A sweep walks the subscribers of every relay, a "Status Nodes" press reads one user's relays
+            start = time.perf_counter()
+            if layout == "node lists":
+                sum(len(node_list.split()) for node_list in structure.values())
+            elif layout == "subscr. lists":
+                sum(len(pairs) for pairs in structure.values())
+            else:
+                sum(len(structure.subscribers(fingerprint)) for fingerprint in structure.fingerprints())
+            sweep = time.perf_counter() - start
+
+            # The relay lists have no per-user access, which took a query on the 'subscriptions' table
+            user = "-"
+            if layout != "subscr. lists":
+                start = time.perf_counter()
+                for user_id in users:
+                    if layout == "node lists":
+                        structure[user_id].split()
+                    else:
+                        structure.user_fingerprints(user_id)
+                user = f"{(time.perf_counter() - start) / len(users) * 10 ** 6:.1f}"
+
+            print(f"{size:>13} {layout:>13} {memory / 2 ** 20:>8.1f} {memory / size:>10.1f} {elapsed:>8.2f} "
+                  f"{sweep * 1000:>9.1f} {user:>8}")
+            del structure
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [10000, 100000, 1000000])
@@ -0,0 +1,63 @@
+"""
+Measures the overhead of the instrumentation on the hot instrumented call, a SQLite lookup,
+with the metrics disabled and enabled, then runs a sweep against a local stub Onionoo server and
+prints what the /metrics endpoint exposes.
+
+Usage:
+    python benchmarks/bench_metrics.py [calls]
+"""
+import os
+import sys
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+import metrics
+from fixtures import make_index
+from onionoo import RelayCache
+from stub_onionoo import StubOnionoo, make_relays
+from sweep import run_sweep
+
+RELAYS = 2000
+
+
+def per_call(function, calls):
+    start = time.perf_counter()
+    for _ in range(calls):
+        function()
+    return (time.perf_counter() - start) / calls * 10 ** 9
+
+
+def main(calls):
+    conn, _ = make_index([(1, "A" * 40)])
+    raw = database.list_subscriptions
+
+    # While disabled the decorated function is the plain one, which is the baseline
+    print(f"{'mode':>10} {'ns/call':>9} {'overhead':>9}")
+    baseline = per_call(lambda: raw(conn, 1), calls)
+    print(f"{'disabled':>10} {baseline:>9.0f} {'':>9}")
+
+    server = metrics.start_server(0)
+    assert database.list_subscriptions is not raw
+    enabled = per_call(lambda: database.list_subscriptions(conn, 1), calls)
+    print(f"{'enabled':>10} {enabled:>9.0f} {(enabled - baseline) / baseline:>9.1%}")
+
+    # A sweep through the cache, then a scrape of the endpoint
+    stub = StubOnionoo(make_relays(RELAYS)).start()
+    rows = [(user_id, relay["fingerprint"]) for user_id, relay in enumerate(stub.relays[:500])]
+    conn, index = make_index(rows)
+    run_sweep(conn, lambda user_id, message: None, fetch=RelayCache(base_url=stub.url).lookup_all, index=index)
+    stub.stop()
+
+    host, port = server.server_address
+    body = requests.get(f"http://{host}:{port}/metrics").text
+    print()
+    print("\n".join(line for line in body.splitlines() if not line.startswith("#") and "_bucket" not in line))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
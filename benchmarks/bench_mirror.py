@@ -0,0 +1,115 @@
+"""
+Measures the local relay mirror against a stub Onionoo server: the cost of a full, an unchanged and
+a partly changed refresh, the latency of a "Status Nodes" lookup served from the mirror versus from
+Onionoo, and what is left of the lookups once Onionoo stops answering.
+
+Usage:
+    python benchmarks/bench_mirror.py [relays] [latency_ms]
+"""
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fixtures import make_index
+from mirror import RelayMirror
+from onionoo import RelayCache
+from onionoo_client import onionoo_client
+from stub_onionoo import StubOnionoo, make_relays
+from sweep import run_mirror_sweep
+
+LOOKUPS = 200
+NODES_PER_USER = 5
+# Share of the relays whose record changes between two publications
+CHURN = 0.01
+
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return time.perf_counter() - start, result
+
+
+def lookup_latency(lookup, relays, seed=1):
+    """
+    Returns the median latency in milliseconds of `LOOKUPS` lookups of a few random relays, and the failures.
+    """
+    rng = random.Random(seed)
+    samples = []
+    failures = 0
+    for _ in range(LOOKUPS):
+        fingerprints = [relay["fingerprint"] for relay in rng.sample(relays, NODES_PER_USER)]
+        start = time.perf_counter()
+        try:
+            lookup(fingerprints)
+        except requests.RequestException:
+            failures += 1
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return samples[len(samples) // 2] * 1000, failures
+
+
+def main(count, latency):
+    stub = StubOnionoo(make_relays(count), latency=latency).start()
+    # Retrying the failed lookups quickly, the circuit opens after a few of them anyway
+    onionoo_client.configure(backoff=0.01)
+    rows = [(user_id, relay["fingerprint"]) for user_id, relay in enumerate(stub.relays[:count // 4])]
+    conn, index = make_index(rows)
+    mirror = RelayMirror(base_url=stub.url)
+
+    print(f"{'refresh':>10} {'seconds':>8} {'changed':>8}")
+    elapsed, changed = timed(lambda: mirror.refresh(conn))
+    print(f"{'full':>10} {elapsed:>8.3f} {changed:>8}")
+    elapsed, changed = timed(lambda: mirror.refresh(conn))
+    print(f"{'unchanged':>10} {elapsed:>8.3f} {changed:>8}")
+
+    # A new publication where a few relays changed state
+    for relay in random.Random(2).sample(stub.relays, int(count * CHURN)):
+        relay["running"] = not relay["running"]
+    stub.last_modified = "Mon, 01 Jan 2024 01:00:00 GMT"
+    stub.published = "2024-01-01 01:00:00"
+    elapsed, changed = timed(lambda: mirror.refresh(conn))
+    print(f"{'churn':>10} {elapsed:>8.3f} {changed:>8}")
+
+    # A saved copy of the document, as loaded for offline testing
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as dump:
+        json.dump({"relays_published": "2024-01-01 02:00:00", "relays": stub.relays}, dump)
+    elapsed, changed = timed(lambda: mirror.load_dump(conn, dump.name))
+    print(f"{'dump':>10} {elapsed:>8.3f} {changed:>8}")
+    os.unlink(dump.name)
+
+    elapsed, checked = timed(lambda: run_mirror_sweep(conn, lambda user_id, message: None, mirror=mirror,
+                                                      index=index, refresh=False))
+    print(f"{'sweep':>10} {elapsed:>8.3f} {checked:>8}")
+
+    # "Status Nodes" latency, the cache being cold as after its TTL
+    cache = RelayCache(base_url=stub.url)
+
+    def from_onionoo(fingerprints):
+        cache.clear()
+        return cache.lookup_many(fingerprints)
+
+    print()
+    print(f"{'lookup':>10} {'onionoo':>8} {'p50 ms':>8} {'failed':>8}")
+    for state in ("up", "down"):
+        for name, lookup in (("onionoo", from_onionoo), ("mirror", lambda fingerprints: mirror.lookup_many(conn, fingerprints))):
+            median, failures = lookup_latency(lookup, stub.relays)
+            print(f"{name:>10} {state:>8} {median:>8.2f} {failures:>8}")
+        if state == "up":
+            # Answering errors rather than stopping, the pooled keep-alive connections would outlive the server
+            stub.down = True
+
+    stub.stop()
+    status = mirror.status(conn)
+    print(f"\nmirror: {status['relays']} relays published {status['relays_published']}, stale: {status['stale']}")
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(int(args[0]) if args else 8000, (float(args[1]) if len(args) > 1 else 50) / 1000)
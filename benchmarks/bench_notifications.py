@@ -0,0 +1,54 @@
+"""
+Drives the notification queue through pyTelegramBotAPI against a local stand-in of the Telegram
+Bot API, and checks that Telegram's global and per-chat limits are never exceeded.
+
+The stand-in also answers some requests with a 429 on purpose, which the queue has to honor.
+Exits with status 1 if any limit was exceeded or any alert was lost.
+
+Usage:
+    python benchmarks/bench_notifications.py [users] [alerts_per_user] [sweeps]
+"""
+import os
+import sys
+import time
+
+import telebot
+from telebot import apihelper
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from notifications import NotificationQueue
+from stub_telegram import StubTelegram
+
+
+def main(users, alerts_per_user, sweeps):
+    stub = StubTelegram(flood_every=25).start()
+    apihelper.API_URL = stub.api_url
+    bot = telebot.TeleBot("123456:TEST")
+
+    queue = NotificationQueue(lambda chat_id, text: bot.send_message(chat_id, text)).start()
+
+    # Several sweeps in a row: each one is coalesced per user, and the later ones hit the per-chat limit
+    start = time.perf_counter()
+    alerts = []
+    for sweep in range(sweeps):
+        batch = [(user_id, f"alert {sweep}.{i} for {user_id}") for user_id in range(users) for i in range(alerts_per_user)]
+        queue.submit_many(batch)
+        alerts.extend(batch)
+        time.sleep(0.5)
+    queue.wait_idle()
+    elapsed = time.perf_counter() - start
+    queue.stop()
+    stub.stop()
+
+    delivered = sum(text.count("alert ") for _, _, text in stub.messages)
+    print(f"users: {users}, alerts: {len(alerts)}, telegram messages: {len(stub.messages)}")
+    print(f"seconds: {elapsed:.2f}, injected 429: {stub.floods}, retried: {queue.retried}, failed: {queue.failed}")
+    print(f"limit violations: {len(stub.violations)}, alerts delivered: {delivered}/{len(alerts)}")
+
+    return 1 if stub.violations or delivered != len(alerts) or queue.failed else 0
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:]]
+    sys.exit(main(*(args + [100, 5, 3][len(args):])))
@@ -0,0 +1,94 @@
+"""
+Measures the time to render the status card of a relay: the original formatting with its final
+`.replace(".", "\\.")` pass, the single-pass MarkdownV2 rendering, and the cards cached per consensus
+by `RelayCards`, where only the uptime is computed for each request.
+
+Usage:
+    python benchmarks/bench_render.py [relays] [requests_per_relay]
+"""
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rendering import RelayCards, convert_bandwidth, render_card
+from stub_onionoo import make_relays
+
+PUBLISHED = "2024-01-01 00:00:00"
+
+
+def legacy_uptime(last_restarted):
+    # The original get_uptime
+    delta = datetime.now() - datetime.fromisoformat(last_restarted)
+    raw = delta.total_seconds()
+    days = int(raw // (24 * 3600))
+    hours = int((raw % (24 * 3600)) // 3600)
+    minutes = int((raw % 3600) // 60)
+    seconds = int(raw % 60)
+    months = days // 30
+    remaining_days = days % 30
+    if months > 0:
+        return "{:d} months, {:d} days, {:02d}:{:02d}:{:02d}".format(months, remaining_days, hours, minutes, seconds)
+    elif days > 0:
+        return "{:d} days, {:02d}:{:02d}:{:02d}".format(remaining_days, hours, minutes, seconds)
+    return "{:02d}:{:02d}:{:02d}".format(hours, minutes, seconds)
+
+
+def legacy_card(fingerprint, relay):
+    # The formatting of the original get_status_of_relay, which only escaped the dots
+    uptime = legacy_uptime(relay.get('last_restarted', ''))
+    relay_status = f"Fingerprint: `{fingerprint}`\n" \
+                   f"Status: {'Running ✅' if relay.get('running') else 'Offline ❌'}\n" \
+                   f"Nickname: {relay.get('nickname', 'N/A')}\n" \
+                   f"Country: {relay.get('country_name', 'N/A')}\n" \
+                   f"Bandwidth: {convert_bandwidth(relay.get('bandwidth_rate'))} bytes/s\n" \
+                   f"Uptime: {uptime}"
+    return relay_status.replace(".", "\\.")
+
+
+def timed(render, relays, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for relay in relays:
+            render(relay["fingerprint"], relay)
+    return (time.perf_counter() - start) / (rounds * len(relays)) * 1e6
+
+
+def main(count, rounds):
+    relays = make_relays(count)
+    # Names with MarkdownV2 characters the original formatting left unescaped
+    for relay in relays[::10]:
+        relay["nickname"] = f"{relay['nickname']}-exit_(1)!"
+
+    # Without a consensus version every request renders the whole card, with one it is served from the cache
+    cards = RelayCards()
+    cached = lambda fingerprint, relay: cards.render(fingerprint, relay, PUBLISHED)
+    modes = {
+        "legacy": legacy_card,
+        "single pass": lambda fingerprint, relay: cards.render(fingerprint, relay),
+        "cached": cached,
+    }
+
+    print(f"{count} relays, {rounds} requests per relay, microseconds per card")
+    print(f"{'mode':>12} {'us/card':>9}")
+    for mode, render in modes.items():
+        cards.clear()
+        print(f"{mode:>12} {timed(render, relays, rounds):>9.2f}")
+    print(f"{'cache':>12} {cards.hits} hits, {cards.misses} misses")
+
+    # The part of the card that does not depend on the clock renders once per consensus
+    start = time.perf_counter()
+    for relay in relays:
+        render_card(relay["fingerprint"], relay)
+    print(f"{'card body':>12} {(time.perf_counter() - start) / count * 1e6:>9.2f}")
+
+    sample = relays[0]
+    print(f"\nlegacy:\n{legacy_card(sample['fingerprint'], sample)}")
+    print(f"\nrendered at {datetime.now():%H:%M:%S}:\n{cached(sample['fingerprint'], sample)}")
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(int(args[0]) if args else 8000, int(args[1]) if len(args) > 1 else 10)
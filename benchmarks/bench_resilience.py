@@ -0,0 +1,134 @@
+"""
+Exercises the shared Onionoo client against a flaky stub server: connections opened by bare
+`requests.get` calls versus the keep-alive pool, lookups failing with and without retries when a
+share of the answers are 503 or 429, a hung response with and without timeouts, and the requests
+that reach Onionoo during an outage with and without the circuit breaker, while the relay cache
+keeps answering "Status Nodes" with its last known records.
+Fails if the client loses a tenth of the lookups the bare calls lose, or the breaker lets the outage through.
+
+Usage:
+    python benchmarks/bench_resilience.py [lookups]
+"""
+import asyncio
+import os
+import random
+import sys
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from async_sweep import AsyncSweeper
+from fixtures import make_index
+from onionoo import RelayCache
+from onionoo_client import CLOSED, OPEN, CircuitOpenError, onionoo_client
+from stub_onionoo import StubOnionoo, make_relays
+
+RELAYS = 1000
+# Short delays, so that the run takes seconds
+BACKOFF = 0.01
+RESET_TIMEOUT = 0.5
+HANG = 3.0
+READ_TIMEOUT = 0.25
+
+
+def run(lookups, get, fingerprints):
+    """
+    Returns the failed lookups and the milliseconds per lookup of `lookups` requests of random relays.
+    """
+    rng = random.Random(1)
+    failures = 0
+    start = time.perf_counter()
+    for _ in range(lookups):
+        try:
+            get({"lookup": rng.choice(fingerprints)}).raise_for_status()
+        except requests.RequestException:
+            failures += 1
+    return failures, (time.perf_counter() - start) / lookups * 1000
+
+
+def reset(stub, **settings):
+    stub.reset()
+    stub.down = False
+    stub.failure_rate = stub.hang_rate = 0.0
+    stub.failure_status = 503
+    for name, value in settings.items():
+        setattr(stub, name, value)
+    onionoo_client.breaker.record_success()
+
+
+def main(lookups):
+    stub = StubOnionoo(make_relays(RELAYS), hang=HANG).start()
+    fingerprints = [relay["fingerprint"] for relay in stub.relays]
+    bare = lambda params: requests.get(stub.url, params=params)
+    pooled = lambda params: onionoo_client.get(stub.url, params=params)
+    onionoo_client.configure(backoff=BACKOFF, read_timeout=READ_TIMEOUT, reset_timeout=RESET_TIMEOUT)
+    ok = True
+
+    print(f"{'scenario':>14} {'client':>8} {'failed':>7} {'requests':>9} {'conns':>6} {'ms/lookup':>10}")
+
+    def report(scenario, name, get, count=lookups):
+        failures, elapsed = run(count, get, fingerprints)
+        print(f"{scenario:>14} {name:>8} {failures:>7} {stub.requests:>9} {stub.connections:>6} {elapsed:>10.2f}")
+        return failures
+
+    for scenario, settings in (("healthy", {}), ("30% 503", {"failure_rate": 0.3}),
+                               ("30% 429", {"failure_rate": 0.3, "failure_status": 429})):
+        reset(stub, **settings)
+        lost = report(scenario, "bare", bare)
+        reset(stub, **settings)
+        ok &= report(scenario, "client", pooled) <= lost / 10
+
+    # A response that never comes, the bare call waits for it, the client gives up after its read timeout
+    for name, get in (("bare", bare), ("client", pooled)):
+        reset(stub, hang_rate=1.0)
+        report("hung", name, get, count=1)
+
+    # Onionoo down for a while: without the breaker every lookup retries, with it they fail at once
+    reset(stub)
+    cache = RelayCache(base_url=stub.url, ttl=0)
+    cache.lookup_many(fingerprints[:50])
+    for name, threshold in (("retries", 10 ** 9), ("breaker", 5)):
+        onionoo_client.configure(failure_threshold=threshold)
+        reset(stub, down=True)
+        served = rejected = 0
+        start = time.perf_counter()
+        for i in range(lookups):
+            try:
+                cache.lookup_many(fingerprints[i % 50:i % 50 + 5])
+            except CircuitOpenError:
+                rejected += 1
+                served += len(cache.peek(fingerprints[i % 50:i % 50 + 5]))
+            except requests.RequestException:
+                served += len(cache.peek(fingerprints[i % 50:i % 50 + 5]))
+        elapsed = (time.perf_counter() - start) / lookups * 1000
+        print(f"{'outage':>14} {name:>8} {lookups:>7} {stub.requests:>9} {stub.connections:>6} {elapsed:>10.2f}"
+              f"   {rejected} refused, {served} relays served from the cache")
+        if threshold == 5:
+            ok &= onionoo_client.breaker.state == OPEN and stub.requests <= (onionoo_client.retries + 1) * 5
+
+    # The sweeps pause while the circuit is open, then the trial request closes it once Onionoo is back
+    conn, index = make_index([(1, fingerprint) for fingerprint in fingerprints[:100]])
+
+    async def sweep():
+        async with AsyncSweeper(base_url=stub.url, cache=RelayCache(ttl=0), index=index) as sweeper:
+            return await sweeper.run(conn, lambda user_id, message: None)
+
+    stub.reset()
+    paused = asyncio.run(sweep())
+    requests_paused = stub.requests
+    stub.down = False
+    time.sleep(RESET_TIMEOUT)
+    resumed = asyncio.run(sweep())
+    print(f"\nsweep while open: {paused} relays checked, {requests_paused} requests; "
+          f"after {RESET_TIMEOUT} s: {resumed} relays checked, circuit {onionoo_client.breaker.state}")
+    ok &= paused == 0 and requests_paused == 0 and resumed == 100 and onionoo_client.breaker.state == CLOSED
+
+    stub.stop()
+    if not ok:
+        sys.exit("the Onionoo client lost lookups or the breaker let the outage through")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
@@ -0,0 +1,102 @@
+"""
+Measures the cold start of the bot in fresh interpreters: the time to import the core modules and
+whether they pull in `telebot`, the time to import main.py, and the time from launching
+`python main.py` to the first poll of Telegram and to the reply to a first /start update,
+against a local stand-in of the Bot API. The embedded watchdog is disabled, so Onionoo is not contacted.
+
+Pass the path of another checkout to measure it the same way, such as an older commit added with
+`git worktree add /tmp/before HEAD~1`.
+
+Usage:
+    python benchmarks/bench_startup.py [tree] [runs]
+"""
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stub_telegram import StubTelegram
+
+# Modules of the core, present in every checkout since the relay history
+CORE = ("database", "onionoo", "onionoo_client", "mirror", "relay_index", "rendering", "history", "sweep")
+# Sets the Bot API address, then runs main.py as `python main.py` would
+LAUNCHER = ("import runpy, sys, telebot; telebot.apihelper.API_URL = sys.argv[1]; "
+            "sys.argv = [sys.argv[2]]; runpy.run_path(sys.argv[0], run_name='__main__')")
+CONFIG = """[telegram]
+token = 123456:TEST
+
+[watchdog]
+embedded = false
+"""
+TIMEOUT = 60
+
+
+def import_time(tree, modules):
+    """
+    Returns the seconds to import the modules in a fresh interpreter, and whether `telebot` got imported.
+    """
+    code = ("import sys, time; start = time.perf_counter(); " + "; ".join(f"import {module}" for module in modules)
+            + "; print(time.perf_counter() - start, 'telebot' in sys.modules)")
+    output = subprocess.run([sys.executable, "-c", code], cwd=tree, capture_output=True, text=True, timeout=TIMEOUT)
+    if output.returncode:
+        return None, None
+    elapsed, telebot = output.stdout.split()
+    return float(elapsed), telebot == "True"
+
+
+def first_update(tree):
+    """
+    Returns the seconds from launching main.py to its first poll and to its reply to a /start update.
+    """
+    stub = StubTelegram(enforce_limits=False).start()
+    stub.push_update(42, "/start")
+    with tempfile.TemporaryDirectory() as workdir:
+        with open(os.path.join(workdir, "config.ini"), "w") as config:
+            config.write(CONFIG)
+        start = time.monotonic()
+        process = subprocess.Popen([sys.executable, "-c", LAUNCHER, stub.api_url, os.path.join(tree, "main.py")],
+                                   cwd=workdir, env=dict(os.environ, PYTHONPATH=tree),
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            while not stub.messages and time.monotonic() - start < TIMEOUT:
+                time.sleep(0.005)
+        finally:
+            process.kill()
+            process.wait()
+        stub.stop()
+    if not stub.messages:
+        return None, None
+    return stub.first_poll - start, stub.messages[0][0] - start
+
+
+def main(tree, runs):
+    tree = os.path.abspath(tree)
+    print(f"{tree}, median of {runs} runs")
+
+    for label, modules in (("core", CORE), ("core + validation", CORE + ("validation",)), ("main.py", ("main",))):
+        # Importing the main.py of a checkout that starts the bot on import never returns
+        if label == "main.py" and subprocess.run(["grep", "-q", "^bot = telebot", os.path.join(tree, "main.py")]).returncode == 0:
+            print(f"{'import ' + label:>24}    starts the bot on import")
+            continue
+        results = [import_time(tree, modules) for _ in range(runs)]
+        if results[0][0] is None:
+            print(f"{'import ' + label:>24}    not available")
+            continue
+        print(f"{'import ' + label:>24} {statistics.median(elapsed for elapsed, _ in results) * 1000:>8.1f} ms"
+              f"   telebot imported: {results[0][1]}")
+
+    results = [first_update(tree) for _ in range(runs)]
+    if any(poll is None for poll, _ in results):
+        sys.exit("main.py never answered the /start update")
+    print(f"{'first poll':>24} {statistics.median(poll for poll, _ in results) * 1000:>8.1f} ms")
+    print(f"{'first reply':>24} {statistics.median(reply for _, reply in results) * 1000:>8.1f} ms")
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(args[0] if args else os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+         int(args[1]) if len(args) > 1 else 5)
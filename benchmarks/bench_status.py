@@ -0,0 +1,54 @@
+"""
+Measures the latency of the "Status Nodes" lookups as the number of nodes of a user grows,
+comparing one Onionoo request per node with one batched lookup, against a local stub Onionoo
+server that adds latency to every response. The cache is cold for every press.
+
+Usage:
+    python benchmarks/bench_status.py [nodes ...]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from onionoo import RelayCache
+from stub_onionoo import StubOnionoo, make_relays
+
+RELAYS = 2000
+LATENCY = 0.02
+PRESSES = 20
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def main(sizes):
+    stub = StubOnionoo(make_relays(RELAYS), latency=LATENCY).start()
+
+    print(f"{'nodes':>6} {'mode':>10} {'requests':>9} {'p50 ms':>8} {'p99 ms':>8}")
+    for size in sizes:
+        fingerprints = [relay["fingerprint"] for relay in stub.relays[:size]]
+        modes = {
+            "per node": lambda cache: [cache.lookup(fingerprint) for fingerprint in fingerprints],
+            "batched": lambda cache: cache.lookup_many(fingerprints),
+        }
+
+        for mode, press in modes.items():
+            stub.reset()
+            samples = []
+            for _ in range(PRESSES):
+                cache = RelayCache(base_url=stub.url, ttl=0)
+                start = time.perf_counter()
+                press(cache)
+                samples.append((time.perf_counter() - start) * 1000)
+            print(f"{size:>6} {mode:>10} {stub.requests // PRESSES:>9} "
+                  f"{percentile(samples, 0.5):>8.1f} {percentile(samples, 0.99):>8.1f}")
+
+    stub.stop()
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [1, 10, 40])
@@ -0,0 +1,106 @@
+"""
+Compares peak RSS and parse time of `json.loads` on a whole Onionoo details document with the
+streaming `RelayStreamParser`, keeping the relays of a watched set.
+
+Pass a recorded dump (for example `curl -o details.json https://onionoo.torproject.org/details`)
+or let the script generate a synthetic one with the fields of a full details document.
+Every mode runs in its own process, so that the peak RSS of one does not hide the other.
+
+Usage:
+    python benchmarks/bench_streaming.py [details.json] [watched]
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fixtures import peak_rss_kb
+from onionoo import RELAY_FIELDS, STREAM_CHUNK, RelayStreamParser
+from stub_onionoo import make_relays
+
+RELAYS = 8000
+
+
+def write_dump(path):
+    relays = make_relays(RELAYS)
+    for i, relay in enumerate(relays):
+        # Fields of a full details document that the bot does not use
+        relay.update({
+            "or_addresses": [f"192.0.2.{i % 250}:9001", f"[2001:db8::{i:x}]:9001"],
+            "exit_policy": ["reject *:25", "reject *:119", "accept *:*"] * 4,
+            "exit_policy_summary": {"reject": ["25", "119", "135-139", "445", "563", "1214"]},
+            "flags": ["Fast", "Guard", "HSDir", "Running", "Stable", "V2Dir", "Valid"],
+            "family": [relay["fingerprint"]] * 3,
+            "platform": "Tor 0.4.8.10 on Linux",
+            "version": "0.4.8.10",
+            "as_name": "Example Hosting GmbH",
+            "contact": "operator <abuse AT example dot org> " * 2,
+            "observed_bandwidth": 12345678,
+            "consensus_weight": 12000,
+            "first_seen": "2020-01-01 00:00:00",
+            "last_seen": "2024-01-01 00:00:00",
+        })
+    with open(path, "w") as dump:
+        json.dump({"version": "8.0", "relays_published": "2024-01-01 00:00:00", "relays": relays,
+                   "bridges_published": "2024-01-01 00:00:00", "bridges": []}, dump)
+
+
+def run_mode(mode, path, keys_path):
+    with open(keys_path) as keys_file:
+        keys = set(json.load(keys_file))
+
+    base = peak_rss_kb()
+    start = time.perf_counter()
+    with open(path, "rb") as dump:
+        if mode == "json":
+            data = json.loads(dump.read())
+            relays = {relay["fingerprint"]: {field: relay[field] for field in RELAY_FIELDS if field in relay}
+                      for relay in data["relays"] if relay["fingerprint"] in keys}
+        else:
+            parser = RelayStreamParser(keys)
+            for chunk in iter(lambda: dump.read(STREAM_CHUNK), b""):
+                parser.feed(chunk)
+            relays = parser.close()
+    elapsed = time.perf_counter() - start
+    peak = peak_rss_kb()
+
+    print(json.dumps({"mode": mode, "relays": len(relays), "seconds": elapsed, "peak_rss_kb": peak,
+                      "peak_rss_growth_kb": peak - base}))
+
+
+def main(path, watched):
+    temporary = None
+    if path is None:
+        temporary = tempfile.NamedTemporaryFile(suffix=".json", delete=False)
+        temporary.close()
+        path = temporary.name
+        write_dump(path)
+
+    with open(path, "rb") as dump:
+        keys = [relay["fingerprint"] for relay in json.load(dump)["relays"][:watched]]
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as keys_file:
+        json.dump(keys, keys_file)
+
+    print(f"document: {os.path.getsize(path) / 2**20:.1f} MB, watched relays: {len(keys)}")
+    print(f"{'mode':>7} {'kept':>6} {'seconds':>8} {'RSS growth MB':>14}")
+    for mode in ("json", "stream"):
+        output = subprocess.run([sys.executable, __file__, "--mode", mode, path, keys_file.name],
+                                capture_output=True, text=True, check=True).stdout
+        result = json.loads(output)
+        print(f"{mode:>7} {result['relays']:>6} {result['seconds']:>8.3f} {result['peak_rss_growth_kb'] / 1024:>14.1f}")
+
+    os.unlink(keys_file.name)
+    if temporary is not None:
+        os.unlink(path)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--mode"]:
+        run_mode(sys.argv[2], sys.argv[3], sys.argv[4])
+    else:
+        args = sys.argv[1:]
+        main(args[0] if args else None, int(args[1]) if len(args) > 1 else 2000)
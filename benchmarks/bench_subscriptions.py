@@ -0,0 +1,144 @@
+"""
+Compares add, remove, list and sweep latency of the legacy space-separated NodeList column
+with the normalized 'subscriptions' table, then the onboarding of an operator's relays with one
+transaction per relay versus one batch for all of them.
+
+Usage:
+    python benchmarks/bench_subscriptions.py [subscriptions]
+"""
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+from stub_onionoo import make_fingerprint
+
+USERS = 1000
+OPERATIONS = 1000
+# Relays of the operator being onboarded
+BATCH = 50
+
+
+def legacy_add(conn, user_id, fingerprint):
+    row = conn.execute('SELECT NodeList FROM TorWatchdog WHERE TelegramUserID = ?', (user_id,)).fetchone()
+    node_list = row[0] if row else ""
+    if fingerprint not in node_list.split():
+        node_list += (" " if node_list else "") + fingerprint
+        conn.execute('UPDATE TorWatchdog SET NodeList = ? WHERE TelegramUserID = ?', (node_list, user_id))
+    conn.commit()
+
+
+def legacy_remove(conn, user_id, fingerprint):
+    row = conn.execute('SELECT NodeList FROM TorWatchdog WHERE TelegramUserID = ?', (user_id,)).fetchone()
+    node_list = row[0].replace(" " + fingerprint, "").replace(fingerprint, "").strip()
+    conn.execute('UPDATE TorWatchdog SET NodeList = ? WHERE TelegramUserID = ?', (node_list, user_id))
+    conn.commit()
+
+
+def legacy_list(conn, user_id):
+    return sorted(conn.execute('SELECT NodeList FROM TorWatchdog WHERE TelegramUserID = ?', (user_id,)).fetchone()[0].split())
+
+
+def legacy_sweep(conn):
+    return {fingerprint for _, node_list in conn.execute('SELECT * FROM TorWatchdog') for fingerprint in node_list.split()}
+
+
+def normalized_add(conn, user_id, fingerprint):
+    database.add_subscriptions(conn, user_id, [fingerprint])
+    conn.commit()
+
+
+def normalized_remove(conn, user_id, fingerprint):
+    database.remove_subscriptions(conn, user_id, [fingerprint])
+    conn.commit()
+
+
+def onboarding(conn, rng, rounds=20):
+    """
+    Returns the milliseconds to add then remove `BATCH` relays, one transaction per relay and as one batch.
+    """
+    single = batch = 0.0
+    for user_id in range(USERS, USERS + rounds):
+        relays = [make_fingerprint(rng) for _ in range(BATCH)]
+
+        start = time.perf_counter()
+        for fingerprint in relays:
+            normalized_add(conn, user_id, fingerprint)
+        for fingerprint in relays:
+            normalized_remove(conn, user_id, fingerprint)
+        single += time.perf_counter() - start
+
+        start = time.perf_counter()
+        with conn:
+            database.add_subscriptions(conn, user_id, relays)
+        with conn:
+            database.remove_subscriptions(conn, user_id, relays)
+        batch += time.perf_counter() - start
+
+    return single / rounds * 1000, batch / rounds * 1000
+
+
+def timed(function, calls):
+    start = time.perf_counter()
+    for args in calls:
+        function(*args)
+    return (time.perf_counter() - start) / len(calls) * 1e6
+
+
+def main(size):
+    rng = random.Random(0)
+    fingerprints = [make_fingerprint(rng) for _ in range(size // 5)]
+    users = {user_id: [] for user_id in range(USERS)}
+    for i in range(size):
+        users[i % USERS].append(fingerprints[i % len(fingerprints)])
+
+    changes = [(rng.randrange(USERS), make_fingerprint(rng)) for _ in range(OPERATIONS)]
+    lists = [(conn_user,) for conn_user in rng.sample(range(USERS), 100)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        legacy = sqlite3.connect(os.path.join(directory, "legacy.db"))
+        legacy.execute('CREATE TABLE TorWatchdog (TelegramUserID INTEGER PRIMARY KEY, NodeList TEXT)')
+        legacy.executemany('INSERT INTO TorWatchdog VALUES (?, ?)', ((u, " ".join(f)) for u, f in users.items()))
+        legacy.commit()
+
+        normalized = sqlite3.connect(os.path.join(directory, "normalized.db"))
+        database.create_schema(normalized)
+        normalized.executemany("INSERT INTO TorWatchdog VALUES (?, '')", ((u,) for u in users))
+        normalized.executemany('INSERT OR IGNORE INTO subscriptions VALUES (?, ?)', ((u, f) for u, fs in users.items() for f in fs))
+        normalized.commit()
+
+        results = {
+            "legacy": (
+                timed(lambda u, f: legacy_add(legacy, u, f), changes),
+                timed(lambda u, f: legacy_remove(legacy, u, f), changes),
+                timed(lambda u: legacy_list(legacy, u), lists),
+                timed(lambda: legacy_sweep(legacy), [()] * 10),
+            ),
+            "normalized": (
+                timed(lambda u, f: normalized_add(normalized, u, f), changes),
+                timed(lambda u, f: normalized_remove(normalized, u, f), changes),
+                timed(lambda u: database.list_subscriptions(normalized, u), lists),
+                timed(lambda: {fingerprint for _, fingerprint in database.subscription_rows(normalized)}, [()] * 10),
+            ),
+        }
+        single, batch = onboarding(normalized, rng)
+        legacy.close()
+        normalized.close()
+
+    print(f"{size} subscriptions, {USERS} users, microseconds per operation")
+    print(f"{'schema':>10} {'add':>9} {'remove':>9} {'list':>9} {'sweep':>11}")
+    for schema, (add, remove, listing, sweep) in results.items():
+        print(f"{schema:>10} {add:>9.1f} {remove:>9.1f} {listing:>9.1f} {sweep:>11.1f}")
+
+    print(f"\nadding then removing {BATCH} relays, milliseconds")
+    print(f"{'per relay':>10} {single:>9.1f}")
+    print(f"{'batch':>10} {batch:>9.1f}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
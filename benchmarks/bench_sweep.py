@@ -0,0 +1,68 @@
+"""
+Compares the per-fingerprint sweep with the bulk sweep against a local stub Onionoo server.
+
+Usage:
+    python benchmarks/bench_sweep.py [subscriptions ...]
+"""
+import os
+import random
+import sys
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fixtures import make_index
+from onionoo import RelayCache
+from stub_onionoo import StubOnionoo, make_relays
+from sweep import run_sweep
+
+RELAYS = 8000
+USERS_PER_RELAY = 5
+
+
+def make_rows(relays, subscriptions, seed=1):
+    """
+    Spreads `subscriptions` fingerprints over synthetic users, several users per relay.
+    """
+    rng = random.Random(seed)
+    watched = rng.sample(relays, max(1, subscriptions // USERS_PER_RELAY))
+    users = {}
+
+    for i in range(subscriptions):
+        relay = watched[i % len(watched)]
+        users.setdefault(rng.randrange(subscriptions // 2 + 1), []).append(relay["fingerprint"])
+
+    return [(user_id, fingerprint) for user_id, fingerprints in users.items() for fingerprint in fingerprints]
+
+
+def legacy_sweep(rows, url):
+    # One request per fingerprint of every user, as the original run_thread did
+    for user_id, fingerprint in rows:
+        requests.get(f"{url}?search={fingerprint}").json()
+
+
+def main(sizes):
+    stub = StubOnionoo(make_relays(RELAYS)).start()
+
+    print(f"{'subscriptions':>13} {'mode':>6} {'requests':>9} {'seconds':>9}")
+    for size in sizes:
+        rows = make_rows(stub.relays, size)
+
+        for mode in ("legacy", "bulk"):
+            stub.reset()
+            start = time.perf_counter()
+            if mode == "legacy":
+                legacy_sweep(rows, stub.url)
+            else:
+                conn, index = make_index(rows)
+                run_sweep(conn, lambda user_id, message: None, fetch=RelayCache(base_url=stub.url).lookup_all, index=index)
+            elapsed = time.perf_counter() - start
+            print(f"{size:>13} {mode:>6} {stub.requests:>9} {elapsed:>9.3f}")
+
+    stub.stop()
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [10, 100, 1000])
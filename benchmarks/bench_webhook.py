@@ -0,0 +1,168 @@
+"""
+Replays synthetic Telegram updates against the webhook server and reports the throughput and the
+queue latency, from the delivery of an update to the start of its handler, as the worker pool grows.
+A single worker behaves like the polling loop, where one slow "Status Nodes" press delays everyone.
+
+The updates of a chat are delivered one after the other, like Telegram does, and the script checks
+that they are handled in order and that every "[+] Node" prompt, kept in the 'pending_action' table,
+is answered by the fingerprint that follows it.
+Exits with status 1 if any update was handled out of order or any flow was broken.
+
+Usage:
+    python benchmarks/bench_webhook.py [updates] [chats]
+"""
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import telebot
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+from webhook import WebhookServer, UpdateDispatcher
+
+# Share of "Status Nodes" presses and the time each one spends waiting for Onionoo
+SLOW_SHARE = 0.1
+SLOW_SECONDS = 0.02
+# Concurrent connections opened by the replay, Telegram's default for webhooks
+CONNECTIONS = 40
+SECRET = "secret"
+
+
+def make_updates(count, chats, seed=1):
+    """
+    Builds `count` message updates spread over `chats` chats, with some two-step "[+] Node" flows.
+    """
+    rng = random.Random(seed)
+    updates = []
+
+    while len(updates) < count:
+        chat_id = rng.randrange(chats) + 1
+        roll = rng.random()
+        if roll < SLOW_SHARE:
+            texts = ["Status Nodes"]
+        elif roll < SLOW_SHARE + 0.1:
+            texts = ["[+] Node", "%040X" % rng.getrandbits(160)]
+        else:
+            texts = ["List Nodes"]
+
+        for text in texts:
+            update_id = len(updates) + 1
+            updates.append({
+                "update_id": update_id,
+                "message": {
+                    "message_id": update_id,
+                    "date": 0,
+                    "chat": {"id": chat_id, "type": "private"},
+                    "from": {"id": chat_id, "is_bot": False, "first_name": "user"},
+                    "text": text,
+                },
+            })
+
+    return updates
+
+
+def make_bot(handled, lock, path):
+    # The handlers only record the update, sleep for the slow ones and keep the prompts in the database
+    bot = telebot.TeleBot("123456:TEST", threaded=False)
+    local = threading.local()
+
+    @bot.message_handler(func=lambda message: True)
+    def handle(message):
+        if getattr(local, "conn", None) is None:
+            local.conn = database.connect(path)
+        with local.conn as conn:
+            step = database.pop_pending_action(conn, message.chat.id) == "add"
+            if message.text == "[+] Node" and not step:
+                database.set_pending_action(conn, message.chat.id, "add")
+
+        with lock:
+            handled.append((message.chat.id, message.message_id, time.perf_counter(), step))
+        if message.text == "Status Nodes":
+            time.sleep(SLOW_SECONDS)
+
+    return bot
+
+
+def replay(updates, url):
+    """
+    Posts the updates with one sequential connection per group of chats, returning their delivery times.
+    """
+    delivered = {}
+    groups = {}
+    for update in updates:
+        groups.setdefault(update["message"]["chat"]["id"] % CONNECTIONS, []).append(update)
+
+    def post(group):
+        session = requests.Session()
+        for update in group:
+            delivered[update["update_id"]] = time.perf_counter()
+            # A 503 is retried later, like Telegram does
+            while session.post(url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": SECRET}).status_code == 503:
+                time.sleep(0.05)
+
+    with ThreadPoolExecutor(CONNECTIONS) as executor:
+        list(executor.map(post, groups.values()))
+
+    return delivered
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def main(count, chats):
+    updates = make_updates(count, chats)
+    flows = sum(update["message"]["text"] == "[+] Node" for update in updates)
+    failed = False
+
+    print(f"{'workers':>7} {'updates/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8} {'rejected':>9} {'order':>6} {'flows':>11}")
+    for workers in (1, 8, 32):
+        handled = []
+        lock = threading.Lock()
+        path = os.path.join(tempfile.mkdtemp(), "bench.db")
+        with database.connect(path) as conn:
+            database.create_schema(conn)
+        bot = make_bot(handled, lock, path)
+        dispatcher = UpdateDispatcher(lambda update: bot.process_new_updates([update]), workers).start()
+        server = WebhookServer(("127.0.0.1", 0), dispatcher, secret_token=SECRET)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        host, port = server.server_address
+
+        start = time.perf_counter()
+        delivered = replay(updates, f"http://{host}:{port}/telegram")
+        dispatcher.wait_idle()
+        elapsed = time.perf_counter() - start
+
+        server.shutdown()
+        server.server_close()
+        dispatcher.stop()
+
+        # Every chat must see its updates in the order they were delivered
+        last = {}
+        out_of_order = 0
+        for chat_id, message_id, _, _ in handled:
+            if message_id < last.get(chat_id, 0):
+                out_of_order += 1
+            last[chat_id] = message_id
+        steps = sum(step for _, _, _, step in handled)
+        latencies = [(at - delivered[message_id]) * 1000 for _, message_id, at, _ in handled]
+
+        print(f"{workers:>7} {len(handled) / elapsed:>10.0f} {percentile(latencies, 0.5):>8.1f} "
+              f"{percentile(latencies, 0.99):>8.1f} {max(latencies):>8.1f} {dispatcher.rejected:>9} "
+              f"{out_of_order:>6} {steps:>5}/{flows:<5}")
+        failed = failed or out_of_order or steps != flows or len(handled) != len(updates)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(*(args + [5000, 500][len(args):]))
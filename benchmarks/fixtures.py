@@ -0,0 +1,68 @@
+import os
+import resource
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+from relay_index import RelayIndex
+
+
+def make_database(rows, path=":memory:"):
+    """
+    Creates a database holding the given (user_id, fingerprint) subscriptions.
+
+    Args:
+        rows (iterable): The subscriptions to insert.
+        path (str): The path of the database, in memory by default.
+
+    Returns:
+        sqlite3.Connection: The connection to the new database.
+    """
+    conn = database.connect(path)
+    database.create_schema(conn)
+
+    with conn:
+        conn.executemany('INSERT OR IGNORE INTO subscriptions (user_id, fingerprint) VALUES (?, ?)', rows)
+        conn.executemany("INSERT OR IGNORE INTO TorWatchdog (TelegramUserID, NodeList) VALUES (?, '')",
+                         {(user_id,) for user_id, _ in rows})
+
+    return conn
+
+
+def relay_running(relay):
+    """
+    Returns the `running` flag of an Onionoo record, or None if Onionoo does not know the relay.
+    """
+    if relay is None:
+        return None
+    return bool(relay.get("running", False))
+
+
+def make_index(rows):
+    """
+    Creates a database holding the given subscriptions and returns it with its loaded relay index,
+    which keeps the new watchers for the sweeps as the index of a sweeping process does.
+
+    Returns:
+        tuple: The (sqlite3.Connection, RelayIndex) pair.
+    """
+    conn = make_database(rows)
+    index = RelayIndex(track_arrivals=True)
+    index.load(conn)
+    return conn, index
+
+
+def peak_rss_kb():
+    """
+    Returns the peak resident memory of the process in KiB.
+    """
+    # VmHWM is reset by exec, while ru_maxrss keeps the peak of the parent process on Linux
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
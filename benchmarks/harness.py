@@ -0,0 +1,270 @@
+"""
+Benchmark suite of the bot's core logic at growing numbers of subscriptions, against local
+stand-ins of Onionoo and of the Telegram Bot API.
+
+For every scale it generates synthetic users watching five relays each, stores them in a fresh
+database file and reports, as one JSON object per line:
+    - the database size and the time to load the relay index,
+    - the duration of a first sweep, which finds every offline relay, and of a second one,
+    - the duration of a full refresh of the local relay mirror,
+    - the p50 and p99 latency of the add, remove, list and status commands, reply included,
+    - whether a relay added, then removed, by another process is listed, then no longer listed, by "List Nodes",
+    - the peak resident memory of the process.
+Every scale runs in its own process, so its peak memory is not hidden by a larger one, and the
+records carry the current commit, so that runs can be compared across commits.
+
+The commands go through the handlers of main.py, with the bot built by `main.create_bot` against
+the stub Bot API, and the "Status Nodes" latency lasts until its reply has left the notification
+queue. The command latencies are therefore not comparable with the records of the commits whose
+harness replayed the core calls without a bot.
+
+Usage:
+    python benchmarks/harness.py [--scales 1000,10000,100000,1000000] [--commands 50] [--output results.jsonl]
+"""
+import argparse
+import asyncio
+import configparser
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from telebot import apihelper, types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+import main as bot_main
+from async_sweep import AsyncSweeper
+from fixtures import peak_rss_kb
+from mirror import relay_mirror
+from onionoo import RelayCache
+from relay_index import relay_index
+from stub_onionoo import StubOnionoo, make_relays
+from stub_telegram import StubTelegram
+
+SCALES = (1000, 10000, 100000, 1000000)
+RELAYS = 8000
+RELAYS_PER_USER = 5
+COMMANDS = 50
+FIRST_USER = 10 ** 8
+
+
+def make_rows(relays, subscriptions, seed=1):
+    """
+    Yields (user_id, fingerprint) subscriptions, each user watching `RELAYS_PER_USER` distinct relays.
+    """
+    rng = random.Random(seed)
+    fingerprints = [relay["fingerprint"] for relay in relays]
+
+    for user in range(-(-subscriptions // RELAYS_PER_USER)):
+        for fingerprint in rng.sample(fingerprints, RELAYS_PER_USER):
+            yield FIRST_USER + user, fingerprint
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    pick = lambda fraction: samples[min(len(samples) - 1, int(len(samples) * fraction))] * 1000
+    return {"p50_ms": round(pick(0.5), 3), "p99_ms": round(pick(0.99), 3)}
+
+
+def timed(function):
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def make_message(user_id, text, message_id):
+    """
+    Returns the message a private chat with `user_id` would send, as telebot decodes it from an update.
+    """
+    return types.Message.de_json({
+        "message_id": message_id,
+        "date": 0,
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "user"},
+        "text": text,
+    })
+
+
+def run_commands(relays, users, count, seed=2):
+    """
+    Sends the add, remove, list and status commands of `count` random users to the handlers of main.py.
+    """
+    rng = random.Random(seed)
+    samples = {"add": [], "remove": [], "list": [], "status": []}
+
+    for number in range(count):
+        user_id = rng.randrange(FIRST_USER, FIRST_USER + users)
+        fingerprint = rng.choice(relays)["fingerprint"]
+
+        def status():
+            bot_main.verify_all_nodes_status(make_message(user_id, "Status Nodes", number))
+            bot_main.notifications.wait_idle()
+
+        samples["add"].append(timed(lambda: bot_main.add_node_fingerprint(make_message(user_id, fingerprint, number))))
+        samples["remove"].append(timed(lambda: bot_main.remove_node_fingerprint(make_message(user_id, fingerprint, number))))
+        samples["list"].append(timed(lambda: bot_main.list_nodes(make_message(user_id, "List Nodes", number))))
+        samples["status"].append(timed(status))
+
+    return {command: percentiles(values) for command, values in samples.items()}
+
+
+def subscribe_elsewhere(path, user_id, fingerprint, add):
+    """
+    Registers a user and adds or removes one of their relays, as a second bot process sharing the database would.
+    """
+    database.init_database(path)
+    conn = database.get_connection()
+    with conn:
+        database.register_user(conn, user_id)
+        if add:
+            database.add_subscriptions(conn, user_id, [fingerprint])
+        else:
+            database.remove_subscriptions(conn, user_id, [fingerprint])
+    database.close_connection()
+
+
+def check_processes(path, telegram, fingerprint):
+    """
+    Adds then removes a relay of a new user from another process, and returns whether the "List Nodes" reply
+    of this one follows, with the latency of the command that picks the changes up.
+    """
+    user_id = FIRST_USER - 1
+    record = {}
+
+    for step, add in (("added", True), ("removed", False)):
+        subprocess.run([sys.executable, __file__, "--subscribe", path, str(user_id), fingerprint, str(int(add))], check=True)
+        sent = len(telegram.messages)
+        elapsed = timed(lambda: bot_main.list_nodes(make_message(user_id, "List Nodes", 0)))
+        listed = any(fingerprint in text for _, chat_id, text in telegram.messages[sent:] if chat_id == user_id)
+        record[f"{step}_listed"] = listed
+        record[f"{step}_list_ms"] = round(elapsed * 1000, 3)
+
+    record["ok"] = record["added_listed"] and not record["removed_listed"]
+    return record
+
+
+def run_scale(scale, commands):
+    """
+    Measures one scale in the current process and returns its record.
+    """
+    onionoo = StubOnionoo(make_relays(RELAYS)).start()
+    telegram = StubTelegram(enforce_limits=False).start()
+    apihelper.API_URL = telegram.api_url
+    record = {"scale": scale}
+
+    # The bot of main.py, answering through the stub Bot API, with the mirror of the stub Onionoo
+    config = configparser.ConfigParser()
+    config.read_dict({"telegram": {"token": "123456:TEST"}})
+    bot_main.configure(config)
+    bot_main.create_bot(config)
+    relay_mirror.configure(base_url=onionoo.url)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.db")
+        database.init_database(path)
+        conn = database.get_connection()
+
+        rows = list(make_rows(onionoo.relays, scale))
+        users = len({user_id for user_id, _ in rows})
+        with conn:
+            conn.executemany("INSERT INTO TorWatchdog (TelegramUserID, NodeList) VALUES (?, '')",
+                             ((FIRST_USER + user,) for user in range(users)))
+            conn.executemany('INSERT OR IGNORE INTO subscriptions (user_id, fingerprint) VALUES (?, ?)', rows)
+            # The sweeps keep a day of changes, the bulk load is not one of them
+            database.prune_subscription_log(conn, time.time() + 1)
+        del rows
+
+        record["users"] = users
+        record["index_load_seconds"] = round(timed(lambda: relay_index.load(conn)), 4)
+        record["fingerprints"] = len(relay_index.fingerprints())
+
+        # The first sweep finds every offline relay, the second one only revalidates
+        cache = RelayCache(base_url=onionoo.url)
+        alerts = []
+
+        async def sweep():
+            async with AsyncSweeper(base_url=onionoo.url, cache=cache, index=relay_index) as sweeper:
+                await sweeper.run(conn, lambda user_id, message: alerts.append(user_id))
+
+        record["sweep_cold_seconds"] = round(timed(lambda: asyncio.run(sweep())), 4)
+        record["alerts"] = len(alerts)
+        cache.clear()
+        record["sweep_warm_seconds"] = round(timed(lambda: asyncio.run(sweep())), 4)
+
+        # The status command reads the mirror, as the bot does
+        record["mirror_refresh_seconds"] = round(timed(lambda: relay_mirror.refresh(conn)), 4)
+
+        record["commands"] = run_commands(onionoo.relays, users, commands)
+        record["processes"] = check_processes(path, telegram, onionoo.relays[0]["fingerprint"])
+
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        record["db_bytes"] = os.path.getsize(path)
+        database.close_connection()
+
+    bot_main.notifications.stop()
+    onionoo.stop()
+    telegram.stop()
+    record["peak_rss_kb"] = peak_rss_kb()
+    return record
+
+
+def describe():
+    """
+    Returns the commit and the environment the results were measured on.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=root,
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit": commit, "python": platform.python_version(), "machine": platform.machine()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--scales", default=",".join(map(str, SCALES)), help="comma-separated subscription counts")
+    parser.add_argument("--commands", type=int, default=COMMANDS, help="samples of every command per scale")
+    parser.add_argument("--output", help="JSON lines file the records are appended to, stdout by default")
+    parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--subscribe", nargs=4, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.subscribe is not None:
+        path, user_id, fingerprint, add = args.subscribe
+        subscribe_elsewhere(path, int(user_id), fingerprint, add == "1")
+        return
+
+    if args.child is not None:
+        print(json.dumps(run_scale(args.child, args.commands)))
+        return
+
+    environment = describe()
+    output = open(args.output, "a") if args.output else sys.stdout
+
+    print(f"{'scale':>8} {'users':>7} {'db MB':>7} {'load s':>7} {'cold s':>7} {'warm s':>7} "
+          f"{'add p50':>8} {'status p50':>10} {'peak MB':>8} {'2 procs':>7}", file=sys.stderr)
+    for scale in (int(value) for value in args.scales.split(",")):
+        result = subprocess.run([sys.executable, __file__, "--child", str(scale), "--commands", str(args.commands)],
+                                capture_output=True, text=True, check=True)
+        record = {**environment, **json.loads(result.stdout.splitlines()[-1])}
+        print(json.dumps(record), file=output, flush=True)
+
+        commands = record["commands"]
+        print(f"{scale:>8} {record['users']:>7} {record['db_bytes'] / 2 ** 20:>7.1f} {record['index_load_seconds']:>7.2f} "
+              f"{record['sweep_cold_seconds']:>7.2f} {record['sweep_warm_seconds']:>7.2f} "
+              f"{commands['add']['p50_ms']:>8.2f} {commands['status']['p50_ms']:>10.2f} "
+              f"{record['peak_rss_kb'] / 1024:>8.1f} {'ok' if record['processes']['ok'] else 'STALE':>7}", file=sys.stderr)
+
+    if args.output:
+        output.close()
+
+
+if __name__ == "__main__":
+    main()
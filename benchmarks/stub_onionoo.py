@@ -0,0 +1,192 @@
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+def make_fingerprint(rng):
+    """
+    Generates a random upper-case relay fingerprint.
+    """
+    return "".join(rng.choice("0123456789ABCDEF") for _ in range(40))
+
+
+def make_relays(count, seed=0):
+    """
+    Generates `count` synthetic Onionoo relay records.
+
+    Args:
+        count (int): The number of relays to generate.
+        seed (int): The seed of the random generator, so that runs are reproducible.
+
+    Returns:
+        list: The list of relay records, roughly 10% of which are offline.
+    """
+    rng = random.Random(seed)
+    relays = []
+
+    for i in range(count):
+        relay = {
+            "nickname": f"relay{i}",
+            "fingerprint": make_fingerprint(rng),
+            "running": rng.random() >= 0.1,
+            "country_name": "Germany",
+            "bandwidth_rate": rng.randint(1, 100) * 1024 * 1024,
+            "last_restarted": "2024-01-01 00:00:00",
+            "contact": f"operator{i % 50}",
+        }
+        # Derived from the rate rather than drawn, so that the relays of a seed stay the same
+        relay["observed_bandwidth"] = relay["bandwidth_rate"] // 2
+        relay["consensus_weight"] = relay["bandwidth_rate"] // 20480
+        relays.append(relay)
+
+    return relays
+
+
+class StubServer(ThreadingHTTPServer):
+    # The default backlog of 5 drops concurrent connections and skews the timings
+    request_queue_size = 1024
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # A client giving up on a slow answer, as the timeouts under test do, is not an error of the stub
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class StubOnionoo:
+    """
+    A local stand-in for the Onionoo /details endpoint.
+
+    Supports the `search`, `lookup`, `family`, `contact` and `fields` parameters and `If-Modified-Since` revalidation,
+    counts the requests and connections it serves and can add an artificial latency to every response.
+    It can also be made flaky: a `failure_rate` share of the requests is answered with `failure_status`,
+    a `hang_rate` share waits `hang` seconds before answering, and every request fails while `down` is set.
+    """
+
+    def __init__(self, relays, latency=0.0, failure_rate=0.0, failure_status=503, hang_rate=0.0, hang=0.0, seed=0):
+        self.relays = relays
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.hang_rate = hang_rate
+        self.hang = hang
+        self.down = False
+        self.connections = 0
+        self.failures = 0
+        self._random = random.Random(seed)
+        self.last_modified = "Mon, 01 Jan 2024 00:00:00 GMT"
+        self.published = "2024-01-01 00:00:00"
+        self.requests = 0
+        self.not_modified = 0
+        self._lock = threading.Lock()
+        self._by_fingerprint = {relay["fingerprint"]: relay for relay in relays}
+        self._server = StubServer(("127.0.0.1", 0), self._handler())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/details"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.not_modified = 0
+            self.connections = 0
+            self.failures = 0
+
+    def select(self, query):
+        if "lookup" in query:
+            keys = query["lookup"][0].upper().split(",")
+            relays = [self._by_fingerprint[key] for key in keys if key in self._by_fingerprint]
+        elif "family" in query:
+            relay = self._by_fingerprint.get(query["family"][0].upper().lstrip("$"))
+            family = {member.lstrip("$") for member in relay.get("effective_family", ())} if relay else set()
+            relays = [relay] + [self._by_fingerprint[key] for key in sorted(family) if key in self._by_fingerprint
+                                and key != relay["fingerprint"]] if relay else []
+        elif "contact" in query:
+            parts = query["contact"][0].lower().split()
+            relays = [relay for relay in self.relays if all(part in relay.get("contact", "").lower() for part in parts)]
+        elif "search" in query:
+            key = query["search"][0].upper()
+            relays = [self._by_fingerprint[key]] if key in self._by_fingerprint else []
+        else:
+            relays = self.relays
+
+        if "fields" in query:
+            fields = query["fields"][0].split(",")
+            relays = [{field: relay[field] for field in fields if field in relay} for relay in relays]
+
+        return relays
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written separately, Nagle's algorithm would hold the body for a delayed ACK
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                with stub._lock:
+                    stub.connections += 1
+
+            def do_GET(self):
+                with stub._lock:
+                    stub.requests += 1
+                    roll = stub._random.random()
+                if stub.latency:
+                    time.sleep(stub.latency)
+
+                if stub.down or roll < stub.failure_rate:
+                    with stub._lock:
+                        stub.failures += 1
+                    self.send_response(stub.failure_status)
+                    if stub.failure_status == 429:
+                        self.send_header("Retry-After", "0")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                if roll < stub.failure_rate + stub.hang_rate:
+                    time.sleep(stub.hang)
+
+                if self.headers.get("If-Modified-Since") == stub.last_modified:
+                    with stub._lock:
+                        stub.not_modified += 1
+                    self.send_response(304)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+
+                query = parse_qs(urlparse(self.path).query)
+                body = json.dumps({
+                    "version": "8.0",
+                    "relays_published": stub.published,
+                    "relays": stub.select(query),
+                    "bridges": [],
+                }).encode()
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("Last-Modified", stub.last_modified)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,194 @@
+import json
+import sys
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Telegram's limits: messages per second overall and seconds between two messages in the same chat
+GLOBAL_LIMIT = 30
+CHAT_INTERVAL = 1.0
+
+
+class StubServer(ThreadingHTTPServer):
+    # The default backlog of 5 drops concurrent connections and skews the timings
+    request_queue_size = 1024
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # A bot killed in the middle of a long poll, as the startup benchmark does, is not an error of the stub
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class StubTelegram:
+    """
+    A local stand-in for the Telegram Bot API `sendMessage` method.
+
+    Every message is recorded with its arrival time. A message exceeding Telegram's limits is
+    counted as a violation and refused with a 429, like Telegram would do, unless `enforce_limits`
+    is False. Every `flood_every` requests a 429 with `retry_after` is also returned on purpose,
+    to exercise the retries.
+    Updates queued with `push_update` are answered to `getUpdates`, which otherwise waits up to
+    `poll_wait` seconds like a long poll, and the time of the first poll is recorded in `first_poll`.
+    """
+
+    def __init__(self, flood_every=0, retry_after=1, latency=0.0, enforce_limits=True, poll_wait=0.5):
+        self.flood_every = flood_every
+        self.enforce_limits = enforce_limits
+        self.retry_after = retry_after
+        self.latency = latency
+        self.requests = 0
+        self.floods = 0
+        self.violations = []
+        self.messages = []
+        self.poll_wait = poll_wait
+        self.first_poll = None
+        self._updates = []
+        self._window = deque()
+        self._last_by_chat = {}
+        self._lock = threading.Lock()
+        self._server = StubServer(("127.0.0.1", 0), self._handler())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def api_url(self):
+        """
+        The URL template to assign to `telebot.apihelper.API_URL`.
+        """
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/bot{{0}}/{{1}}"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def send_message(self, chat_id, text):
+        """
+        Records a message, returning the Bot API answer as a dictionary.
+        """
+        now = time.monotonic()
+
+        with self._lock:
+            self.requests += 1
+            if self.flood_every and self.requests % self.flood_every == 0:
+                self.floods += 1
+                return self._too_many_requests()
+
+            while self._window and self._window[0] <= now - 1.0:
+                self._window.popleft()
+            last = self._last_by_chat.get(chat_id)
+
+            if self.enforce_limits:
+                if len(self._window) >= GLOBAL_LIMIT:
+                    self.violations.append(("global", chat_id, now))
+                    return self._too_many_requests()
+                if last is not None and now - last < CHAT_INTERVAL:
+                    self.violations.append(("chat", chat_id, now))
+                    return self._too_many_requests()
+
+            self._window.append(now)
+            self._last_by_chat[chat_id] = now
+            self.messages.append((now, chat_id, text))
+            message_id = len(self.messages)
+
+        return {
+            "ok": True,
+            "result": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": text,
+            },
+        }
+
+    def push_update(self, chat_id, text):
+        """
+        Queues a text message from a user, answered to the next `getUpdates`.
+        """
+        with self._lock:
+            update_id = len(self._updates) + 1
+            self._updates.append({
+                "update_id": update_id,
+                "message": {
+                    "message_id": update_id,
+                    "date": int(time.time()),
+                    "from": {"id": chat_id, "is_bot": False, "first_name": "user"},
+                    "chat": {"id": chat_id, "type": "private"},
+                    "text": text,
+                    "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}] if text.startswith("/") else [],
+                },
+            })
+
+    def get_updates(self, offset):
+        """
+        Returns the queued updates from `offset` on, waiting up to `poll_wait` seconds when there are none.
+        """
+        with self._lock:
+            if self.first_poll is None:
+                self.first_poll = time.monotonic()
+        deadline = time.monotonic() + self.poll_wait
+        while True:
+            with self._lock:
+                updates = [update for update in self._updates if update["update_id"] >= offset]
+            if updates or time.monotonic() >= deadline:
+                return {"ok": True, "result": updates}
+            time.sleep(0.01)
+
+    def _too_many_requests(self):
+        return {
+            "ok": False,
+            "error_code": 429,
+            "description": f"Too Many Requests: retry after {self.retry_after}",
+            "parameters": {"retry_after": self.retry_after},
+        }
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written separately, Nagle's algorithm would hold the body for a delayed ACK
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                self.do_POST()
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length).decode() if length else ""
+                params = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+                if body.startswith("{"):
+                    params.update(json.loads(body))
+                else:
+                    params.update({key: values[0] for key, values in parse_qs(body).items()})
+
+                if stub.latency:
+                    time.sleep(stub.latency)
+
+                method = self.path.split("?")[0].rsplit("/", 1)[-1]
+                if method == "sendMessage":
+                    answer = stub.send_message(int(params["chat_id"]), params.get("text", ""))
+                elif method == "getUpdates":
+                    answer = stub.get_updates(int(params.get("offset") or 0))
+                elif method == "getMe":
+                    answer = {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "stub", "username": "stub_bot"}}
+                else:
+                    answer = {"ok": True, "result": True}
+
+                payload = json.dumps(answer).encode()
+                self.send_response(200 if answer["ok"] else answer["error_code"])
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
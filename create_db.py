@@ -1,14 +1,11 @@
-import sqlite3
+from database import connect, create_schema
 
 def create_database():
     # Connessione al database (crea il database se non esiste)
-    conn = sqlite3.connect('tor_watchdog.db')
-    c = conn.cursor()
+    conn = connect('tor_watchdog.db')
 
-    # Creazione della tabella TorWatchdog
-    c.execute('''CREATE TABLE IF NOT EXISTS TorWatchdog
-                 (TelegramUserID INTEGER PRIMARY KEY,
-                 NodeList TEXT)''')
+    # Creazione delle tabelle TorWatchdog e subscriptions, migrando le vecchie NodeList
+    create_schema(conn)
 
     # Chiusura della connessione
     conn.close()
@@ -0,0 +1,879 @@
+import sqlite3
+import threading
+import time
+
+import metrics
+
+
+DATABASE = 'tor_watchdog.db'
+
+# Connection settings: wait for writers instead of failing, and keep parsed statements cached
+BUSY_TIMEOUT = 5000
+CACHED_STATEMENTS = 256
+
+# Seconds a prompt such as "[+] Node" waits for the user's answer
+PENDING_ACTION_TTL = 600
+
+# Fingerprints per query when reading the relay mirror, below SQLite's limit of bound parameters
+MIRROR_BATCH = 500
+
+HOUR = 3600
+DAY = 24 * HOUR
+# Seconds the raw relay samples are kept, and the resolutions of the uptime rollups with the seconds they are kept
+SAMPLE_RETENTION = 2 * DAY
+ROLLUPS = {HOUR: 2 * DAY, DAY: 90 * DAY}
+OUTAGE_RETENTION = 90 * DAY
+# Seconds the changes of the subscriptions are kept for the processes catching up with them
+SUBSCRIPTION_LOG_RETENTION = DAY
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS TorWatchdog (
+    TelegramUserID INTEGER PRIMARY KEY,
+    NodeList TEXT
+);
+
+CREATE TABLE IF NOT EXISTS subscriptions (
+    user_id INTEGER NOT NULL,
+    fingerprint TEXT NOT NULL,
+    PRIMARY KEY (user_id, fingerprint)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS subscriptions_fingerprint ON subscriptions (fingerprint);
+
+CREATE TABLE IF NOT EXISTS group_subscriptions (
+    user_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (user_id, kind, value)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS group_subscriptions_group ON group_subscriptions (kind, value);
+
+CREATE TABLE IF NOT EXISTS subscription_log (
+    seq INTEGER PRIMARY KEY,
+    change TEXT NOT NULL,
+    user_id INTEGER,
+    kind TEXT,
+    value TEXT,
+    logged INTEGER NOT NULL
+);
+
+CREATE TRIGGER IF NOT EXISTS log_register AFTER INSERT ON TorWatchdog BEGIN
+    INSERT INTO subscription_log (change, user_id, logged) VALUES ('register', NEW.TelegramUserID, strftime('%s', 'now'));
+END;
+
+CREATE TRIGGER IF NOT EXISTS log_add AFTER INSERT ON subscriptions BEGIN
+    INSERT INTO subscription_log (change, user_id, value, logged) VALUES ('add', NEW.user_id, NEW.fingerprint, strftime('%s', 'now'));
+END;
+
+CREATE TRIGGER IF NOT EXISTS log_remove AFTER DELETE ON subscriptions BEGIN
+    INSERT INTO subscription_log (change, user_id, value, logged) VALUES ('remove', OLD.user_id, OLD.fingerprint, strftime('%s', 'now'));
+END;
+
+CREATE TRIGGER IF NOT EXISTS log_add_group AFTER INSERT ON group_subscriptions BEGIN
+    INSERT INTO subscription_log (change, user_id, kind, value, logged)
+    VALUES ('add_group', NEW.user_id, NEW.kind, NEW.value, strftime('%s', 'now'));
+END;
+
+CREATE TRIGGER IF NOT EXISTS log_remove_group AFTER DELETE ON group_subscriptions BEGIN
+    INSERT INTO subscription_log (change, user_id, kind, value, logged)
+    VALUES ('remove_group', OLD.user_id, OLD.kind, OLD.value, strftime('%s', 'now'));
+END;
+
+CREATE TABLE IF NOT EXISTS relay_groups (
+    kind TEXT NOT NULL,
+    value TEXT NOT NULL,
+    members TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (kind, value)
+) WITHOUT ROWID;
+
+CREATE TRIGGER IF NOT EXISTS log_members_added AFTER INSERT ON relay_groups BEGIN
+    INSERT INTO subscription_log (change, kind, value, logged) VALUES ('members', NEW.kind, NEW.value, strftime('%s', 'now'));
+END;
+
+CREATE TRIGGER IF NOT EXISTS log_members_changed AFTER UPDATE OF members ON relay_groups BEGIN
+    INSERT INTO subscription_log (change, kind, value, logged) VALUES ('members', NEW.kind, NEW.value, strftime('%s', 'now'));
+END;
+
+CREATE TABLE IF NOT EXISTS relay_state (
+    fingerprint TEXT PRIMARY KEY,
+    running INTEGER,
+    last_seen TEXT,
+    last_restarted TEXT,
+    consensus TEXT
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS pending_action (
+    chat_id INTEGER PRIMARY KEY,
+    action TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS pending_action_expires ON pending_action (expires);
+
+CREATE TABLE IF NOT EXISTS shard_lease (
+    shard INTEGER PRIMARY KEY,
+    owner TEXT,
+    expires REAL NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS watchdog_worker (
+    owner TEXT PRIMARY KEY,
+    expires REAL NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY,
+    chat_id INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    queued REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS outbox_sender (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    owner TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS relay_mirror (
+    fingerprint TEXT PRIMARY KEY,
+    record TEXT NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS mirror_meta (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    relays_published TEXT,
+    last_modified TEXT,
+    fetched_at REAL NOT NULL,
+    source TEXT NOT NULL,
+    relays INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS relay_samples (
+    fingerprint TEXT NOT NULL,
+    observed INTEGER NOT NULL,
+    running INTEGER NOT NULL,
+    bandwidth INTEGER,
+    consensus_weight INTEGER,
+    PRIMARY KEY (fingerprint, observed)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS relay_rollups (
+    fingerprint TEXT NOT NULL,
+    resolution INTEGER NOT NULL,
+    start INTEGER NOT NULL,
+    observations INTEGER NOT NULL,
+    running INTEGER NOT NULL,
+    bandwidth INTEGER NOT NULL,
+    consensus_weight INTEGER NOT NULL,
+    last_observed INTEGER NOT NULL,
+    PRIMARY KEY (fingerprint, resolution, start)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS relay_outages (
+    fingerprint TEXT NOT NULL,
+    started INTEGER NOT NULL,
+    ended INTEGER,
+    PRIMARY KEY (fingerprint, started)
+) WITHOUT ROWID;
+'''
+
+
+def create_schema(conn):
+    """
+    Creates the tables of the bot and migrates the legacy node lists.
+
+    Args:
+        conn (sqlite3.Connection): The connection to the database.
+
+    Returns:
+        None
+
+    Raises:
+        sqlite3.Error: If the schema cannot be created.
+
+    Note:
+        The 'TorWatchdog' table keeps the registered users, while their relays are stored one per row
+        in the 'subscriptions' table. The fingerprint index makes "which users watch relay X" a lookup.
+        A user watching a whole family or operator has a single row in 'group_subscriptions', and the
+        members of every group, found by the sweeps, are kept once in 'relay_groups'.
+        Triggers append every registration and every change of the subscriptions and of the group members
+        to 'subscription_log', whatever process makes it, so that the others bring their relay index up to date
+        by replaying them.
+        The 'relay_state' table keeps the last known state of every watched relay between sweeps,
+        with a NULL `running` for relays Onionoo has no information about, and the consensus it last changed in.
+        The 'pending_action' table keeps the step each chat has been prompted for, with its expiry time.
+        The 'shard_lease' and 'watchdog_worker' tables coordinate the standalone watchdog processes,
+        whose alerts wait in 'outbox' until the bot process holding the single lease of 'outbox_sender' sends them.
+        The 'relay_mirror' table keeps a local copy of Onionoo's relay records as JSON, and the single row
+        of 'mirror_meta' tells where and when it was last refreshed.
+        The history of the watched relays is kept in 'relay_samples', one row per change of a relay,
+        summed per hour and per day in 'relay_rollups', with the periods they were down in 'relay_outages'.
+    """
+    conn.executescript(SCHEMA)
+    migrate_node_lists(conn)
+    migrate_rollups(conn)
+
+
+@metrics.instrumented("sqlite")
+def migrate_node_lists(conn):
+    """
+    Moves the space-separated fingerprints of the legacy NodeList column into 'subscriptions'.
+
+    Args:
+        conn (sqlite3.Connection): The connection to the database.
+
+    Returns:
+        int: The number of users whose node list has been migrated.
+
+    Raises:
+        sqlite3.Error: If the migration fails, in which case nothing is changed.
+
+    Note:
+        The migration is idempotent: duplicates are ignored and every migrated NodeList is emptied
+        in the same transaction, so running it again does nothing.
+    """
+    with conn:
+        rows = conn.execute("SELECT TelegramUserID, NodeList FROM TorWatchdog WHERE NodeList <> ''").fetchall()
+
+        conn.executemany(
+            'INSERT OR IGNORE INTO subscriptions (user_id, fingerprint) VALUES (?, ?)',
+            ((user_id, fingerprint.upper()) for user_id, node_list in rows for fingerprint in node_list.split())
+        )
+        conn.executemany("UPDATE TorWatchdog SET NodeList = '' WHERE TelegramUserID = ?", ((user_id,) for user_id, _ in rows))
+
+    return len(rows)
+
+
+@metrics.instrumented("sqlite")
+def migrate_rollups(conn):
+    """
+    Adds the `last_observed` column to a 'relay_rollups' table created without it.
+
+    Args:
+        conn (sqlite3.Connection): The connection to the database.
+
+    Returns:
+        bool: Whether the column has been added.
+
+    Raises:
+        sqlite3.Error: If the migration fails, in which case nothing is changed.
+
+    Note:
+        The last observation of an existing rollup is unknown, so it is taken as the start of its period:
+        every later observation is still added, at worst a consensus recorded again after the upgrade
+        counts twice.
+    """
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(relay_rollups)')]
+    if 'last_observed' in columns:
+        return False
+
+    with conn:
+        conn.execute('ALTER TABLE relay_rollups ADD COLUMN last_observed INTEGER NOT NULL DEFAULT 0')
+        conn.execute('UPDATE relay_rollups SET last_observed = start')
+
+    return True
+
+
+@metrics.instrumented("sqlite")
+def register_user(conn, user_id):
+    """
+    Registers the user, returning False if they were already registered.
+    """
+    cursor = conn.execute("INSERT OR IGNORE INTO TorWatchdog (TelegramUserID, NodeList) VALUES (?, '')", (user_id,))
+    return cursor.rowcount > 0
+
+
+@metrics.instrumented("sqlite")
+def add_subscriptions(conn, user_id, fingerprints):
+    """
+    Adds several relays to the user's list in one batch.
+
+    Args:
+        conn (sqlite3.Connection): The connection to the database.
+        user_id (int): The ID of the user.
+        fingerprints (list): The distinct upper-case fingerprints to add.
+
+    Returns:
+        list: The fingerprints that have been added, the others were already in the list.
+
+    Raises:
+        sqlite3.Error: If the subscriptions cannot be stored.
+    """
+    watched = set(list_subscriptions(conn, user_id))
+    added = [fingerprint for fingerprint in fingerprints if fingerprint not in watched]
+    conn.executemany('INSERT OR IGNORE INTO subscriptions (user_id, fingerprint) VALUES (?, ?)',
+                     ((user_id, fingerprint) for fingerprint in added))
+    return added
+
+
+@metrics.instrumented("sqlite")
+def remove_subscriptions(conn, user_id, fingerprints):
+    """
+    Removes several relays from the user's list in one batch.
+
+    Args:
+        conn (sqlite3.Connection): The connection to the database.
+        user_id (int): The ID of the user.
+        fingerprints (list): The distinct upper-case fingerprints to remove.
+
+    Returns:
+        list: The fingerprints that have been removed, the others were not in the list.
+
+    Raises:
+        sqlite3.Error: If the subscriptions cannot be deleted.
+    """
+    watched = set(list_subscriptions(conn, user_id))
+    removed = [fingerprint for fingerprint in fingerprints if fingerprint in watched]
+    conn.executemany('DELETE FROM subscriptions WHERE user_id = ? AND fingerprint = ?',
+                     ((user_id, fingerprint) for fingerprint in removed))
+    return removed
+
+
+@metrics.instrumented("sqlite")
+def list_subscriptions(conn, user_id):
+    """
+    Returns the sorted fingerprints of the relays watched by the user.
+    """
+    rows = conn.execute('SELECT fingerprint FROM subscriptions WHERE user_id = ? ORDER BY fingerprint', (user_id,))
+    return [fingerprint for fingerprint, in rows]
+
+
+@metrics.instrumented("sqlite")
+def subscription_rows(conn):
+    """
+    Returns every (user_id, fingerprint) subscription, grouped by fingerprint.
+    """
+    return conn.execute('SELECT user_id, fingerprint FROM subscriptions ORDER BY fingerprint').fetchall()
+
+
+@metrics.instrumented("sqlite")
+def subscription_version(conn):
+    """
+    Returns the sequence number of the last change in 'subscription_log', 0 before the first one.
+    """
+    return conn.execute('SELECT MAX(seq) FROM subscription_log').fetchone()[0] or 0
+
+
+@metrics.instrumented("sqlite")
+def subscription_changes(conn, after):
+    """
+    Returns the (seq, change, user_id, kind, value) changes logged after the sequence number `after`, in order.
+    """
+    return conn.execute('SELECT seq, change, user_id, kind, value FROM subscription_log WHERE seq > ? ORDER BY seq',
+                        (after,)).fetchall()
+
+
+@metrics.instrumented("sqlite")
+def prune_subscription_log(conn, before):
+    """
+    Deletes the changes logged before the POSIX time `before`, returning how many have been deleted.
+
+    Note:
+        The last change is always kept, so that the sequence numbers never go back and a process
+        whose last applied change has been deleted can tell that it has to reload.
+    """
+    cursor = conn.execute('''DELETE FROM subscription_log WHERE logged < ?
+                             AND seq < (SELECT MAX(seq) FROM subscription_log)''', (before,))
+    return cursor.rowcount
+
+
+@metrics.instrumented("sqlite")
+def add_group_subscription(conn, user_id, kind, value):
+    """
+    Adds a family or contact group to the user's list, returning False if it was already there.
+    """
+    cursor = conn.execute('INSERT OR IGNORE INTO group_subscriptions (user_id, kind, value) VALUES (?, ?, ?)', (user_id, kind, value))
+    return cursor.rowcount > 0
+
+
+@metrics.instrumented("sqlite")
+def remove_group_subscription(conn, user_id, kind, value):
+    """
+    Removes a family or contact group from the user's list, returning False if it was not there.
+
+    Note:
+        The members of the group are forgotten with its last subscriber.
+    """
+    cursor = conn.execute('DELETE FROM group_subscriptions WHERE user_id = ? AND kind = ? AND value = ?', (user_id, kind, value))
+    conn.execute('''DELETE FROM relay_groups WHERE kind = ? AND value = ?
+                    AND NOT EXISTS (SELECT 1 FROM group_subscriptions WHERE kind = ? AND value = ?)''', (kind, value, kind, value))
+    return cursor.rowcount > 0
+
+
+@metrics.instrumented("sqlite")
+def group_subscription_rows(conn):
+    """
+    Returns every (user_id, kind, value) group subscription.
+    """
+    return conn.execute('SELECT user_id, kind, value FROM group_subscriptions').fetchall()
+
+
+@metrics.instrumented("sqlite")
+def relay_groups(conn):
+    """
+    Returns the last known members of every group, as lists of fingerprints keyed by (kind, value).
+    """
+    return {(kind, value): members.split() for kind, value, members in conn.execute('SELECT kind, value, members FROM relay_groups')}
+
+
+@metrics.instrumented("sqlite")
+def relay_group(conn, kind, value):
+    """
+    Returns the last known members of a group as a list of fingerprints, or None if they are unknown.
+    """
+    row = conn.execute('SELECT members FROM relay_groups WHERE kind = ? AND value = ?', (kind, value)).fetchone()
+    return None if row is None else row[0].split()
+
+
+@metrics.instrumented("sqlite")
+def save_relay_group(conn, kind, value, members):
+    """
+    Stores the members of a group, returning False if they have not changed.
+    """
+    cursor = conn.execute('''INSERT INTO relay_groups (kind, value, members, updated) VALUES (?, ?, ?, ?)
+                             ON CONFLICT (kind, value) DO UPDATE SET members = excluded.members, updated = excluded.updated
+                             WHERE members <> excluded.members''', (kind, value, " ".join(sorted(members)), time.time()))
+    return cursor.rowcount > 0
+
+
+@metrics.instrumented("sqlite")
+def set_pending_action(conn, chat_id, action, ttl=PENDING_ACTION_TTL):
+    """
+    Records the action the chat's next message answers, replacing any previous one.
+
+    Args:
+        conn (sqlite3.Connection): The connection to the database.
+        chat_id (int): The ID of the chat that has been prompted.
+        action (str): The name of the pending action, such as 'add' or 'remove'.
+        ttl (float): The number of seconds after which the prompt is abandoned.
+
+    Returns:
+        None
+
+    Raises:
+        sqlite3.Error: If the action cannot be stored.
+
+    Note:
+        The expired actions are deleted at the same time, so abandoned prompts do not accumulate.
+    """
+    now = time.time()
+    conn.execute('DELETE FROM pending_action WHERE expires <= ?', (now,))
+    conn.execute('INSERT OR REPLACE INTO pending_action (chat_id, action, expires) VALUES (?, ?, ?)',
+                 (chat_id, action, now + ttl))
+
+
+@metrics.instrumented("sqlite")
+def pop_pending_action(conn, chat_id):
+    """
+    Removes and returns the pending action of the chat, or None if it has none or it has expired.
+
+    Note:
+        The action is deleted and read in one statement, so when several bot processes share the database
+        only one of them handles the answer.
+    """
+    # Most messages answer no prompt, checking first spares them a write transaction
+    if conn.execute('SELECT 1 FROM pending_action WHERE chat_id = ?', (chat_id,)).fetchone() is None:
+        return None
+
+    row = conn.execute('DELETE FROM pending_action WHERE chat_id = ? RETURNING action, expires', (chat_id,)).fetchone()
+    if row is None or row[1] <= time.time():
+        return None
+    return row[0]
+
+
+@metrics.instrumented("sqlite")
+def heartbeat_worker(conn, owner, ttl):
+    """
+    Marks a watchdog worker as alive for `ttl` seconds and returns the number of live workers.
+    """
+    now = time.time()
+    conn.execute('DELETE FROM watchdog_worker WHERE expires <= ?', (now,))
+    conn.execute('INSERT OR REPLACE INTO watchdog_worker (owner, expires) VALUES (?, ?)', (owner, now + ttl))
+    return conn.execute('SELECT COUNT(*) FROM watchdog_worker').fetchone()[0]
+
+
+@metrics.instrumented("sqlite")
+def renew_shards(conn, owner, ttl):
+    """
+    Extends the unexpired leases of a worker by `ttl` seconds and returns its sorted shards.
+
+    Note:
+        An expired lease is not renewed, since another worker may have claimed the shard in the meantime.
+    """
+    now = time.time()
+    rows = conn.execute('UPDATE shard_lease SET expires = ? WHERE owner = ? AND expires > ? RETURNING shard',
+                        (now + ttl, owner, now))
+    return sorted(shard for shard, in rows)
+
+
+@metrics.instrumented("sqlite")
+def claim_shards(conn, owner, count, ttl, shards):
+    """
+    Leases up to `count` free or expired shards to a worker for `ttl` seconds.
+
+    Args:
+        conn (sqlite3.Connection): The connection to the database.
+        owner (str): The identifier of the worker.
+        count (int): The maximum number of shards to claim.
+        ttl (float): The duration of the leases in seconds.
+        shards (int): The total number of shards, whose rows are created on first use.
+
+    Returns:
+        list: The claimed shards.
+
+    Raises:
+        sqlite3.Error: If the leases cannot be written.
+
+    Note:
+        The shards are picked and leased by a single statement, so two workers never claim the same one.
+    """
+    now = time.time()
+    conn.executemany('INSERT OR IGNORE INTO shard_lease (shard) VALUES (?)', ((shard,) for shard in range(shards)))
+    rows = conn.execute('''UPDATE shard_lease SET owner = ?, expires = ?
+                           WHERE shard IN (SELECT shard FROM shard_lease
+                                           WHERE shard < ? AND (owner IS NULL OR expires <= ?)
+                                           ORDER BY shard LIMIT ?)
+                           RETURNING shard''', (owner, now + ttl, shards, now, count))
+    return [shard for shard, in rows]
+
+
+@metrics.instrumented("sqlite")
+def release_shards(conn, owner, shards=None):
+    """
+    Gives up some shards of a worker, all of them by default, so that other workers can claim them at once.
+    """
+    if shards is None:
+        conn.execute('UPDATE shard_lease SET owner = NULL, expires = 0 WHERE owner = ?', (owner,))
+        conn.execute('DELETE FROM watchdog_worker WHERE owner = ?', (owner,))
+    else:
+        conn.executemany('UPDATE shard_lease SET owner = NULL, expires = 0 WHERE owner = ? AND shard = ?',
+                         ((owner, shard) for shard in shards))
+
+
+@metrics.instrumented("sqlite")
+def queue_messages(conn, messages):
+    """
+    Appends (chat_id, text) messages to the outbox, for the bot to send.
+    """
+    now = time.time()
+    conn.executemany('INSERT INTO outbox (chat_id, text, queued) VALUES (?, ?, ?)',
+                     ((chat_id, text, now) for chat_id, text in messages))
+
+
+@metrics.instrumented("sqlite")
+def claim_outbox(conn, owner, ttl, settled):
+    """
+    Takes the queued messages of the chats that got none after `settled`, if `owner` is or becomes the sender.
+
+    Args:
+        conn (sqlite3.Connection): The connection to the database.
+        owner (str): The identifier of the bot process.
+        ttl (float): The duration of the sender lease in seconds.
+        settled (float): The time after which a chat's messages are left for a later claim.
+
+    Returns:
+        list: The (chat_id, text) messages in the order they were queued, empty if another process is the sender.
+
+    Note:
+        Most claims find the outbox empty, and checking it first spares them a write.
+        A single process holds the sender lease while it keeps claiming, so all the messages go through its rate limits,
+        and another process takes over once the lease has expired.
+        The messages are deleted as they are claimed: those of a sender that dies before sending them are lost.
+    """
+    if conn.execute('SELECT 1 FROM outbox LIMIT 1').fetchone() is None:
+        return []
+    now = time.time()
+    sender = conn.execute('''INSERT INTO outbox_sender (id, owner, expires) VALUES (0, ?, ?)
+                             ON CONFLICT (id) DO UPDATE SET owner = excluded.owner, expires = excluded.expires
+                             WHERE owner = excluded.owner OR expires <= ?
+                             RETURNING owner''', (owner, now + ttl, now)).fetchone()
+    if sender is None:
+        return []
+    rows = conn.execute('''DELETE FROM outbox
+                           WHERE chat_id IN (SELECT chat_id FROM outbox GROUP BY chat_id HAVING MAX(queued) <= ?)
+                           RETURNING id, chat_id, text''', (settled,)).fetchall()
+    return [(chat_id, text) for _, chat_id, text in sorted(rows)]
+
+
+@metrics.instrumented("sqlite")
+def save_relay_states(conn, states):
+    """
+    Inserts or updates relay states.
+
+    Args:
+        conn (sqlite3.Connection): The connection to the database.
+        states (iterable): The (fingerprint, running, last_seen, last_restarted, consensus) tuples to store.
+            A None `last_seen` keeps the one already stored.
+
+    Returns:
+        None
+
+    Raises:
+        sqlite3.Error: If the states cannot be stored.
+    """
+    conn.executemany('''INSERT INTO relay_state (fingerprint, running, last_seen, last_restarted, consensus)
+                          VALUES (?, ?, ?, ?, ?)
+                          ON CONFLICT (fingerprint) DO UPDATE SET
+                              running = excluded.running,
+                              last_seen = COALESCE(excluded.last_seen, last_seen),
+                              last_restarted = excluded.last_restarted,
+                              consensus = excluded.consensus''', states)
+
+
+@metrics.instrumented("sqlite")
+def mirror_meta(conn):
+    """
+    Returns the metadata of the relay mirror, or None if it has never been loaded.
+
+    Returns:
+        dict: The `relays_published` timestamp of the data, the `last_modified` header it was served with,
+        the `fetched_at` time of the last refresh, the `source` it was loaded from and the number of `relays`.
+    """
+    row = conn.execute('SELECT relays_published, last_modified, fetched_at, source, relays FROM mirror_meta WHERE id = 0').fetchone()
+    if row is None:
+        return None
+    return dict(zip(("relays_published", "last_modified", "fetched_at", "source", "relays"), row))
+
+
+@metrics.instrumented("sqlite")
+def mirror_records(conn, fingerprints):
+    """
+    Returns the JSON records of the mirrored relays among the upper-case fingerprints, keyed by fingerprint.
+    """
+    records = {}
+    for i in range(0, len(fingerprints), MIRROR_BATCH):
+        batch = fingerprints[i:i + MIRROR_BATCH]
+        placeholders = ",".join("?" * len(batch))
+        records.update(conn.execute(f'SELECT fingerprint, record FROM relay_mirror WHERE fingerprint IN ({placeholders})', batch))
+    return records
+
+
+@metrics.instrumented("sqlite")
+def mirror_contact_fingerprints(conn, parts):
+    """
+    Returns the fingerprints of the mirrored relays whose contact line contains every lower-case part.
+    """
+    where = " AND ".join("instr(lower(json_extract(record, '$.contact')), ?) > 0" for _ in parts)
+    return [fingerprint for fingerprint, in conn.execute(f'SELECT fingerprint FROM relay_mirror WHERE {where}', parts)]
+
+
+@metrics.instrumented("sqlite")
+def save_mirror(conn, records, relays_published, last_modified, source, fetched_at):
+    """
+    Replaces the content of the relay mirror with a new copy of Onionoo's relays.
+
+    Args:
+        conn (sqlite3.Connection): The connection to the database.
+        records (list): The (fingerprint, record) pairs of every relay, with the record as JSON text.
+        relays_published (str): The Onionoo `relays_published` timestamp of the records.
+        last_modified (str): The `Last-Modified` header of the Onionoo response, if any.
+        source (str): The URL or the file the records were read from.
+        fetched_at (float): The time of the refresh, as returned by `time.time()`.
+
+    Returns:
+        tuple: The number of (changed, removed) records.
+
+    Raises:
+        sqlite3.Error: If the records cannot be stored.
+
+    Note:
+        Only the records that differ from the stored ones are written, and the relays missing from the
+        new copy are deleted, so an hourly refresh only rewrites a small part of the table.
+    """
+    changed = conn.executemany('''INSERT INTO relay_mirror (fingerprint, record) VALUES (?, ?)
+                                  ON CONFLICT (fingerprint) DO UPDATE SET record = excluded.record
+                                  WHERE record <> excluded.record''', records).rowcount
+
+    # The fingerprints of the new copy, so that the others are deleted in one statement
+    conn.execute('CREATE TEMP TABLE IF NOT EXISTS mirror_seen (fingerprint TEXT PRIMARY KEY) WITHOUT ROWID')
+    conn.executemany('INSERT OR IGNORE INTO temp.mirror_seen (fingerprint) VALUES (?)', ((fingerprint,) for fingerprint, _ in records))
+    removed = conn.execute('DELETE FROM relay_mirror WHERE fingerprint NOT IN (SELECT fingerprint FROM temp.mirror_seen)').rowcount
+    conn.execute('DELETE FROM temp.mirror_seen')
+
+    conn.execute('''INSERT OR REPLACE INTO mirror_meta (id, relays_published, last_modified, fetched_at, source, relays)
+                    VALUES (0, ?, ?, ?, ?, ?)''', (relays_published, last_modified, fetched_at, source, len(records)))
+    return changed, removed
+
+
+@metrics.instrumented("sqlite")
+def touch_mirror(conn, fetched_at):
+    """
+    Records a refresh of the relay mirror that found no new data.
+    """
+    conn.execute('UPDATE mirror_meta SET fetched_at = ? WHERE id = 0', (fetched_at,))
+
+
+@metrics.instrumented("sqlite")
+def save_observations(conn, observed, observations):
+    """
+    Appends the relays observed by a sweep to their history.
+
+    Args:
+        conn (sqlite3.Connection): The connection to the database.
+        observed (int): The POSIX time of the observations.
+        observations (list): The (fingerprint, running, bandwidth, consensus_weight) tuples of the relays,
+            with `running` as 1 or 0 and None for an unknown bandwidth or weight.
+
+    Returns:
+        int: The number of samples appended to 'relay_samples'.
+
+    Raises:
+        sqlite3.Error: If the history cannot be stored.
+
+    Note:
+        The samples are delta-encoded: a row is only appended when the running flag, bandwidth or weight of
+        a relay differs from its previous sample, which holds until the next one. Every observation is also
+        added to the hourly and daily rollups, which answer the availability queries with a few rows, and
+        opens or closes the outage of the relay. Observations no newer than the last one of a rollup are
+        not added again, so recording a consensus twice, after a restart or by two processes, counts it once.
+        The samples, rollups and outages of the observed relays older than their retention are deleted in
+        the same pass, seeking them through the primary keys, except the last sample of a relay, which still
+        holds its state.
+    """
+    conn.execute('''CREATE TEMP TABLE IF NOT EXISTS observation (
+                        fingerprint TEXT PRIMARY KEY,
+                        running INTEGER NOT NULL,
+                        bandwidth INTEGER,
+                        consensus_weight INTEGER
+                    ) WITHOUT ROWID''')
+    conn.executemany('INSERT OR REPLACE INTO temp.observation VALUES (?, ?, ?, ?)', observations)
+
+    appended = conn.execute('''INSERT OR IGNORE INTO relay_samples (fingerprint, observed, running, bandwidth, consensus_weight)
+                               SELECT o.fingerprint, ?, o.running, o.bandwidth, o.consensus_weight FROM temp.observation AS o
+                               WHERE (SELECT running, bandwidth, consensus_weight FROM relay_samples
+                                      WHERE fingerprint = o.fingerprint ORDER BY observed DESC LIMIT 1)
+                                     IS NOT (o.running, o.bandwidth, o.consensus_weight)''', (observed,)).rowcount
+
+    for resolution in ROLLUPS:
+        conn.execute('''INSERT INTO relay_rollups (fingerprint, resolution, start, observations, running, bandwidth,
+                                                  consensus_weight, last_observed)
+                        SELECT fingerprint, ?, ?, 1, running, COALESCE(bandwidth, 0), COALESCE(consensus_weight, 0), ?
+                        FROM temp.observation WHERE true
+                        ON CONFLICT (fingerprint, resolution, start) DO UPDATE SET
+                            observations = observations + 1,
+                            running = running + excluded.running,
+                            bandwidth = bandwidth + excluded.bandwidth,
+                            consensus_weight = consensus_weight + excluded.consensus_weight,
+                            last_observed = excluded.last_observed
+                        WHERE excluded.last_observed > last_observed''',
+                     (resolution, observed - observed % resolution, observed))
+
+    conn.execute('''INSERT OR IGNORE INTO relay_outages (fingerprint, started)
+                    SELECT fingerprint, ? FROM temp.observation AS o
+                    WHERE running = 0 AND NOT EXISTS (SELECT 1 FROM relay_outages
+                                                      WHERE fingerprint = o.fingerprint AND ended IS NULL)''', (observed,))
+    conn.execute('''UPDATE relay_outages SET ended = ?
+                    WHERE ended IS NULL AND fingerprint IN (SELECT fingerprint FROM temp.observation WHERE running = 1)''',
+                 (observed,))
+
+    # Trimming the history of the observed relays only, so that a sweep never scans the whole tables
+    # The sample in effect at the cutoff holds the state of an unchanged relay, it stays until a newer one expires
+    conn.execute('''DELETE FROM relay_samples WHERE fingerprint IN (SELECT fingerprint FROM temp.observation)
+                    AND observed < ? AND EXISTS (SELECT 1 FROM relay_samples AS newer
+                                                 WHERE newer.fingerprint = relay_samples.fingerprint
+                                                 AND newer.observed > relay_samples.observed AND newer.observed <= ?)''',
+                 (observed - SAMPLE_RETENTION, observed - SAMPLE_RETENTION))
+    for resolution, retention in ROLLUPS.items():
+        conn.execute('''DELETE FROM relay_rollups WHERE fingerprint IN (SELECT fingerprint FROM temp.observation)
+                        AND resolution = ? AND start < ?''', (resolution, observed - retention))
+    conn.execute('''DELETE FROM relay_outages WHERE fingerprint IN (SELECT fingerprint FROM temp.observation)
+                    AND ended < ?''', (observed - OUTAGE_RETENTION,))
+
+    conn.execute('DELETE FROM temp.observation')
+    return appended
+
+
+@metrics.instrumented("sqlite")
+def relay_availability(conn, fingerprint, resolution, since):
+    """
+    Returns the sums of the rollups of a relay at `resolution` starting at or after `since`.
+
+    Returns:
+        tuple: The numbers of observations and of observations while running, and the sums of the bandwidths
+        and consensus weights observed, all 0 if the relay has no history in that period.
+    """
+    return conn.execute('''SELECT COALESCE(SUM(observations), 0), COALESCE(SUM(running), 0),
+                                  COALESCE(SUM(bandwidth), 0), COALESCE(SUM(consensus_weight), 0)
+                           FROM relay_rollups WHERE fingerprint = ? AND resolution = ? AND start >= ?''',
+                        (fingerprint, resolution, since)).fetchone()
+
+
+@metrics.instrumented("sqlite")
+def relay_outages(conn, fingerprint, since, limit):
+    """
+    Returns the (started, ended) POSIX times of the last `limit` outages of a relay that lasted past `since`,
+    most recent first, with a None `ended` for an ongoing outage.
+    """
+    return conn.execute('''SELECT started, ended FROM relay_outages
+                           WHERE fingerprint = ? AND (ended IS NULL OR ended >= ?)
+                           ORDER BY started DESC LIMIT ?''', (fingerprint, since, limit)).fetchall()
+
+
+_local = threading.local()
+
+
+def connect(path=None):
+    """
+    Opens a tuned connection to the database.
+
+    Args:
+        path (str): The path of the database, 'tor_watchdog.db' by default.
+
+    Returns:
+        sqlite3.Connection: The connection, in WAL journaling mode.
+
+    Raises:
+        sqlite3.Error: If the database cannot be opened.
+
+    Note:
+        In WAL mode readers never block on the watchdog's writes and a writer does not block readers.
+        With `synchronous=NORMAL` a commit does not wait for the disk, which WAL keeps safe against corruption.
+    """
+    conn = sqlite3.connect(path or DATABASE, timeout=BUSY_TIMEOUT / 1000, cached_statements=CACHED_STATEMENTS)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT}')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    return conn
+
+
+def get_connection():
+    """
+    Returns the connection of the calling thread, opening it on first use.
+
+    Returns:
+        sqlite3.Connection: A connection that is reused by every later call from the same thread.
+
+    Raises:
+        sqlite3.Error: If the database cannot be opened.
+
+    Note:
+        Using the connection as a context manager commits on success and rolls back on error,
+        without closing it, so its statement cache survives across messages.
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = _local.conn = connect()
+    return conn
+
+
+def close_connection():
+    """
+    Closes the connection of the calling thread, if it has one.
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+
+def init_database(path=DATABASE):
+    """
+    Selects the database at `path`, then creates its schema and migrates it once at startup.
+    """
+    global DATABASE
+    DATABASE = path
+
+    with get_connection() as conn:
+        create_schema(conn)
@@ -0,0 +1,98 @@
+import time
+
+import database
+from database import DAY, HOUR
+from onionoo import parse_published
+
+
+# Periods shown by the "Availability" command, with the resolution of the rollups answering them
+WINDOWS = (
+    ("24 hours", DAY, HOUR),
+    ("7 days", 7 * DAY, DAY),
+    ("30 days", 30 * DAY, DAY),
+)
+# Most recent outages listed
+OUTAGES_SHOWN = 10
+
+
+def observations(relays):
+    """
+    Builds the (fingerprint, running, bandwidth, consensus_weight) rows of the relays fetched by a sweep.
+
+    Args:
+        relays (dict): The Onionoo records of the fetched fingerprints, None for the unknown ones.
+
+    Returns:
+        list: One row per relay, a relay Onionoo does not know being recorded as down.
+
+    Raises:
+        None
+    """
+    rows = []
+    for fingerprint, relay in relays.items():
+        if relay is None:
+            rows.append((fingerprint, 0, None, None))
+        else:
+            rows.append((fingerprint, 1 if relay.get("running") else 0,
+                         relay.get("observed_bandwidth"), relay.get("consensus_weight")))
+    return rows
+
+
+def record_sweep(conn, relays, published=None, now=None):
+    """
+    Appends the relays fetched by a sweep to their uptime history.
+
+    Args:
+        conn (sqlite3.Connection): The connection to the database, in the transaction of the sweep.
+        relays (dict): The Onionoo records of the fetched fingerprints, None for the unknown ones.
+        published (str): The Onionoo `relays_published` timestamp of the fetched data, if known.
+        now (float): The POSIX time used when `published` is unknown, the system clock by default.
+
+    Returns:
+        int: The number of samples appended.
+
+    Raises:
+        sqlite3.Error: If the history cannot be stored.
+
+    Note:
+        The observations are dated by the consensus they come from, so a consensus recorded twice,
+        by two processes or again after a restart, is only counted once.
+    """
+    if not relays:
+        return 0
+    published = parse_published(published)
+    observed = int(published.timestamp() if published is not None else (now if now is not None else time.time()))
+    return database.save_observations(conn, observed, observations(relays))
+
+
+def relay_history(conn, fingerprint, now=None):
+    """
+    Returns the availability of a relay over the WINDOWS periods and its recent outages.
+
+    Args:
+        conn (sqlite3.Connection): The connection to the database.
+        fingerprint (str): The fingerprint of the relay.
+        now (float): The POSIX time the periods end at, the system clock by default.
+
+    Returns:
+        dict: "windows", the (label, observations, running, bandwidth, consensus_weight) sums of every period,
+        and "outages", the (started, ended) POSIX times of the last OUTAGES_SHOWN outages within the longest one,
+        with a None `ended` for an ongoing outage.
+
+    Raises:
+        sqlite3.Error: If the history cannot be read.
+
+    Note:
+        Every period is answered from the hourly or daily rollups, a few dozen rows at most, without reading
+        the raw samples. A period starts at the beginning of the rollup it falls in.
+    """
+    now = time.time() if now is None else now
+    fingerprint = fingerprint.upper()
+
+    windows = []
+    for label, span, resolution in WINDOWS:
+        since = int(now - span)
+        windows.append((label,) + tuple(database.relay_availability(conn, fingerprint, resolution, since - since % resolution)))
+
+    since = int(now - max(span for _, span, _ in WINDOWS))
+    return {"windows": windows, "outages": database.relay_outages(conn, fingerprint, since, OUTAGES_SHOWN)}
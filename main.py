@@ -1,93 +1,140 @@
-import telebot
-from telebot import types
-import configparser
+import argparse
+import os
 import sqlite3
-import re
 import requests
-from datetime import datetime
 import threading
-from time import sleep
+import asyncio
 import logging
-import random
-
-
-# Read the Telegram TOKEN
-config = configparser.ConfigParser()
-config.read('config.ini')
-TOKEN = config['telegram']['token']
-
-# Fingerprint Pattern
-FINGERPRINT_REGEX = "^[A-Za-z0-9]{40}$"
-FINGERPRINT_PATTERN = re.compile(FINGERPRINT_REGEX)
-ONIONOO = "https://onionoo.torproject.org/details?search="
-
-# Create a bot object
-bot = telebot.TeleBot(TOKEN)
+import time
+
+import database
+import history
+import metrics
+import settings
+from onionoo import fetch_group_members, relay_cache
+from onionoo_client import CLOSED, onionoo_client
+from mirror import relay_mirror
+from relay_index import relay_index
+from notifications import NotificationQueue, Outbox, paginate
+from rendering import describe_group, escape_markdown, format_history, relay_cards
+from scheduler import SweepScheduler
+from sweep import expand_groups, run_mirror_sweep
+from validation import is_valid_group, parse_fingerprint, parse_fingerprints, parse_group
+
+
+# Settings of 'config.ini', applied by `configure`
+# Local mirror of Onionoo's relays, refreshed by the sweeps and answering the status lookups
+MIRROR_ENABLED = True
+# A saved details document replacing Onionoo, for offline testing
+MIRROR_DUMP = ''
+
+# Seconds a "[+] Node" or "[-] Node" prompt waits for the fingerprint
+PENDING_ACTION_TTL = 600
+
+# Watchdog sweep limits
+WATCHDOG_CONCURRENCY = 10
+WATCHDOG_TIMEOUT = 30
+# Disabled when the sweeps are run by the standalone watchdog.py processes
+WATCHDOG_EMBEDDED = True
+
+# Characters of the invalid entries quoted back to the user
+INVALID_ENTRY_LENGTH = 64
+
+# Labels of the keyboard buttons
+BUTTONS = ("[+] Node", "[-] Node", "List Nodes", "Status Nodes", "Availability")
+
+# Built by `create_bot` and `start_watchdog`, so that importing this module neither reads 'config.ini' nor starts anything
+bot = None
+keyboard = None
+notifications = None
+scheduler = None
+
+HANDLER_SECONDS = metrics.histogram("torwatchdog_handler_seconds", "Duration of the bot handlers.", ("handler",))
+
+def send_markdown(chat_id, text):
+    """
+    Sends a MarkdownV2 message, on behalf of the notification queue.
 
-# Create the buttons
-keyboard = types.ReplyKeyboardMarkup(row_width=2)
-button_add = types.KeyboardButton("[+] Node")
-button_remove = types.KeyboardButton("[-] Node")
-button_list = types.KeyboardButton("List Nodes")
-button_status = types.KeyboardButton("Status Nodes")
-keyboard.add(button_add, button_remove, button_list, button_status)
+    Args:
+        chat_id (int): The ID of the chat to which the message will be sent.
+        text (str): The MarkdownV2 message to send.
 
+    Returns:
+        None
 
-# Logger configuration
-logging.basicConfig(filename='error.log', level=logging.ERROR)
+    Raises:
+        telebot.apihelper.ApiException: If Telegram refuses the message, so that the queue can retry a 429.
+    """
+    bot.send_message(chat_id, text, parse_mode='MarkdownV2')
 
-def check_relay_status(user_id, fingerprint):
+async def watch_relays():
     """
-    Checks the status of a Tor relay with the given fingerprint.
+    Continuously checks the status of Tor relays against the local relay mirror, or with the asynchronous sweep engine.
+
+    Uses the thread's connection to the SQLite database 'tor_watchdog.db'.
+    Takes the subscriptions from the in-memory relay index, brought up to date with `relay_index.sync` first.
+    When the mirror is enabled, every sweep refreshes it from Onionoo, unless it has been loaded from a file,
+    and checks the relays against it with `run_mirror_sweep`.
+    Otherwise it expands the watched families and operators through Onionoo and checks the status of Tor relays with `AsyncSweeper`.
+    Users are only notified when one of their relays goes offline or comes back online.
+    The sweeps are run by `scheduler`, aligned to Onionoo's hourly publication.
 
     Args:
-        user_id (int): The ID of the user to whom the status message will be sent.
-        fingerprint (str): The fingerprint of the Tor relay to check.
+        None
 
     Returns:
         None
 
     Raises:
-        None
-
-    Sends a message to the user indicating the status of the Tor relay with the given fingerprint.
-    If the relay is offline, it sends a message indicating that it's offline.
-    If there is no information available for the fingerprint, it sends a corresponding message.
-    If an error occurs while fetching information for the fingerprint, it sends an error message.
+        Exception: Any unexpected error, which is logged by `run_thread`.
 
     Note:
-        This function assumes the existence of the `ONIONOO` variable, which is the URL of the Onionoo service.
-        It also assumes the existence of the `bot` object, which is used to send messages to users.
+        The concurrency limit and the per-request timeout are read from the [watchdog] section of 'config.ini'.
+        The HTTP connection pool is kept open across sweeps.
+        The mirror refresh blocks the event loop, which has nothing else to run in the meantime.
+        Alerts go through the notification queue, so the sweep never waits for Telegram.
     """
-    try:
-        response = requests.get(f"{ONIONOO}{fingerprint}")
+    if MIRROR_ENABLED:
+        async def sweep():
+            # Picking up the subscriptions made by the other bot processes
+            relay_index.sync(database.get_connection())
 
-        if response.status_code == 200:
-            data = response.json()
-            relays = data.get('relays', [])
+            # Refreshing the mirror, then checking every subscribed relay against it
+            alerts = []
+            run_mirror_sweep(database.get_connection(), lambda user_id, message: alerts.append((user_id, message)),
+                             refresh=not MIRROR_DUMP)
 
-            if relays:
-                relay = relays[0]
-                is_running = relay.get("running", False)
+            # Queueing the alerts at once, so that every user gets a single message per sweep
+            notifications.submit_many(alerts)
 
-                if not is_running:
-                    message = f"The relay with fingerprint `{fingerprint}` is offline"
-            else:
-                message = f"No information available for fingerprint: `{fingerprint}`"
-        else:
-            message = f"Failed to fetch information for fingerprint: `{fingerprint}`"
-    except requests.RequestException as e:
-        message = f"Error fetching information for fingerprint `{fingerprint}`: {e}"
+        await scheduler.run(sweep)
+        return
+
+    # Only this engine needs `aiohttp`, whose import would delay the first update of every other setup
+    from async_sweep import AsyncSweeper
+
+    async with AsyncSweeper(concurrency=WATCHDOG_CONCURRENCY, timeout=WATCHDOG_TIMEOUT) as sweeper:
+        async def sweep():
+            # Picking up the subscriptions made by the other bot processes
+            relay_index.sync(database.get_connection())
+
+            # Expanding the watched families and operators with one Onionoo request each
+            expand_groups(database.get_connection(), relay_index, fetch_group_members)
+
+            # Checking every subscribed relay with bounded concurrency through the thread's connection
+            alerts = []
+            await sweeper.run(database.get_connection(), lambda user_id, message: alerts.append((user_id, message)))
 
-    bot.send_message(user_id, message, parse_mode='MarkdownV2')
+            # Queueing the alerts at once, so that every user gets a single message per sweep
+            notifications.submit_many(alerts)
+
+        await scheduler.run(sweep)
 
 def run_thread():
     """
     Executes a thread to continuously check the status of Tor relays.
 
-    Connects to the SQLite database 'tor_watchdog.db' using a context.
-    Retrieves records from the 'TorWatchdog' table and checks the status of Tor relays.
-    Sleeps for 12 hours after processing all records.
+    Runs the `watch_relays` event loop until the scheduler is stopped.
 
     Args:
         None
@@ -99,53 +146,23 @@ def run_thread():
         None
 
     Note:
-        This function continuously runs in a loop to monitor the status of Tor relays.
-        It fetches records from the 'TorWatchdog' table and checks the status of relays associated with each user.
-        If an error occurs during the execution of the thread, it logs the error using the logging module.
-
-    Debugging:
-        During debugging, the sleep time can be reduced to 5 seconds by uncommenting the line 'sleep(5)'.
+        Errors raised by a sweep are logged and retried by the scheduler.
+        If an error occurs outside of a sweep, it logs the error using the logging module.
     """
     try:
-        # Connecting to the SQLite database using a context
-        with sqlite3.connect('tor_watchdog.db') as conn:
-            cursor = conn.cursor()
-
-            while True:
-                # Selecting records from the TorWatchdog table
-                cursor.execute('SELECT * FROM TorWatchdog')
-                rows = cursor.fetchall()
-
-                for row in rows:
-                    user_id, node_list = row
-                    fingerprints = node_list.split()
-
-                    for fingerprint in fingerprints:
-                        check_relay_status(user_id, fingerprint)
-
-                # Sleep for 12 
-                sleep(43200)
-                # Sleep for 5 seconds Debugging
-                #sleep(5)
+        asyncio.run(watch_relays())
     except Exception as e:
         # Error log instead of printing it to stdout
         logging.error("Error during thread execution: %s", e)
+    finally:
+        database.close_connection()
 
-# Start the thread
-thread = threading.Thread(target=run_thread)
-thread.daemon = True
-thread.start()
-
-
-@bot.message_handler(commands=['start'])
 def send_welcome(message):
     """
     Handles the 'start' command by registering the user in the database if not already registered.
 
-    Connects to the SQLite database 'tor_watchdog.db' using a context.
-    Creates the 'TorWatchdog' table if it does not already exist.
-    Checks if the user is already in the database.
-    Inserts a new record into the database if the user is not found.
+    Uses the thread's connection to the SQLite database 'tor_watchdog.db'.
+    Inserts a new record into the 'TorWatchdog' table if the user is not found, then brings the relay index up to date.
     Sends a welcome message to the user indicating whether their ID is registered or not.
 
     Args:
@@ -163,105 +180,89 @@ def send_welcome(message):
         If an error occurs during the execution of the function, it is logged using the logging module.
     """
     try:
-        # Connecting to the SQLite database using a context
-        with sqlite3.connect('tor_watchdog.db') as conn:
-            cursor = conn.cursor()
-
-            # Creating the table if it does not already exist
-            cursor.execute('''CREATE TABLE IF NOT EXISTS TorWatchdog (
-                                TelegramUserID INTEGER PRIMARY KEY,
-                                NodeList TEXT
-                                )''')
-
+        # Using the thread's connection, committing on success
+        with database.get_connection() as conn:
             user_id = message.from_user.id
-            # Checks whether the user is already in the database
-            cursor.execute('SELECT * FROM TorWatchdog WHERE TelegramUserID = ?', (user_id,))
-            user_exists = cursor.fetchone()
-
-            if not user_exists:
-                # Inserting a new tuple into the database for the user
-                cursor.execute('INSERT INTO TorWatchdog (TelegramUserID, NodeList) VALUES (?, ?)', (user_id, ''))
-                bot.reply_to(message, "Welcome! Your ID has been registered in the database", reply_markup=keyboard, parse_mode='MarkdownV2')
-            else:
-                bot.reply_to(message, "Welcome back! Your ID is already in the database", reply_markup=keyboard, parse_mode='MarkdownV2')
-
-            # Commit changes to the database
-            conn.commit()
+            # Inserting a new tuple into the database for the user, unless it is already there
+            registered = database.register_user(conn, user_id)
+        relay_index.sync(conn)
+
+        if registered:
+            bot.reply_to(message, r"Welcome\! Your ID has been registered in the database", reply_markup=keyboard, parse_mode='MarkdownV2')
+        else:
+            bot.reply_to(message, r"Welcome back\! Your ID is already in the database", reply_markup=keyboard, parse_mode='MarkdownV2')
     except Exception as e:
         # Error management
         logging.error("Error during the start function: %s", e)
 
-def add_node_fingerprint(message):
+def reply_batch(message, sections):
     """
-    Adds a node fingerprint to the user's list of monitored nodes.
-
-    Extracts the user ID and fingerprint from the message object.
-    Checks if the fingerprint matches the expected pattern using FINGERPRINT_PATTERN.
-    Connects to the SQLite database 'tor_watchdog.db' using a context.
-    Retrieves the existing node list for the user from the 'TorWatchdog' table.
-    Checks if the node fingerprint is already in the user's list.
-    If the fingerprint is not in the list, adds it to the list and updates the database.
-    Sends a confirmation message to the user indicating that the node has been added.
+    Replies with a summary of a batch of fingerprints, in as few messages as Telegram's 4096 characters allow.
 
     Args:
-        message: The message object containing the user ID and fingerprint.
+        message: The message object the reply answers.
+        sections (list): The (title, entries) pairs of the summary, the sections without entries are left out.
+            The entries are already formatted for MarkdownV2.
 
     Returns:
         None
 
+    Raises:
+        None
+    """
+    lines = []
+    for title, entries in sections:
+        if entries:
+            # An empty line between two sections
+            lines.extend([""] if lines else [])
+            lines.append(rf"{title} \({len(entries)}\):")
+            lines.extend(rf"\- {entry}" for entry in entries)
+
+    for page in paginate(lines, separator="\n"):
+        bot.reply_to(message, page, parse_mode='MarkdownV2')
+
+def sync_index():
+    """
+    Brings the relay index up to date with the subscriptions changed by every bot process, before it is read.
+
     Raises:
         None
 
     Note:
-        This function is typically triggered when the user adds a new node fingerprint.
-        It ensures that the fingerprint matches the expected format and updates the user's list in the database.
-        If an error occurs during database access, it is logged using the logging module.
+        If the log of the changes cannot be read, the error is logged and the index is read as it is.
     """
-    user_id = message.from_user.id
-    fingerprint = message.text.strip()
+    try:
+        relay_index.sync(database.get_connection())
+    except sqlite3.Error as e:
+        logging.error("An error occurred while accessing the database: %s", e)
 
-    if FINGERPRINT_PATTERN.match(fingerprint):
-        try:
-            # Connecting to the SQLite database using a context
-            with sqlite3.connect('tor_watchdog.db') as conn:
-                cursor = conn.cursor()
-
-                # Retrieves the existing node list for the user
-                cursor.execute('SELECT NodeList FROM TorWatchdog WHERE TelegramUserID = ?', (user_id,))
-                row = cursor.fetchone()
-                node_list = row[0] if row else ""
-
-                # Checks whether the node has already been entered
-                if fingerprint in node_list.split():
-                    bot.reply_to(message, rf"The node you indicated is already in the list of nodes you are checking", parse_mode='MarkdownV2')
-                else:
-                    # Add fingerprint to the node list, separating with a space
-                    node_list += (" " if node_list else "") + fingerprint
-
-                    # Update the list of nodes in the database
-                    cursor.execute('UPDATE TorWatchdog SET NodeList = ? WHERE TelegramUserID = ?', (node_list, user_id))
-                    conn.commit()
-
-                    bot.reply_to(message, rf"The node with fingerprint `{fingerprint}` has been added to your list", parse_mode='MarkdownV2')
-        except sqlite3.Error as e:
-            logging.error("An error occurred while accessing the database: %s", e)
-    else:
-        logging.error("The fingerprint you indicated does not match the expected format")
+def resolve_group(kind, value):
+    """
+    Returns the fingerprints of the relays of a group, from the local relay mirror once it has been loaded.
 
-def remove_node_fingerprint(message):
+    Raises:
+        requests.RequestException: If the mirror is disabled or still empty and the request to Onionoo fails.
+        sqlite3.Error: If the mirror cannot be read.
+    """
+    if MIRROR_ENABLED:
+        members = relay_mirror.group_members(database.get_connection(), kind, value)
+        if members is not None:
+            return members
+    return fetch_group_members(kind, value)
+
+def add_relay_group(message, kind, value):
     """
-    Removes a node fingerprint from the user's list of monitored nodes.
+    Adds a family or an operator to the user's list of monitored nodes with a single subscription.
 
-    Extracts the user ID and fingerprint from the message object.
-    Checks if the fingerprint matches the expected pattern using FINGERPRINT_PATTERN.
-    Connects to the SQLite database 'tor_watchdog.db' using a context.
-    Retrieves the existing node list for the user from the 'TorWatchdog' table.
-    Removes the fingerprint from the node list if present.
-    Updates the database with the modified node list.
-    Sends a confirmation message to the user indicating that the node has been removed.
+    Uses the thread's connection to the SQLite database 'tor_watchdog.db'.
+    Inserts the group into the 'group_subscriptions' table unless the user already watches it,
+    then brings the relay index used by the sweeps up to date.
+    Sends a confirmation message to the user with the number of relays of the group.
 
     Args:
-        message: The message object containing the user ID and fingerprint.
+        message: The message object containing the user ID.
+        kind (str): 'family' or 'contact'.
+        value (str): The fingerprint of a family member, or the contact text of the operator.
 
     Returns:
         None
@@ -270,53 +271,53 @@ def remove_node_fingerprint(message):
         None
 
     Note:
-        This function is typically triggered when the user removes a node fingerprint.
-        It ensures that the fingerprint matches the expected format and updates the user's list in the database.
-        If the fingerprint is not found in the list, it sends a corresponding message to the user.
-        If an error occurs during database access, it is logged using the logging module.
+        The relays of a group nobody watched yet are looked up at once, so that they are listed right away.
+        Afterwards every sweep refreshes them, so relays joining or leaving the family are followed.
+        If an error occurs during database access or the lookup, it is logged using the logging module.
     """
     user_id = message.from_user.id
-    fingerprint = message.text.strip()
 
-    if FINGERPRINT_PATTERN.match(fingerprint):
+    try:
+        # Using the thread's connection, committing on success
+        with database.get_connection() as conn:
+            # Whether anyone watched the group already, in which case its members are known
+            relay_index.sync(conn)
+            known = relay_index.has_group(kind, value)
+            added = database.add_group_subscription(conn, user_id, kind, value)
+        relay_index.sync(conn)
+    except sqlite3.Error as e:
+        logging.error("An error occurred while accessing the database: %s", e)
+        return
+
+    if not added:
+        bot.reply_to(message, rf"You are already watching {describe_group(kind, value)}", parse_mode='MarkdownV2')
+        return
+
+    # Expanding a group nobody watched yet
+    if not known:
         try:
-            # Connecting to the SQLite database using a context
-            with sqlite3.connect('tor_watchdog.db') as conn:
-                cursor = conn.cursor()
-
-                # Retrieves the existing node list for the user
-                cursor.execute('SELECT NodeList FROM TorWatchdog WHERE TelegramUserID = ?', (user_id,))
-                row = cursor.fetchone()
-                if row:
-                    node_list = row[0]
-                    
-                    # Removes the fingerprint from the node list, if present
-                    node_list = node_list.replace(" " + fingerprint, "").replace(fingerprint, "")
-                    node_list = node_list.strip()
-
-                    # Update the list of nodes in the database
-                    cursor.execute('UPDATE TorWatchdog SET NodeList = ? WHERE TelegramUserID = ?', (node_list, user_id))
-                    conn.commit()
-
-                    bot.reply_to(message, rf"The node with fingerprint `{fingerprint}` has been removed from your list", parse_mode='MarkdownV2')
-                else:
-                    bot.reply_to(message, rf"You don't have any nodes in your list", parse_mode='MarkdownV2')
-        except sqlite3.Error as e:
-            logging.error("An error occurred while accessing the database: %s", e)
-    else:
-        bot.reply_to(message, rf"The fingerprint you indicated does not match the expected format", parse_mode='MarkdownV2')
+            members = resolve_group(kind, value)
+            with database.get_connection() as conn:
+                database.save_relay_group(conn, kind, value, members)
+            relay_index.set_members(kind, value, members)
+        except (requests.RequestException, sqlite3.Error) as e:
+            logging.error("Error expanding the %s %s: %s", kind, value, e)
 
-def list_nodes(message):
+    count = len(relay_index.group_members(kind, value))
+    bot.reply_to(message, rf"{describe_group(kind, value, capitalize=True)} has been added to your list with {count} relays", parse_mode='MarkdownV2')
+
+def remove_relay_group(message, kind, value):
     """
-    Lists the nodes registered by the user.
+    Removes a family or an operator from the user's list of monitored nodes.
 
-    Extracts the user ID from the message object.
-    Connects to the SQLite database 'tor_watchdog.db' using a context.
-    Retrieves the node list for the user from the 'TorWatchdog' table.
-    Formats the node list and sends it as a message to the user.
+    Uses the thread's connection to the SQLite database 'tor_watchdog.db'.
+    Deletes the user's row for the group from the 'group_subscriptions' table, if present,
+    then brings the relay index used by the sweeps up to date.
 
     Args:
-        message: The message object representing the user's request.
+        message: The message object containing the user ID.
+        kind (str): 'family' or 'contact'.
+        value (str): The fingerprint of a family member, or the contact text of the operator.
 
     Returns:
         None
@@ -325,167 +326,261 @@ def list_nodes(message):
         None
 
     Note:
-        This function is typically triggered when the user requests to list their registered nodes.
-        It retrieves the node list from the database, formats it, and sends it as a reply to the user.
-        If the user is not registered in the database, it sends a corresponding message.
         If an error occurs during database access, it is logged using the logging module.
     """
     user_id = message.from_user.id
 
     try:
-        # Connecting to the SQLite database using a context
-        with sqlite3.connect('tor_watchdog.db') as conn:
-            cursor = conn.cursor()
-
-            # Retrieve the node list for the user
-            cursor.execute('SELECT NodeList FROM TorWatchdog WHERE TelegramUserID = ?', (user_id,))
-            row = cursor.fetchone()
-
-            if row:
-                node_list = row[0]
-
-                if node_list:
-                    # Split of the node list into individual fingerprints and sorting
-                    fingerprints = sorted(node_list.split())
-
-                    # Creating a formatted list of fingerprints
-                    formatted_list = "\n".join([rf"\- `{fingerprint}`" for fingerprint in fingerprints])
-                    reply_message = f"Your nodes:\n{formatted_list}"
-                else:
-                    reply_message = "You have no nodes in your list"
-            else:
-                reply_message = "You are not registered in the database. Please use /start command to register"
-
-            bot.reply_to(message, text=reply_message, parse_mode='MarkdownV2')
+        # Using the thread's connection, committing on success
+        with database.get_connection() as conn:
+            removed = database.remove_group_subscription(conn, user_id, kind, value)
+        relay_index.sync(conn)
     except sqlite3.Error as e:
         logging.error("An error occurred while accessing the database: %s", e)
+        return
+
+    if removed:
+        bot.reply_to(message, rf"{describe_group(kind, value, capitalize=True)} has been removed from your list", parse_mode='MarkdownV2')
+    else:
+        bot.reply_to(message, rf"You are not watching {describe_group(kind, value)}", parse_mode='MarkdownV2')
 
-def convert_bandwidth(bandwidth_rate):
+def add_node_fingerprint(message):
     """
-    Converts the given bandwidth rate to a human-readable format.
+    Adds one or more node fingerprints to the user's list of monitored nodes.
+
+    Extracts the user ID and the fingerprints from the message object with `parse_fingerprints`,
+    which checks them against FINGERPRINT_PATTERN in one pass.
+    Uses the thread's connection to the SQLite database 'tor_watchdog.db'.
+    Inserts the fingerprints into the 'subscriptions' table in one transaction, skipping those the user already watches.
+    Once committed, the relay index used by the sweeps is brought up to date with them.
+    Sends a single reply listing the added, duplicate and invalid fingerprints.
 
     Args:
-        bandwidth_rate (int): The bandwidth rate to be converted, in bytes per second.
+        message: The message object containing the user ID and fingerprints.
 
     Returns:
-        str: A string representing the converted bandwidth rate in a human-readable format.
+        None
 
     Raises:
         None
 
     Note:
-        This function calculates the appropriate unit prefix (Bytes, KBytes, MBytes, GBytes) 
-        for the given bandwidth rate and formats the result accordingly.
+        This function is typically triggered when the user answers the "[+] Node" prompt, with one fingerprint
+        or a whole list of them, such as the family of their relays.
+        A single fingerprint gets the same short confirmation as before.
+        A message such as "family: <fingerprint>" or "contact: <text>" is handed to `add_relay_group`.
+        If an error occurs during database access, it is logged using the logging module.
     """
-    # Define prefixes for unit measurements
-    prefixes = {
-        0: 'Bytes',
-        1: 'KBytes',
-        2: 'MBytes',
-        3: 'GBytes'
-    }
+    group = parse_group(message.text)
+    if group is not None and is_valid_group(*group):
+        add_relay_group(message, *group)
+        return
 
-    # Initialize the prefix index
-    prefix_index = 0
+    user_id = message.from_user.id
+    fingerprints, invalid = parse_fingerprints(message.text)
+    added = []
+
+    if fingerprints:
+        try:
+            # Using the thread's connection, committing on success
+            with database.get_connection() as conn:
+                # Adds the fingerprints at once, except the nodes that have already been entered
+                added = database.add_subscriptions(conn, user_id, fingerprints)
+            relay_index.sync(conn)
+        except sqlite3.Error as e:
+            logging.error("An error occurred while accessing the database: %s", e)
+            return
 
-    # Calculate the correct prefix
-    while bandwidth_rate >= 1024 and prefix_index < 3:
-        bandwidth_rate /= 1024
-        prefix_index += 1
+    if len(fingerprints) == 1 and not invalid:
+        if added:
+            bot.reply_to(message, rf"The node with fingerprint `{fingerprints[0]}` has been added to your list", parse_mode='MarkdownV2')
+        else:
+            bot.reply_to(message, rf"The node you indicated is already in the list of nodes you are checking", parse_mode='MarkdownV2')
+    elif not fingerprints and len(invalid) <= 1:
+        bot.reply_to(message, rf"The fingerprint you indicated does not match the expected format", parse_mode='MarkdownV2')
+    else:
+        new = set(added)
+        reply_batch(message, [
+            ("Added to your list", [f"`{fingerprint}`" for fingerprint in added]),
+            ("Already in your list", [f"`{fingerprint}`" for fingerprint in fingerprints if fingerprint not in new]),
+            ("Not matching the expected format", [escape_markdown(entry[:INVALID_ENTRY_LENGTH]) for entry in invalid]),
+        ])
 
-    # Format the result
-    result = f"{bandwidth_rate:.2f} {prefixes[prefix_index]}"
+def remove_node_fingerprint(message):
+    """
+    Removes one or more node fingerprints from the user's list of monitored nodes.
 
-    return result
+    Extracts the user ID and the fingerprints from the message object with `parse_fingerprints`,
+    which checks them against FINGERPRINT_PATTERN in one pass.
+    Uses the thread's connection to the SQLite database 'tor_watchdog.db'.
+    Deletes the user's rows for the fingerprints from the 'subscriptions' table in one transaction.
+    Once committed, the relay index used by the sweeps is brought up to date with them.
+    Sends a single reply listing the removed, missing and invalid fingerprints.
 
-def get_uptime(last_restarted):
+    Args:
+        message: The message object containing the user ID and fingerprints.
+
+    Returns:
+        None
+
+    Raises:
+        None
+
+    Note:
+        This function is typically triggered when the user answers the "[-] Node" prompt.
+        A single fingerprint gets the same short confirmation as before, or a corresponding message if it is not in the list.
+        A message such as "family: <fingerprint>" or "contact: <text>" is handed to `remove_relay_group`.
+        If an error occurs during database access, it is logged using the logging module.
     """
-    Calculates the uptime based on the last restart time.
+    group = parse_group(message.text)
+    if group is not None and is_valid_group(*group):
+        remove_relay_group(message, *group)
+        return
+
+    user_id = message.from_user.id
+    fingerprints, invalid = parse_fingerprints(message.text)
+    removed = []
+
+    if fingerprints:
+        try:
+            # Using the thread's connection, committing on success
+            with database.get_connection() as conn:
+                # Removes the fingerprints at once from the user's nodes, if present
+                removed = database.remove_subscriptions(conn, user_id, fingerprints)
+            relay_index.sync(conn)
+        except sqlite3.Error as e:
+            logging.error("An error occurred while accessing the database: %s", e)
+            return
+
+    if len(fingerprints) == 1 and not invalid:
+        if removed:
+            bot.reply_to(message, rf"The node with fingerprint `{fingerprints[0]}` has been removed from your list", parse_mode='MarkdownV2')
+        else:
+            bot.reply_to(message, rf"The node you indicated is not in your list", parse_mode='MarkdownV2')
+    elif not fingerprints and len(invalid) <= 1:
+        bot.reply_to(message, rf"The fingerprint you indicated does not match the expected format", parse_mode='MarkdownV2')
+    else:
+        gone = set(removed)
+        reply_batch(message, [
+            ("Removed from your list", [f"`{fingerprint}`" for fingerprint in removed]),
+            ("Not in your list", [f"`{fingerprint}`" for fingerprint in fingerprints if fingerprint not in gone]),
+            ("Not matching the expected format", [escape_markdown(entry[:INVALID_ENTRY_LENGTH]) for entry in invalid]),
+        ])
+
+def list_nodes(message):
+    """
+    Lists the nodes registered by the user.
+
+    Extracts the user ID from the message object.
+    Retrieves the fingerprints, families and operators watched by the user from the in-memory relay index,
+    once `sync_index` has applied the changes made by the other bot processes.
+    Formats the node list and sends it as a message to the user.
 
     Args:
-        last_restarted (str): The timestamp of the last restart in ISO 8601 format.
+        message: The message object representing the user's request.
 
     Returns:
-        str: A string representing the uptime in a human-readable format.
+        None
 
     Raises:
         None
 
     Note:
-        This function calculates the uptime based on the difference between the current time and the last restart time.
-        It converts the time difference into days, hours, minutes, and seconds, and formats the result accordingly.
-        If the uptime exceeds one month, it also calculates the number of months.
-    """
-    delta = datetime.now() - datetime.fromisoformat(last_restarted)
-    raw = delta.total_seconds()
-    days = int(raw // (24 * 3600))
-    hours = int((raw % (24 * 3600)) // 3600)
-    minutes = int((raw % 3600) // 60)
-    seconds = int(raw % 60)
-
-    # Calculate the number of months
-    months = days // 30
-    remaining_days = days % 30
-
-    # Format the output
-    formatted_time = ""
-
-    if months > 0:
-        formatted_time = "{:d} months, {:d} days, {:02d}:{:02d}:{:02d}".format(months, remaining_days, hours, minutes, seconds)
-    elif days > 0:
-        formatted_time = "{:d} days, {:02d}:{:02d}:{:02d}".format(remaining_days, hours, minutes, seconds)
+        This function is typically triggered when the user requests to list their registered nodes.
+        It retrieves the node list from the relay index, formats it, and sends it as a reply to the user.
+        If the user is not registered in the database, it sends a corresponding message.
+    """
+    user_id = message.from_user.id
+
+    # Retrieve the sorted node list and groups for the user
+    sync_index()
+    fingerprints = relay_index.user_fingerprints(user_id)
+    groups = relay_index.user_groups(user_id)
+
+    if relay_index.is_registered(user_id):
+        if fingerprints or groups:
+            # Creating a formatted list of fingerprints, then of groups with their number of relays
+            parts = []
+            if fingerprints:
+                formatted_list = "\n".join([rf"\- `{fingerprint}`" for fingerprint in fingerprints])
+                parts.append(f"Your nodes:\n{formatted_list}")
+            if groups:
+                formatted_list = "\n".join([rf"\- {describe_group(kind, value)}: {count} relays" for kind, value, count in groups])
+                parts.append(f"Your families and operators:\n{formatted_list}")
+            reply_message = "\n\n".join(parts)
+        else:
+            reply_message = "You have no nodes in your list"
     else:
-        formatted_time = "{:02d}:{:02d}:{:02d}".format(hours, minutes, seconds)
+        reply_message = r"You are not registered in the database\. Please use /start command to register"
 
-    return formatted_time
+    bot.reply_to(message, text=reply_message, parse_mode='MarkdownV2')
 
-def get_status_of_relay(fingerprint):
+def lookup_relays(fingerprints):
     """
-    Retrieves the status of a relay based on its fingerprint.
+    Returns the records of the given relays, from the local relay mirror once it has been loaded.
 
     Args:
-        fingerprint (str): The fingerprint of the relay.
+        fingerprints (list): The fingerprints of the relays.
 
     Returns:
-        str: A string containing the status information of the relay in a formatted manner.
+        tuple: A dictionary mapping each requested upper-case fingerprint to its record, or to None
+        if Onionoo has no information about it, and the version the rendered status cards are cached by:
+        the `relays_published` timestamp of the mirrored records, or the `Last-Modified` of the cached ones,
+        None when the cached records come from different responses.
 
     Raises:
-        None
+        requests.RequestException: If the mirror is disabled or still empty, the request to Onionoo fails
+            and the relay cache holds none of the relays.
+        sqlite3.Error: If the mirror cannot be read.
 
     Note:
-        This function makes a request to the Onionoo API to fetch information about the relay.
-        It then extracts relevant information such as status, nickname, country, bandwidth, and uptime.
-        If the request is successful and the relay information is available, it formats the status information accordingly.
-        If the request fails or encounters an exception, it logs an error message.
+        Until the first refresh of the mirror, or when it is disabled, the relays are looked up through the shared relay cache.
+        If Onionoo cannot be reached, or its circuit is open, the cache answers with its last known records, even stale,
+        and the relays it does not hold are missing from the dictionary.
     """
-    relay_status = ""
+    if MIRROR_ENABLED:
+        conn = database.get_connection()
+        # Read before the records, a refresh in between labels newer records with the older version, never the opposite
+        published = relay_mirror.published(conn)
+        relays = relay_mirror.lookup_many(conn, fingerprints)
+        if relays is not None:
+            return relays, published
+
     try:
-        response = requests.get(f"{ONIONOO}{fingerprint}")
-
-        if response.status_code == 200:
-            data = response.json()
-            if 'relays' in data and data['relays']:
-                relay = data['relays'][0]
-                uptime = get_uptime(relay.get('last_restarted', ''))
-
-                relay_status = f"Fingerprint: `{fingerprint}`\n" \
-                                    f"Status: {'Running ✅' if relay.get('running') else 'Offline ❌'}\n" \
-                                    f"Nickname: {relay.get('nickname', 'N/A')}\n" \
-                                    f"Country: {relay.get('country_name', 'N/A')}\n" \
-                                    f"Bandwidth: {convert_bandwidth(relay.get('bandwidth_rate'))} bytes/s\n" \
-                                    f"Uptime: {uptime}"
-            else:
-                relay_status = rf"No information available for fingerprint: `{fingerprint}`"
-        else:
-            relay_status = rf"Failed to fetch information for fingerprint: `{fingerprint}`"
-        
-        return relay_status.replace(".", "\.")
+        relays = relay_cache.lookup_many(fingerprints)
     except requests.RequestException as e:
-        logging.error(rf"Error fetching information for fingerprint {fingerprint}: {e}")
+        relays = relay_cache.peek(fingerprints)
+        if not relays:
+            raise
+        logging.error("Error fetching information for %d relays, serving the cached ones: %s", len(fingerprints), e)
+    return relays, relay_cache.version(relays)
 
+def stale_data_notice():
+    """
+    Returns a MarkdownV2 warning when the mirrored relay data is older than the configured `max_age`,
+    or when the relay cache serves its last known data while the circuit to Onionoo is open, None otherwise.
+    """
+    status = None
+    if MIRROR_ENABLED:
+        try:
+            status = relay_mirror.status(database.get_connection())
+        except sqlite3.Error as e:
+            logging.error("An error occurred while accessing the database: %s", e)
+            return None
+
+    if status is not None:
+        if not status["stale"]:
+            return None
+        published = escape_markdown(status["relays_published"] or "an unknown date")
+        return f"⚠️ Onionoo could not be reached, this relay data was published on {published} UTC"
+    if onionoo_client.breaker.state != CLOSED:
+        return "⚠️ Onionoo could not be reached, this is the last known relay data"
+    return None
+
+@metrics.timed(HANDLER_SECONDS, "verify_all_nodes_status")
 def verify_all_nodes_status(message):
     """
-    Verifies the status of all nodes registered by the user and sends the status information as messages.
+    Verifies the status of all nodes registered by the user and sends the status information in one reply.
 
     Args:
         message: The message object representing the user's request.
@@ -497,48 +592,97 @@ def verify_all_nodes_status(message):
         None
 
     Note:
-        This function retrieves the node list for the user from the SQLite database.
-        It then iterates through each node in the list, fetching and sending its status information using the `get_status_of_relay` function.
+        This function retrieves the node list for the user from the in-memory relay index, including the relays
+        of the families and operators they watch, once `sync_index` has applied the changes made by the other bot processes.
+        It then reads the status of all the nodes at once from the local relay mirror, or with a batched Onionoo lookup
+        until the mirror has been loaded. The cards of the relays are rendered once per consensus by `relay_cards`,
+        only their uptime is computed for every request, and they are joined into as few messages
+        as Telegram's 4096 characters allow. A warning follows them when the mirrored data is stale.
+        The messages are sent through the notification queue.
         If the user is not registered in the database, it sends a corresponding message.
-        If an error occurs during database access, it sends an error message to the user.
     """
     user_id = message.from_user.id
 
+    # Retrieve the node list for the user, with the members of their groups
+    sync_index()
+    fingerprints = relay_index.user_relays(user_id)
+
+    if not relay_index.is_registered(user_id):
+        bot.reply_to(message, r"You are not registered in the database\. Please use /start command to register", parse_mode='MarkdownV2')
+        return
+    if not fingerprints:
+        bot.reply_to(message, "You have no nodes in your list", parse_mode='MarkdownV2')
+        return
+
+    # Fetching all the nodes at once, the failed ones are reported as such
     try:
-        # Connecting to the SQLite database using a context
-        with sqlite3.connect('tor_watchdog.db') as conn:
-            cursor = conn.cursor()
+        relays, published = lookup_relays(fingerprints)
+    except (requests.RequestException, sqlite3.Error) as e:
+        logging.error("Error fetching information for the nodes of user %s: %s", user_id, e)
+        relays, published = {}, None
+
+    # The same clock for every card of the reply
+    now = time.time()
+    relay_statuses = []
+    for fingerprint in fingerprints:
+        if fingerprint in relays:
+            relay_statuses.append(relay_cards.render(fingerprint, relays[fingerprint], published, now))
+        else:
+            relay_statuses.append(rf"Failed to fetch information for fingerprint: `{fingerprint}`")
+
+    notice = stale_data_notice()
+    if notice:
+        relay_statuses.append(notice)
+
+    notifications.submit_many([(user_id, page) for page in paginate(relay_statuses)])
 
-            # Retrieve the node list for the user
-            cursor.execute('SELECT NodeList FROM TorWatchdog WHERE TelegramUserID = ?', (user_id,))
-            row = cursor.fetchone()
+@metrics.timed(HANDLER_SECONDS, "show_relay_history")
+def show_relay_history(message):
+    """
+    Sends the availability of a relay over the last 24 hours, 7 days and 30 days, and its recent outages.
 
-            relay_status = ""
+    Args:
+        message: The message object containing the fingerprint of the relay.
 
-            if row:
-                node_list = row[0]
+    Returns:
+        None
+
+    Raises:
+        None
 
-                if node_list:
-                    fingerprints = node_list.split()
+    Note:
+        The history is read from the hourly and daily rollups written by the sweeps, so only the relays
+        watched by someone have one. An invalid fingerprint is reported without querying the database.
+    """
+    fingerprint = parse_fingerprint(message.text)
+    if fingerprint is None:
+        bot.reply_to(message, "The fingerprint does not match the expected format", parse_mode='MarkdownV2')
+        return
 
-                    for fingerprint in fingerprints:
-                        relay_status = get_status_of_relay(fingerprint=fingerprint)
-                        bot.send_message(chat_id=user_id, text=relay_status, parse_mode='MarkdownV2')
-                else:
-                    relay_status = "You have no nodes in your list"
-            else:
-                relay_status = "You are not registered in the database. Please use /start command to register"
+    try:
+        relay_history = history.relay_history(database.get_connection(), fingerprint)
     except sqlite3.Error as e:
-        bot.reply_to(message, rf"An error occurred while accessing the database: {e}", parse_mode='MarkdownV2')
+        logging.error("An error occurred while accessing the database: %s", e)
+        bot.reply_to(message, rf"Failed to fetch the history of fingerprint: `{fingerprint}`", parse_mode='MarkdownV2')
+        return
+
+    bot.reply_to(message, format_history(fingerprint, relay_history), parse_mode='MarkdownV2')
+
+# Steps answered by the message following a prompt, by the name stored in the 'pending_action' table.
+# The handlers are looked up when called, so that the timing wrappers installed by `metrics.enable` are used
+PENDING_ACTIONS = {
+    "add": "add_node_fingerprint",
+    "remove": "remove_node_fingerprint",
+    "availability": "show_relay_history",
+}
 
-@bot.message_handler(func=lambda message: True)
 def handle_buttons(message):
     """
     Handles button commands received from the user.
 
     Parses the message text and routes it to the appropriate function based on the command.
     Supports commands such as adding a node, removing a node, listing nodes, checking nodes' status,
-    displaying help, and providing guidance on using the correct format.
+    showing the availability of a node, displaying help, and providing guidance on using the correct format.
 
     Args:
         message: The message object containing the user's command.
@@ -551,40 +695,259 @@ def handle_buttons(message):
 
     Note:
         This function is a handler for button commands received from the user.
+        If the chat has been prompted for a fingerprint, the message is handed to the pending step instead.
+        The pending steps are stored in the database with an expiry time, so they survive a restart,
+        are shared by every bot process and are forgotten when the user never answers.
         It checks the text of the message against predefined commands and invokes corresponding functions.
         If the message text does not match any command, it provides guidance on using the correct format.
     """
+    try:
+        # Using the thread's connection, committing on success
+        with database.get_connection() as conn:
+            action = database.pop_pending_action(conn, message.chat.id)
+
+            # Prompting for the fingerprint, which the next message of the chat answers
+            if message.text == "[+] Node" and action is None:
+                database.set_pending_action(conn, message.chat.id, "add", PENDING_ACTION_TTL)
+            elif message.text == "[-] Node" and action is None:
+                database.set_pending_action(conn, message.chat.id, "remove", PENDING_ACTION_TTL)
+            elif message.text == "Availability" and action is None:
+                database.set_pending_action(conn, message.chat.id, "availability", PENDING_ACTION_TTL)
+    except sqlite3.Error as e:
+        logging.error("An error occurred while accessing the database: %s", e)
+        return
+
+    # Answer to a prompt
+    if action in PENDING_ACTIONS:
+        globals()[PENDING_ACTIONS[action]](message)
     # Add node
-    if message.text == "[+] Node":
-        bot.reply_to(message, "Write down the fingerprint of the node you want to look at", parse_mode='MarkdownV2')
-        bot.register_next_step_handler(message, add_node_fingerprint)
+    elif message.text == "[+] Node":
+        bot.reply_to(message, "Write down the fingerprints of the nodes you want to look at, separated by spaces, commas or new lines, or family: FINGERPRINT, or contact: TEXT to watch a whole family or operator", parse_mode='MarkdownV2')
     # Remove node
     elif message.text == "[-] Node":
-        bot.reply_to(message, "Write the fingerprint of the node you no longer want to control", parse_mode='MarkdownV2')
-        bot.register_next_step_handler(message, remove_node_fingerprint)
+        bot.reply_to(message, "Write the fingerprints of the nodes you no longer want to control, separated by spaces, commas or new lines, or the family: or contact: you are watching", parse_mode='MarkdownV2')
     # List nodes
     elif message.text == "List Nodes":
         list_nodes(message=message)
     # Get nodes status
     elif message.text == "Status Nodes":
         verify_all_nodes_status(message=message)
+    # Get the history of a node
+    elif message.text == "Availability":
+        bot.reply_to(message, "Write the fingerprint of the node whose availability you want to see", parse_mode='MarkdownV2')
     elif message.text == "/help":
         send_help(message)
     else:
         bot.reply_to(message=message, text="Please respect the required format, if you don't know the formats invoke the /help command")
 
 
-@bot.message_handler(commands=['help'])
 def send_help(message):
     """
     Handles the /help command
     """
     help_message = "You can manage nodes using the following commands (By clicking on the buttons):\n" \
-                   "[+] Node: Add a new Node\n" \
-                   "[-] Node: Remove a Node\n" \
+                   "[+] Node: Add one or more Nodes, or a whole family or operator with family: FINGERPRINT or contact: TEXT\n" \
+                   "[-] Node: Remove one or more Nodes\n" \
                    "List Nodes: View the list of nodes\n" \
-                   "Status Nodes: View the status of nodes"
+                   "Status Nodes: View the status of nodes\n" \
+                   "Availability: View the uptime of a node over the last 24 hours, 7 days and 30 days, and its outages"
     bot.reply_to(message, help_message, reply_markup=keyboard)
 
-# Run the bot
-bot.infinity_polling()
+
+def configure(config):
+    """
+    Applies the settings of 'config.ini' to this module and to the shared Onionoo client, relay cache and relay mirror.
+
+    Args:
+        config (configparser.ConfigParser): The configuration read by `settings.read_config`.
+
+    Returns:
+        None
+
+    Raises:
+        ValueError: If a setting is not a number or a boolean.
+    """
+    global MIRROR_ENABLED, MIRROR_DUMP, PENDING_ACTION_TTL, WATCHDOG_CONCURRENCY, WATCHDOG_TIMEOUT, WATCHDOG_EMBEDDED
+
+    settings.configure_onionoo(config)
+    MIRROR_ENABLED = config.getboolean('mirror', 'enabled', fallback=True)
+    MIRROR_DUMP = config.get('mirror', 'dump', fallback='')
+    PENDING_ACTION_TTL = config.getint('telegram', 'pending_action_ttl', fallback=600)
+    WATCHDOG_CONCURRENCY = config.getint('watchdog', 'concurrency', fallback=10)
+    WATCHDOG_TIMEOUT = config.getfloat('watchdog', 'request_timeout', fallback=30)
+    WATCHDOG_EMBEDDED = config.getboolean('watchdog', 'embedded', fallback=True)
+
+def initialize(config):
+    """
+    Prepares the state shared by the bot and the embedded watchdog: the error log, the metrics endpoint,
+    the database, the relay index and the mirror loaded from a saved details document.
+
+    Args:
+        config (configparser.ConfigParser): The configuration read by `settings.read_config`.
+
+    Returns:
+        None
+
+    Raises:
+        sqlite3.Error: If the database cannot be created or read.
+        OSError: If the metrics port or the details document cannot be opened.
+    """
+    # Logger configuration
+    logging.basicConfig(filename='error.log', level=logging.ERROR)
+
+    # Prometheus metrics on a local endpoint, nothing is recorded when disabled
+    if config.getboolean('metrics', 'enabled', fallback=False):
+        metrics.start_server(config.getint('metrics', 'port', fallback=9464), config.get('metrics', 'listen', fallback='127.0.0.1'))
+
+    # Create the tables and migrate the legacy node lists once at startup
+    database.init_database()
+
+    # Load the subscriptions and relay states in memory, the handlers keep them up to date with `relay_index.sync`
+    relay_index.load(database.get_connection())
+
+    # Fill the mirror from the saved details document, which replaces Onionoo
+    if MIRROR_ENABLED and MIRROR_DUMP:
+        relay_mirror.load_dump(database.get_connection(), MIRROR_DUMP)
+
+def create_bot(config):
+    """
+    Creates the Telegram bot, its keyboard and the notification queue, and registers the handlers.
+
+    Args:
+        config (configparser.ConfigParser): The configuration read by `settings.read_config`.
+
+    Returns:
+        telebot.TeleBot: The bot, also stored in `bot`.
+
+    Raises:
+        KeyError: If the [telegram] section has no token.
+
+    Note:
+        `telebot` is only imported here, so that the watchdog, the benchmarks and the core modules never load it.
+        The handlers are registered in the order they are tried, the catch-all `handle_buttons` answering /help itself.
+    """
+    global bot, keyboard, notifications
+
+    import telebot
+    from telebot import types
+
+    bot = telebot.TeleBot(config['telegram']['token'])
+
+    # Create the buttons
+    keyboard = types.ReplyKeyboardMarkup(row_width=2)
+    keyboard.add(*[types.KeyboardButton(label) for label in BUTTONS])
+
+    # Outbound messages are queued and sent by worker threads within Telegram's rate limits
+    notifications = NotificationQueue(send_markdown, workers=config.getint('telegram', 'notification_workers', fallback=4))
+    notifications.start()
+    metrics.QUEUE_DEPTH.set_function(notifications.depth, "notifications")
+
+    bot.register_message_handler(send_welcome, commands=['start'])
+    bot.register_message_handler(handle_buttons, func=lambda message: True)
+    bot.register_message_handler(send_help, commands=['help'])
+    return bot
+
+def start_watchdog(config):
+    """
+    Starts the sweeps of the embedded watchdog in a daemon thread, alerting through the notification queue of `create_bot`.
+
+    Args:
+        config (configparser.ConfigParser): The configuration read by `settings.read_config`.
+
+    Returns:
+        threading.Thread: The running thread, which returns once `scheduler` is stopped.
+
+    Raises:
+        None
+    """
+    global scheduler
+
+    # The sweeps tell the new watchers of a relay that is already down, a process that does not sweep keeps none
+    relay_index.track_arrivals = True
+
+    # Sweeps follow Onionoo's hourly publication, catching up at once after a downtime
+    scheduler = SweepScheduler(
+        lambda: relay_index.consensus,
+        min_interval=config.getint('watchdog', 'min_interval', fallback=300),
+    )
+
+    thread = threading.Thread(target=run_thread)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def run_bot(config, embedded=None):
+    """
+    Runs the bot until it is stopped, receiving the updates through a webhook if one is configured, by polling otherwise.
+
+    Args:
+        config (configparser.ConfigParser): The configuration read by `settings.read_config`.
+        embedded (bool): Whether the relays are also swept by a thread of this process, the `embedded`
+            setting of the [watchdog] section by default. Otherwise the alerts of the standalone watchdog
+            are sent from the outbox.
+
+    Returns:
+        None
+
+    Raises:
+        KeyError: If the [telegram] section has no token.
+        sqlite3.Error: If the database cannot be created or read.
+    """
+    configure(config)
+    initialize(config)
+    create_bot(config)
+
+    # Start the thread, unless the standalone watchdog sweeps the relays and queues its alerts in the outbox
+    thread = start_watchdog(config) if (WATCHDOG_EMBEDDED if embedded is None else embedded) else None
+    outbox = Outbox(notifications).start() if thread is None else None
+
+    if config.get('webhook', 'url', fallback=''):
+        # Imported here since it loads `telebot`, like `create_bot`
+        from webhook import run_webhook
+
+        run_webhook(
+            bot,
+            config['webhook']['url'],
+            listen=config.get('webhook', 'listen', fallback='127.0.0.1'),
+            port=config.getint('webhook', 'port', fallback=8443),
+            path=config.get('webhook', 'path', fallback='/telegram'),
+            secret_token=config.get('webhook', 'secret_token', fallback=None) or None,
+            workers=config.getint('webhook', 'workers', fallback=8),
+            max_pending=config.getint('webhook', 'max_pending', fallback=10000),
+        )
+    else:
+        bot.infinity_polling()
+
+    # Stop the watchdog after the running sweep, or the outbox, and the notification workers
+    if thread is not None:
+        scheduler.stop()
+        thread.join()
+    if outbox is not None:
+        outbox.stop()
+    notifications.stop()
+
+def main(argv=None):
+    """
+    Starts the bot, the standalone watchdog, or the bot with the watchdog embedded, as chosen on the command line.
+
+    Usage:
+        python main.py [all|bot|watchdog] [--config config.ini] [--workers N]
+    """
+    parser = argparse.ArgumentParser(description="Telegram bot notifying the operators of Tor relays when they go offline.")
+    parser.add_argument("role", nargs="?", choices=("all", "bot", "watchdog"), default="all",
+                        help="all: the bot, sweeping the relays itself unless embedded = false in [watchdog]; "
+                             "bot: the bot alone; watchdog: the standalone watchdog processes")
+    parser.add_argument("--config", default=settings.CONFIG_PATH, help="path of the configuration file")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="number of watchdog processes")
+    args = parser.parse_args(argv)
+
+    if args.role == "watchdog":
+        import watchdog
+
+        watchdog.main(args.workers, args.config)
+    else:
+        run_bot(settings.read_config(args.config), embedded=None if args.role == "all" else False)
+
+
+if __name__ == "__main__":
+    main()
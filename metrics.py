@@ -0,0 +1,315 @@
+import functools
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Latency buckets in seconds, from a cached SQLite read to a full details download
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Nothing is recorded until `enable` is called
+enabled = False
+_registry = {}
+_registry_lock = threading.Lock()
+# The (function, wrapper) pairs of the functions decorated while disabled, installed by `enable`
+_deferred = []
+
+
+def enable():
+    """
+    Starts recording the metrics and installs the timing wrappers of the functions decorated so far.
+
+    Note:
+        Until then the decorated functions are left untouched, so they cost nothing while disabled.
+        The wrapper replaces the function in its module, so the callers that look it up there,
+        such as `database.add_subscriptions(...)`, are timed from now on.
+    """
+    global enabled
+    enabled = True
+
+    for function, wrapper in _deferred:
+        namespace = vars(sys.modules[function.__module__])
+        if namespace.get(function.__name__) is function:
+            namespace[function.__name__] = wrapper
+    _deferred.clear()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    """
+    Base class of the metrics, keeping one value per combination of label values.
+    """
+
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._functions = {}
+        self._lock = threading.Lock()
+
+    def set_function(self, function, *labels):
+        """
+        Reads the value from `function` at every scrape, such as the depth of a queue.
+        """
+        self._functions[labels] = function
+
+    def render(self):
+        """
+        Returns the metric in the Prometheus text format.
+        """
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            values = dict(self._values)
+        for labels, function in list(self._functions.items()):
+            try:
+                values[labels] = function()
+            except Exception:
+                continue
+        for labels, value in sorted(values.items()):
+            lines.extend(self._samples(labels, value))
+        return "\n".join(lines)
+
+    def _samples(self, labels, value):
+        return [f"{self.name}{_format_labels(self.labels, labels)} {value}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        """
+        Adds `amount` to the counter of the given label values.
+        """
+        if not enabled:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, *labels):
+        """
+        Sets the gauge of the given label values.
+        """
+        if not enabled:
+            return
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        """
+        Records a value, such as a duration in seconds, for the given label values.
+        """
+        if not enabled:
+            return
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                # One count per bucket, then the sum and the total count
+                counts = self._values[labels] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-2] += value
+            counts[-1] += 1
+
+    def time(self, *labels):
+        """
+        Returns a context manager observing the duration of its block.
+        """
+        return _Timer(self, labels) if enabled else _NULL_TIMER
+
+    def _samples(self, labels, counts):
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            bucket = _format_labels(self.labels, labels, f'le="{bound}"')
+            samples.append(f"{self.name}_bucket{bucket} {cumulative}")
+        bucket = _format_labels(self.labels, labels, 'le="+Inf"')
+        samples.append(f"{self.name}_bucket{bucket} {counts[-1]}")
+        samples.append(f"{self.name}_sum{_format_labels(self.labels, labels)} {counts[-2]}")
+        samples.append(f"{self.name}_count{_format_labels(self.labels, labels)} {counts[-1]}")
+        return samples
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "errors", "start")
+
+    def __init__(self, histogram, labels, errors=None):
+        self.histogram = histogram
+        self.labels = labels
+        self.errors = errors
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+        if exc_type is not None and self.errors is not None:
+            self.errors.inc(*self.labels)
+        return False
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def _register(cls, name, *args, **kwargs):
+    # Modules may declare the same metric, they share a single instance
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = cls(name, *args, **kwargs)
+        return metric
+
+
+def counter(name, documentation, labels=()):
+    """
+    Returns the counter called `name`, creating it on first use.
+    """
+    return _register(Counter, name, documentation, labels)
+
+
+def gauge(name, documentation, labels=()):
+    """
+    Returns the gauge called `name`, creating it on first use.
+    """
+    return _register(Gauge, name, documentation, labels)
+
+
+def histogram(name, documentation, labels=(), buckets=BUCKETS):
+    """
+    Returns the histogram called `name`, creating it on first use.
+    """
+    return _register(Histogram, name, documentation, labels, buckets)
+
+
+def render():
+    """
+    Returns every metric in the Prometheus text format.
+    """
+    with _registry_lock:
+        metrics = list(_registry.values())
+    return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+# Time spent waiting for the external services and their failures, by service and operation
+UPSTREAM_SECONDS = histogram("torwatchdog_upstream_seconds", "Duration of the calls to Onionoo, SQLite and Telegram.",
+                             ("upstream", "operation"))
+UPSTREAM_ERRORS = counter("torwatchdog_upstream_errors_total", "Failed calls to Onionoo, SQLite and Telegram.",
+                          ("upstream", "operation"))
+# Messages and updates waiting in the in-process queues, by queue
+QUEUE_DEPTH = gauge("torwatchdog_queue_depth", "Items waiting in the in-process queues.", ("queue",))
+
+
+def upstream(service, operation):
+    """
+    Returns a context manager timing a call to an external service and counting it if it raises.
+
+    Usage:
+        with metrics.upstream("onionoo", "lookup"):
+            response = requests.get(url)
+    """
+    return _Timer(UPSTREAM_SECONDS, (service, operation), UPSTREAM_ERRORS) if enabled else _NULL_TIMER
+
+
+def timed(histogram, *labels, errors=None):
+    """
+    Decorates a module-level function so that its duration is observed by `histogram`,
+    and its exceptions counted by `errors`, once the metrics are enabled.
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with _Timer(histogram, labels, errors):
+                return function(*args, **kwargs)
+
+        if enabled:
+            return wrapper
+        _deferred.append((function, wrapper))
+        return function
+
+    return decorate
+
+
+def instrumented(service, operation=None):
+    """
+    Decorates a function calling an external service, timing it as `operation`, its name by default.
+    """
+    def decorate(function):
+        return timed(UPSTREAM_SECONDS, service, operation or function.__name__, errors=UPSTREAM_ERRORS)(function)
+
+    return decorate
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are not logged
+        pass
+
+
+def start_server(port, address="127.0.0.1"):
+    """
+    Enables the metrics and serves them on http://address:port/metrics from a daemon thread.
+
+    Returns:
+        ThreadingHTTPServer: The server, which can be stopped with `shutdown`.
+
+    Raises:
+        OSError: If the server cannot listen on the address.
+    """
+    enable()
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
@@ -0,0 +1,244 @@
+import json
+import sys
+import time
+from datetime import datetime, timezone
+
+import database
+import metrics
+from onionoo import GROUP_KINDS, ONIONOO_DETAILS, RELAY_FIELDS, STREAM_CHUNK, RelayStreamParser, parse_published
+from onionoo_client import onionoo_client
+
+
+# Onionoo publishes once per hour, data older than this means the refreshes have been failing
+MAX_AGE = 3 * 3600
+REQUEST_TIMEOUT = 60
+# The mirror also keeps what the family and contact subscriptions are expanded with
+MIRROR_FIELDS = RELAY_FIELDS + ("effective_family", "contact")
+
+MIRROR_PUBLISHED = metrics.gauge("torwatchdog_mirror_published_timestamp_seconds",
+                                 "Onionoo publication time of the relay data in the local mirror.")
+MIRROR_RELAYS = metrics.gauge("torwatchdog_mirror_relays", "Relays in the local mirror.")
+MIRROR_REFRESHES = metrics.counter("torwatchdog_mirror_refreshes_total", "Refreshes of the local mirror by result.", ("result",))
+
+
+class RelayMirror:
+    """
+    Local copy of the relay records of Onionoo's details document, kept in the 'relay_mirror' table.
+
+    A background job calls `refresh`, which downloads the whole document with `If-Modified-Since`,
+    so an unchanged document costs an empty 304 response, and parses it as a stream. The lookups
+    are then answered from the database, whether Onionoo is reachable or not, and `status` tells
+    how old the data is. Since the mirror lives in the database, every bot and watchdog process
+    sharing it reads the same copy. `load_dump` fills it from a saved details document instead,
+    for offline testing.
+
+    Usage:
+        relay_mirror.refresh(conn)
+        relays = relay_mirror.lookup_many(conn, fingerprints)
+    """
+
+    def __init__(self, base_url=ONIONOO_DETAILS, fields=MIRROR_FIELDS, max_age=MAX_AGE, timeout=REQUEST_TIMEOUT):
+        self.base_url = base_url
+        self.fields = fields
+        self.max_age = max_age
+        self.timeout = timeout
+
+    def configure(self, base_url=None, max_age=None, timeout=None):
+        """
+        Changes the settings of the mirror.
+        """
+        if base_url is not None:
+            self.base_url = base_url
+        if max_age is not None:
+            self.max_age = max_age
+        if timeout is not None:
+            self.timeout = timeout
+
+    def refresh(self, conn):
+        """
+        Downloads Onionoo's details document, if it has changed, and stores it in the mirror.
+
+        Args:
+            conn (sqlite3.Connection): The connection to the database.
+
+        Returns:
+            int: The number of relay records that have been added, changed or removed, 0 if Onionoo has no new data.
+
+        Raises:
+            requests.RequestException: If the request fails or Onionoo answers with an error status.
+            ValueError: If the downloaded document is truncated, malformed or holds no relay.
+            sqlite3.Error: If the records cannot be stored.
+        """
+        meta = database.mirror_meta(conn)
+        last_modified = meta["last_modified"] if meta else None
+        headers = {"If-Modified-Since": last_modified} if last_modified else {}
+        params = {"type": "relay", "fields": ",".join(self.fields)}
+
+        with metrics.upstream("onionoo", "mirror"):
+            response = onionoo_client.get(self.base_url, params=params, headers=headers, stream=True, timeout=self.timeout)
+            with response:
+                if response.status_code == 304:
+                    relays = None
+                else:
+                    response.raise_for_status()
+                    # Streaming the document, the mirror keeps every relay
+                    parser = RelayStreamParser(None, self.fields)
+                    for chunk in response.iter_content(STREAM_CHUNK):
+                        parser.feed(chunk)
+                    relays = parser.close()
+
+        if relays is None:
+            with conn:
+                database.touch_mirror(conn, time.time())
+            MIRROR_REFRESHES.inc("not_modified")
+            return 0
+
+        return self._store(conn, relays, parser.published, response.headers.get("Last-Modified"), self.base_url)
+
+    def load_dump(self, conn, path):
+        """
+        Fills the mirror from a details document saved to a file, such as with
+        `curl -o details.json 'https://onionoo.torproject.org/details?type=relay'`.
+
+        Args:
+            conn (sqlite3.Connection): The connection to the database.
+            path (str): The path of the saved document.
+
+        Returns:
+            int: The number of relay records that have been added, changed or removed.
+
+        Raises:
+            OSError: If the file cannot be read.
+            ValueError: If the document is truncated, malformed or holds no relay.
+            sqlite3.Error: If the records cannot be stored.
+
+        Note:
+            The next `refresh` downloads the whole document again, since a file has no `Last-Modified` header.
+        """
+        parser = RelayStreamParser(None, self.fields)
+        with open(path, "rb") as dump:
+            for chunk in iter(lambda: dump.read(STREAM_CHUNK), b""):
+                parser.feed(chunk)
+        return self._store(conn, parser.close(), parser.published, None, f"file:{path}")
+
+    def lookup_many(self, conn, fingerprints):
+        """
+        Returns the mirrored records of a few relays.
+
+        Args:
+            conn (sqlite3.Connection): The connection to the database.
+            fingerprints (iterable): The fingerprints of the relays.
+
+        Returns:
+            dict: A dictionary mapping each requested upper-case fingerprint to its record, or to None
+            if Onionoo had no information about it. None if the mirror has never been loaded.
+
+        Raises:
+            sqlite3.Error: If the mirror cannot be read.
+        """
+        keys = list(dict.fromkeys(fingerprint.upper() for fingerprint in fingerprints))
+        if database.mirror_meta(conn) is None:
+            return None
+
+        records = database.mirror_records(conn, keys)
+        return {key: json.loads(records[key]) if key in records else None for key in keys}
+
+    def group_members(self, conn, kind, value):
+        """
+        Returns the fingerprints of the relays of a family or of an operator, found in the mirror.
+
+        Args:
+            conn (sqlite3.Connection): The connection to the database.
+            kind (str): 'family' or 'contact', with the meaning of `onionoo.fetch_group_members`.
+            value (str): The upper-case fingerprint of a family member, or the contact text.
+
+        Returns:
+            list: The sorted upper-case fingerprints of the members, None if the mirror has never been loaded.
+
+        Raises:
+            ValueError: If `kind` is not one of GROUP_KINDS.
+            sqlite3.Error: If the mirror cannot be read.
+
+        Note:
+            A family member unknown to the mirror is its only member, so that its subscribers are told so.
+        """
+        if kind not in GROUP_KINDS:
+            raise ValueError(f"Unknown relay group: {kind}")
+        if database.mirror_meta(conn) is None:
+            return None
+
+        if kind == "contact":
+            parts = value.lower().split()
+            return sorted(database.mirror_contact_fingerprints(conn, parts)) if parts else []
+
+        record = database.mirror_records(conn, [value]).get(value)
+        family = json.loads(record).get("effective_family", []) if record else []
+        return sorted({value} | {member.lstrip("$").upper() for member in family})
+
+    def published(self, conn):
+        """
+        Returns the Onionoo `relays_published` timestamp of the mirrored data, or None if it has never been loaded.
+        """
+        meta = database.mirror_meta(conn)
+        return meta["relays_published"] if meta else None
+
+    def status(self, conn, now=None):
+        """
+        Returns the metadata of the mirror and how old its data is.
+
+        Args:
+            conn (sqlite3.Connection): The connection to the database.
+            now (datetime): The current aware time, the system clock by default.
+
+        Returns:
+            dict: The metadata returned by `database.mirror_meta`, with the `age` of the data in seconds
+            since Onionoo published it and whether it is `stale`, older than `max_age`.
+            None if the mirror has never been loaded.
+
+        Raises:
+            sqlite3.Error: If the mirror cannot be read.
+        """
+        meta = database.mirror_meta(conn)
+        if meta is None:
+            return None
+
+        published = parse_published(meta["relays_published"])
+        now = now or datetime.now(timezone.utc)
+        meta["age"] = None if published is None else (now - published).total_seconds()
+        meta["stale"] = meta["age"] is None or meta["age"] > self.max_age
+        return meta
+
+    def _store(self, conn, relays, published, last_modified, source):
+        # An empty document would wipe the mirror, it is an upstream failure rather than a Tor network without relays
+        if not relays:
+            raise ValueError("Onionoo details document without relays")
+
+        # Onionoo is served by several hosts, one of them lagging behind must not roll the mirror back
+        current = self.published(conn)
+        if current and published and published < current:
+            MIRROR_REFRESHES.inc("outdated")
+            return 0
+
+        records = [(key, json.dumps(relay, separators=(",", ":"), sort_keys=True)) for key, relay in relays.items()]
+        with conn:
+            changed, removed = database.save_mirror(conn, records, published, last_modified, source, time.time())
+
+        MIRROR_REFRESHES.inc("updated")
+        MIRROR_RELAYS.set(len(records))
+        published = parse_published(published)
+        if published is not None:
+            MIRROR_PUBLISHED.set(published.timestamp())
+        return changed + removed
+
+
+# Shared by the watchdog and the bot handlers of a process
+relay_mirror = RelayMirror()
+
+
+if __name__ == "__main__":
+    # Fills the mirror of 'tor_watchdog.db' from a saved details document, or from Onionoo without argument
+    database.init_database()
+    conn = database.get_connection()
+    changed = relay_mirror.load_dump(conn, sys.argv[1]) if len(sys.argv) > 1 else relay_mirror.refresh(conn)
+    status = relay_mirror.status(conn)
+    print(f"{status['relays']} relays published {status['relays_published']}, {changed} changed, from {status['source']}")
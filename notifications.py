@@ -0,0 +1,331 @@
+import heapq
+import itertools
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from collections import deque
+
+import database
+import metrics
+
+
+# Telegram limits: about 30 messages per second overall, one per second in the same chat.
+# The global rate stays a little below the limit to absorb network jitter.
+GLOBAL_RATE = 28
+CHAT_RATE = 1
+MESSAGE_LIMIT = 4096
+WORKERS = 4
+# The outbox is polled every second, and a chat's messages wait until no worker has queued any for `OUTBOX_LINGER`
+# seconds, so the alerts of the same sweep are sent together. The sender lease outlives a few polls.
+OUTBOX_POLL = 1
+OUTBOX_LINGER = 5
+OUTBOX_LEASE = 30
+
+
+class RateLimiter:
+    """
+    Token bucket allowing `rate` operations per second with bursts of at most `burst`.
+
+    Tokens are reserved in advance, so concurrent callers are spread over time instead of
+    all waking up at once when the bucket refills.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Takes a token and returns how many seconds the caller has to wait before using it.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return max(0.0, -self._tokens / self.rate)
+
+    def acquire(self):
+        """
+        Blocks until a token is available.
+        """
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+
+def paginate(parts, limit=MESSAGE_LIMIT, separator="\n\n"):
+    """
+    Joins message parts into as few messages as possible, each at most `limit` characters long.
+
+    Args:
+        parts (iterable): The message parts, which are never split.
+        limit (int): The maximum length of a message.
+        separator (str): The text placed between two parts of the same message.
+
+    Returns:
+        list: The messages.
+
+    Raises:
+        None
+    """
+    pages = []
+    page = ""
+
+    for part in parts:
+        if page and len(page) + len(separator) + len(part) > limit:
+            pages.append(page)
+            page = part
+        else:
+            page = f"{page}{separator}{part}" if page else part
+
+    if page:
+        pages.append(page)
+
+    return pages
+
+
+def retry_after(error):
+    """
+    Returns the `retry_after` of a Telegram 429 error, or None for any other error.
+    """
+    if getattr(error, "error_code", None) != 429:
+        return None
+    result_json = getattr(error, "result_json", None) or {}
+    return result_json.get("parameters", {}).get("retry_after", 1)
+
+
+class NotificationQueue:
+    """
+    Outbound message queue drained by worker threads within Telegram's rate limits.
+
+    Messages are kept in a queue per chat. A chat is handed to one worker at a time, so its
+    messages keep their order, and it becomes ready again one second after its last message.
+    Every message also takes a token from the global limiter. All the messages waiting for a chat
+    when a worker picks it are coalesced into one, up to Telegram's 4096 characters.
+    A 429 answer puts the message back and pauses the chat for the requested `retry_after`.
+
+    Usage:
+        notifications = NotificationQueue(lambda chat_id, text: bot.send_message(chat_id, text))
+        notifications.start()
+        notifications.submit(chat_id, "text")
+    """
+
+    def __init__(self, send, workers=WORKERS, global_rate=GLOBAL_RATE, chat_rate=CHAT_RATE, limit=MESSAGE_LIMIT):
+        self.send = send
+        self.workers = workers
+        self.chat_interval = 1 / chat_rate
+        self.limit = limit
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self._global = RateLimiter(global_rate)
+        self._pending = {}
+        self._ready = []
+        self._scheduled = set()
+        self._in_flight = set()
+        self._next_at = {}
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._threads = []
+        self._stopped = False
+
+    def start(self):
+        """
+        Starts the worker threads.
+        """
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"notifications-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        """
+        Stops the worker threads once the message being sent has been delivered.
+        """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def submit(self, chat_id, text):
+        """
+        Queues a message for a chat and returns immediately.
+        """
+        self.submit_many([(chat_id, text)])
+
+    def submit_many(self, messages):
+        """
+        Queues many (chat_id, text) messages at once.
+
+        Note:
+            The messages are queued atomically, so all the messages for the same chat are coalesced
+            into as few Telegram messages as possible, such as one alert message per user per sweep.
+        """
+        with self._condition:
+            for chat_id, text in messages:
+                self._pending.setdefault(chat_id, deque()).append(text)
+                self._schedule(chat_id)
+            self._condition.notify_all()
+
+    def depth(self):
+        """
+        Returns the number of messages waiting to be sent.
+        """
+        with self._condition:
+            return sum(len(texts) for texts in self._pending.values())
+
+    def wait_idle(self, timeout=None):
+        """
+        Blocks until every queued message has been sent or dropped, returning False on timeout.
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._pending and not self._in_flight, timeout)
+
+    def _schedule(self, chat_id):
+        # Must be called with the condition held
+        if chat_id in self._scheduled or chat_id in self._in_flight:
+            return
+        self._scheduled.add(chat_id)
+        heapq.heappush(self._ready, (self._next_at.get(chat_id, 0), next(self._sequence), chat_id))
+
+    def _take(self):
+        # Waits for a ready chat and takes its coalesced message, or returns None once stopped
+        with self._condition:
+            while True:
+                if self._stopped:
+                    return None
+                now = time.monotonic()
+                if self._ready and self._ready[0][0] <= now:
+                    break
+                self._condition.wait(self._ready[0][0] - now if self._ready else None)
+
+            _, _, chat_id = heapq.heappop(self._ready)
+            self._scheduled.discard(chat_id)
+            self._in_flight.add(chat_id)
+
+            texts = self._pending[chat_id]
+            parts = [texts.popleft()]
+            length = len(parts[0])
+            while texts and length + 2 + len(texts[0]) <= self.limit:
+                length += 2 + len(texts[0])
+                parts.append(texts.popleft())
+
+            return chat_id, "\n\n".join(parts)
+
+    def _work(self):
+        while True:
+            item = self._take()
+            if item is None:
+                return
+            chat_id, text = item
+
+            self._global.acquire()
+            error = None
+            try:
+                with metrics.upstream("telegram", "sendMessage"):
+                    self.send(chat_id, text)
+            except Exception as e:
+                error = e
+            delay = retry_after(error)
+
+            with self._condition:
+                now = time.monotonic()
+                self._in_flight.discard(chat_id)
+
+                if error is None:
+                    self.sent += 1
+                elif delay is None:
+                    self.failed += 1
+                    logging.error("Error sending a message to chat %s: %s", chat_id, error)
+
+                if delay is not None:
+                    self.retried += 1
+                    self._pending.setdefault(chat_id, deque()).appendleft(text)
+                    self._next_at[chat_id] = now + delay
+                else:
+                    self._next_at[chat_id] = now + self.chat_interval
+
+                if self._pending.get(chat_id):
+                    self._schedule(chat_id)
+                else:
+                    self._pending.pop(chat_id, None)
+                    self._prune(now)
+
+                self._condition.notify_all()
+
+    def _prune(self, now):
+        # Forgets the chats whose interval is over, keeping memory bounded by the active chats
+        if len(self._next_at) > 1024:
+            self._next_at = {chat_id: at for chat_id, at in self._next_at.items() if at > now}
+
+
+class Outbox:
+    """
+    Sends the messages queued in the database by other processes through a notification queue.
+
+    The standalone watchdog workers queue their alerts in the 'outbox' table, and the bot process holding
+    the sender lease claims them and hands them to its queue, so they all share its rate limits
+    and every user gets their alerts of a sweep in a single message, whichever workers found them.
+
+    Usage:
+        outbox = Outbox(notifications).start()
+        outbox.stop()
+    """
+
+    def __init__(self, notifications, owner=None, interval=OUTBOX_POLL, linger=OUTBOX_LINGER, ttl=OUTBOX_LEASE):
+        self.notifications = notifications
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+        self.interval = interval
+        self.linger = linger
+        self.ttl = ttl
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Starts the polling thread.
+        """
+        self._thread = threading.Thread(target=self._work, name="outbox", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops the polling thread, leaving the unclaimed messages to the next sender.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def drain(self, conn):
+        """
+        Claims the settled messages of the outbox, if this process is the sender, and queues them.
+
+        Returns:
+            int: The number of messages queued.
+        """
+        with conn:
+            messages = database.claim_outbox(conn, self.owner, self.ttl, time.time() - self.linger)
+        self.notifications.submit_many(messages)
+        return len(messages)
+
+    def _work(self):
+        try:
+            while not self._stopped.wait(self.interval):
+                try:
+                    self.drain(database.get_connection())
+                except sqlite3.Error as e:
+                    logging.error("Error reading the outbox: %s", e)
+        finally:
+            database.close_connection()
@@ -0,0 +1,496 @@
+import codecs
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from email.utils import mktime_tz, parsedate_tz
+
+import metrics
+from onionoo_client import onionoo_client
+
+
+# Onionoo details document and the fields the bot actually uses
+ONIONOO_DETAILS = "https://onionoo.torproject.org/details"
+RELAY_FIELDS = ("fingerprint", "running", "nickname", "country_name", "bandwidth_rate", "last_restarted",
+                "observed_bandwidth", "consensus_weight")
+
+# Groups of relays a user can watch with one subscription, named after the Onionoo parameters that select them
+GROUP_KINDS = ("family", "contact")
+
+# Onionoo refreshes its data once per hour
+CACHE_TTL = 3600
+CACHE_SIZE = 10000
+
+# Fingerprints per `lookup` request
+LOOKUP_BATCH = 100
+
+# Bytes read at a time when streaming the details document
+STREAM_CHUNK = 64 * 1024
+
+RELAYS_START = re.compile(r'"relays"\s*:\s*\[')
+RELAYS_PUBLISHED = re.compile(r'"relays_published"\s*:\s*"([^"]*)"')
+
+
+def parse_published(published):
+    """
+    Parses an Onionoo `relays_published` timestamp such as '2024-01-01 00:00:00', which is in UTC.
+
+    Returns:
+        datetime: The aware timestamp, or None if `published` is empty or malformed.
+    """
+    try:
+        return datetime.strptime(published, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
+    except (TypeError, ValueError):
+        return None
+
+
+def fetch_group_members(kind, value, base_url=ONIONOO_DETAILS):
+    """
+    Fetches the fingerprints of the relays of a family or of an operator with a single request.
+
+    Args:
+        kind (str): 'family', where `value` is the fingerprint of any member, or 'contact', where `value`
+            is matched against the contact lines of the relays.
+        value (str): The fingerprint or the contact text.
+        base_url (str): The URL of the Onionoo details document.
+
+    Returns:
+        list: The sorted upper-case fingerprints of the members.
+
+    Raises:
+        requests.RequestException: If the request fails or Onionoo answers with an error status.
+        ValueError: If `kind` is not one of GROUP_KINDS.
+
+    Note:
+        A family holds the relay itself and the relays sharing a mutual family declaration with it.
+        A contact matches the relays whose contact line contains every space-separated word of `value`,
+        ignoring case.
+    """
+    if kind not in GROUP_KINDS:
+        raise ValueError(f"Unknown relay group: {kind}")
+
+    params = {"type": "relay", "fields": "fingerprint", kind: value}
+    with metrics.upstream("onionoo", kind):
+        response = onionoo_client.get(base_url, params=params)
+        response.raise_for_status()
+        relays = response.json().get("relays", [])
+
+    return sorted(index_relays(relays))
+
+
+def index_relays(relays):
+    """
+    Builds an in-memory index of relay records keyed by fingerprint.
+
+    Args:
+        relays (list): The list of relay records of an Onionoo details document.
+
+    Returns:
+        dict: A dictionary mapping each upper-case relay fingerprint to its record.
+
+    Raises:
+        None
+    """
+    return {relay["fingerprint"].upper(): relay for relay in relays if "fingerprint" in relay}
+
+
+class RelayStreamParser:
+    """
+    Incremental parser of the `relays` array of an Onionoo details document.
+
+    The document is fed in chunks as it is downloaded. Every relay object is decoded on its own and
+    kept only if its fingerprint is watched, reduced to the requested fields, so memory holds one
+    relay and the watched ones instead of the whole document. With `watched` None every relay is kept.
+
+    Usage:
+        parser = RelayStreamParser(watched)
+        for chunk in response.iter_content(STREAM_CHUNK):
+            parser.feed(chunk)
+        relays = parser.close()
+    """
+
+    def __init__(self, watched, fields=RELAY_FIELDS):
+        self.watched = None if watched is None else {fingerprint.upper() for fingerprint in watched}
+        self.fields = fields
+        self.relays = {}
+        self.published = None
+        self._decoder = json.JSONDecoder()
+        self._text = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._in_relays = False
+        self._done = False
+
+    def feed(self, chunk):
+        """
+        Parses the relays completed by a new chunk of the document.
+        """
+        if self._done:
+            return
+        self._buffer += self._text.decode(chunk)
+
+        if not self._in_relays:
+            if self.published is None:
+                match = RELAYS_PUBLISHED.search(self._buffer)
+                if match:
+                    self.published = match.group(1)
+            match = RELAYS_START.search(self._buffer)
+            if match is None:
+                return
+            self._in_relays = True
+            self._buffer = self._buffer[match.end():]
+
+        self._parse()
+
+    def close(self):
+        """
+        Returns the watched relays, keyed by upper-case fingerprint.
+
+        Raises:
+            ValueError: If the document ended before the end of the `relays` array.
+        """
+        if not self._done:
+            raise ValueError("Truncated Onionoo details document")
+        return self.relays
+
+    def _parse(self):
+        buffer = self._buffer
+        position = 0
+
+        while True:
+            # Skipping the separators between two relays
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+            if position == len(buffer):
+                break
+            if buffer[position] == "]":
+                self._done = True
+                break
+
+            try:
+                relay, position = self._decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # The relay continues in the next chunk
+                break
+
+            fingerprint = relay.get("fingerprint", "").upper()
+            if fingerprint and (self.watched is None or fingerprint in self.watched):
+                self.relays[fingerprint] = {field: relay[field] for field in self.fields if field in relay}
+
+        self._buffer = "" if self._done else buffer[position:]
+
+
+class RelayCache:
+    """
+    Process-wide cache of Onionoo relay records keyed by fingerprint.
+
+    Records stay fresh for `ttl` seconds and at most `max_size` of them are kept, evicting the
+    least recently used ones. Stale records are revalidated with `If-Modified-Since`, so when
+    Onionoo has not published new data the answer is an empty 304 response.
+    Fingerprints unknown to Onionoo are cached as None.
+    """
+
+    def __init__(self, base_url=ONIONOO_DETAILS, ttl=CACHE_TTL, max_size=CACHE_SIZE, fields=RELAY_FIELDS):
+        self.base_url = base_url
+        self.ttl = ttl
+        self.max_size = max_size
+        self.fields = fields
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self._entries = OrderedDict()
+        self._document_modified = None
+        self._lock = threading.Lock()
+
+    def configure(self, base_url=None, ttl=None, max_size=None):
+        """
+        Changes the settings of the cache, keeping the records it already holds.
+        """
+        with self._lock:
+            if base_url is not None:
+                self.base_url = base_url
+            if ttl is not None:
+                self.ttl = ttl
+            if max_size is not None:
+                self.max_size = max_size
+                self._evict()
+
+    def clear(self):
+        """
+        Drops every record and resets the counters.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._document_modified = None
+            self.hits = self.misses = self.revalidations = 0
+
+    def stats(self):
+        """
+        Returns the hit, miss and revalidation counters and the number of cached records.
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "revalidations": self.revalidations,
+                "size": len(self._entries),
+            }
+
+    def lookup(self, fingerprint):
+        """
+        Returns the Onionoo record of a single relay.
+
+        Args:
+            fingerprint (str): The fingerprint of the relay.
+
+        Returns:
+            dict: The relay record, or None if Onionoo has no information about the fingerprint.
+
+        Raises:
+            requests.RequestException: If the record is not cached and the request to Onionoo fails.
+        """
+        key = fingerprint.upper()
+
+        with self._lock:
+            entry = self._fresh(key)
+            if entry is not None:
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            last_modified = self._entries[key][2] if key in self._entries else None
+
+        response = self._get({"lookup": key}, last_modified)
+
+        with self._lock:
+            if response.status_code == 304 and key in self._entries:
+                self.revalidations += 1
+                relay = self._entries[key][0]
+            else:
+                relays = response.json().get("relays", [])
+                relay = relays[0] if relays else None
+            self._store(key, relay, response.headers.get("Last-Modified", last_modified))
+
+        return relay
+
+    def lookup_many(self, fingerprints, batch_size=LOOKUP_BATCH):
+        """
+        Returns the Onionoo records of a few relays, fetching the missing ones with batched lookups.
+
+        Args:
+            fingerprints (iterable): The fingerprints of the relays.
+            batch_size (int): The number of fingerprints per `lookup` request.
+
+        Returns:
+            dict: A dictionary mapping each requested upper-case fingerprint to its record, or to None
+            if Onionoo has no information about it.
+
+        Raises:
+            requests.RequestException: If a record is not cached and the request to Onionoo fails.
+
+        Note:
+            Unlike `lookup_all`, which downloads the whole details document, this only asks Onionoo for
+            the missing fingerprints, so it suits the relays of a single user.
+            A batch whose records are all cached, but stale, is revalidated with `If-Modified-Since`,
+            and a 304 only renews them.
+        """
+        keys = list(dict.fromkeys(fingerprint.upper() for fingerprint in fingerprints))
+        relays = self.get_fresh(keys)
+        missing = [key for key in keys if key not in relays]
+
+        for i in range(0, len(missing), batch_size):
+            batch = missing[i:i + batch_size]
+            with self._lock:
+                last_modified = self._batch_modified(batch)
+
+            response = self._get({"lookup": ",".join(batch), "fields": ",".join(self.fields)}, last_modified)
+
+            with self._lock:
+                if response.status_code == 304 and all(key in self._entries for key in batch):
+                    self.revalidations += 1
+                    fetched = {key: self._entries[key][0] for key in batch}
+                else:
+                    index = index_relays(response.json().get("relays", []))
+                    fetched = {key: index.get(key) for key in batch}
+                last_modified = response.headers.get("Last-Modified", last_modified)
+                for key, relay in fetched.items():
+                    self._store(key, relay, last_modified)
+            relays.update(fetched)
+
+        return relays
+
+    def lookup_all(self, fingerprints):
+        """
+        Returns the Onionoo records of many relays, fetching them with at most one request.
+
+        Args:
+            fingerprints (iterable): The upper-case fingerprints of the relays.
+
+        Returns:
+            dict: A dictionary mapping each requested fingerprint to its record, or to None
+            if Onionoo has no information about it.
+
+        Raises:
+            requests.RequestException: If a record is not cached and the request to Onionoo fails.
+            ValueError: If the downloaded document is truncated or malformed.
+
+        Note:
+            When any record is missing or stale, the whole details document is downloaded once and
+            parsed as a stream with `RelayStreamParser`, keeping only the requested relays.
+            If every record is cached, the download is conditional and a 304 only renews them.
+        """
+        keys = set(fingerprints)
+
+        with self._lock:
+            fresh = {key: self._fresh(key) for key in keys}
+            if all(entry is not None for entry in fresh.values()):
+                self.hits += len(keys)
+                return {key: entry[0] for key, entry in fresh.items()}
+            self.misses += sum(1 for entry in fresh.values() if entry is None)
+            self.hits += sum(1 for entry in fresh.values() if entry is not None)
+            cached = all(key in self._entries for key in keys)
+            last_modified = self._document_modified if cached else None
+
+        params = {"type": "relay", "fields": ",".join(self.fields)}
+        response = self._get(params, last_modified, stream=True)
+        index = None
+
+        if response.status_code != 304:
+            # Streaming the document, keeping only the watched relays
+            parser = RelayStreamParser(keys, self.fields)
+            with metrics.upstream("onionoo", "details_body"), response:
+                for chunk in response.iter_content(STREAM_CHUNK):
+                    parser.feed(chunk)
+                index = parser.close()
+
+        with self._lock:
+            last_modified = response.headers.get("Last-Modified", last_modified)
+
+            if index is None:
+                self.revalidations += 1
+                relays = {key: self._entries[key][0] for key in keys if key in self._entries}
+            else:
+                relays = {key: index.get(key) for key in keys}
+
+            self._document_modified = last_modified
+            for key, relay in relays.items():
+                self._store(key, relay, last_modified)
+
+        return relays
+
+    def get_fresh(self, fingerprints):
+        """
+        Returns the cached records that are still fresh, without contacting Onionoo.
+
+        Args:
+            fingerprints (iterable): The upper-case fingerprints of the relays.
+
+        Returns:
+            dict: A dictionary mapping the fingerprints with a fresh record to that record.
+        """
+        with self._lock:
+            relays = {}
+            for key in fingerprints:
+                entry = self._fresh(key)
+                if entry is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+                    relays[key] = entry[0]
+            return relays
+
+    def peek(self, fingerprints):
+        """
+        Returns the cached records, fresh or not, without contacting Onionoo.
+
+        Args:
+            fingerprints (iterable): The fingerprints of the relays.
+
+        Returns:
+            dict: A dictionary mapping the upper-case fingerprints with a cached record to that record.
+
+        Note:
+            It serves the last known state of the relays while Onionoo cannot be reached.
+        """
+        with self._lock:
+            keys = (fingerprint.upper() for fingerprint in fingerprints)
+            return {key: self._entries[key][0] for key in keys if key in self._entries}
+
+    def version(self, relays):
+        """
+        Returns the `Last-Modified` of the Onionoo response the records of a lookup were stored from.
+
+        Args:
+            relays (dict): The records returned by `lookup_many` or `peek`, keyed by upper-case fingerprint.
+
+        Returns:
+            str: The `Last-Modified` header shared by every record, or None if they come from responses
+            with different ones, without one, or have been replaced in the cache since.
+        """
+        versions = set()
+        with self._lock:
+            for key, relay in relays.items():
+                entry = self._entries.get(key)
+                if entry is None or entry[0] is not relay or not entry[2]:
+                    return None
+                versions.add(entry[2])
+        return versions.pop() if len(versions) == 1 else None
+
+    def update(self, relays, last_modified=None):
+        """
+        Stores records fetched outside of the cache, such as by the asynchronous sweep.
+
+        Args:
+            relays (dict): A dictionary mapping upper-case fingerprints to their record or None.
+            last_modified (str): The `Last-Modified` header of the Onionoo response, if any.
+        """
+        with self._lock:
+            for key, relay in relays.items():
+                self._store(key, relay, last_modified)
+
+    def _get(self, params, last_modified, stream=False):
+        headers = {"If-Modified-Since": last_modified} if last_modified else {}
+        with metrics.upstream("onionoo", "lookup" if "lookup" in params else "details"):
+            response = onionoo_client.get(self.base_url, params=params, headers=headers, stream=stream)
+            if response.status_code != 304:
+                response.raise_for_status()
+        return response
+
+    def _batch_modified(self, keys):
+        # The oldest `Last-Modified` of the cached records, a 304 meaning none of them has changed since
+        dates = {}
+        for key in keys:
+            entry = self._entries.get(key)
+            if entry is None or not entry[2]:
+                return None
+            try:
+                dates[entry[2]] = mktime_tz(parsedate_tz(entry[2]))
+            except (TypeError, ValueError, OverflowError):
+                return None
+        return min(dates, key=dates.get) if dates else None
+
+    def _fresh(self, key):
+        entry = self._entries.get(key)
+        if entry is None or entry[1] <= time.monotonic():
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _store(self, key, relay, last_modified):
+        self._entries[key] = (relay, time.monotonic() + self.ttl, last_modified)
+        self._entries.move_to_end(key)
+        self._evict()
+
+    def _evict(self):
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+# Shared by the watchdog thread and the bot handlers
+relay_cache = RelayCache()
+
+# Cache effectiveness, read from the counters of the shared cache at every scrape
+CACHE_LOOKUPS = metrics.counter("torwatchdog_relay_cache_lookups_total", "Relay cache lookups by result.", ("result",))
+CACHE_LOOKUPS.set_function(lambda: relay_cache.hits, "hit")
+CACHE_LOOKUPS.set_function(lambda: relay_cache.misses, "miss")
+CACHE_LOOKUPS.set_function(lambda: relay_cache.revalidations, "revalidated")
@@ -0,0 +1,252 @@
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+
+# Seconds to open a connection to Onionoo and between two bytes of its answer
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 60
+
+# Attempts after the first one, and the base and cap in seconds of the jittered exponential backoff between them
+RETRIES = 3
+BACKOFF = 1.0
+BACKOFF_MAX = 30
+# Answers worth another attempt, Onionoo being overloaded or restarting
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+
+# Keep-alive connections kept open to Onionoo, one per thread making requests at the same time
+POOL_SIZE = 10
+
+# Failed requests in a row that open the circuit, and seconds before a trial request once it is open
+FAILURE_THRESHOLD = 5
+RESET_TIMEOUT = 300
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+RETRIES_TOTAL = metrics.counter("torwatchdog_onionoo_retries_total", "Onionoo requests attempted again by reason.", ("reason",))
+REJECTED = metrics.counter("torwatchdog_onionoo_rejected_total", "Onionoo requests refused at once while the circuit is open.")
+CIRCUIT_OPENED = metrics.counter("torwatchdog_onionoo_circuit_opened_total", "Times the Onionoo circuit has opened.")
+CIRCUIT_OPEN = metrics.gauge("torwatchdog_onionoo_circuit_open", "Whether the Onionoo circuit is open, 1, or closed, 0.")
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """
+    Raised instead of sending a request while the circuit to Onionoo is open.
+
+    It is a `requests.RequestException`, so the callers handle it as any other failed request.
+    """
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker counting the failed requests to an upstream service.
+
+    After `threshold` failures in a row the circuit opens and the requests are refused at once, so a
+    failing upstream is not hammered by every sweep and handler. Once `reset_timeout` seconds have
+    passed, a single trial request is let through: the circuit closes if it succeeds and stays open
+    for another `reset_timeout` otherwise.
+
+    Usage:
+        if breaker.allow():
+            ...
+            breaker.record_success()
+    """
+
+    def __init__(self, threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT, clock=time.monotonic):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        """
+        Returns CLOSED, OPEN, or HALF_OPEN once a trial request is allowed.
+        """
+        with self._lock:
+            return self._state()
+
+    def allow(self):
+        """
+        Returns whether a request may be sent, always while closed and once per `reset_timeout` while open.
+        """
+        with self._lock:
+            state = self._state()
+            if state == HALF_OPEN:
+                # The trial request, the others keep being refused until it has succeeded
+                self.opened_at = self.clock()
+                return True
+            return state == CLOSED
+
+    def record_success(self):
+        """
+        Closes the circuit after a successful request.
+        """
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        """
+        Counts a failed request, opening the circuit after `threshold` of them in a row or a failed trial request.
+        """
+        with self._lock:
+            self.failures += 1
+            if self.opened_at is not None or self.failures >= self.threshold:
+                if self.opened_at is None:
+                    CIRCUIT_OPENED.inc()
+                self.opened_at = self.clock()
+
+    def retry_after(self):
+        """
+        Returns the seconds before the next trial request, 0 while the circuit is closed.
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return 0
+            return max(0, self.opened_at + self.reset_timeout - self.clock())
+
+    def _state(self):
+        if self.opened_at is None:
+            return CLOSED
+        if self.clock() - self.opened_at < self.reset_timeout:
+            return OPEN
+        return HALF_OPEN
+
+
+class OnionooClient:
+    """
+    Shared HTTP client of Onionoo, used by the relay cache, the mirror and the group expansion.
+
+    Requests go through one `requests.Session`, whose pool keeps up to `pool_size` keep-alive
+    connections open, so repeated lookups skip the TCP and TLS handshakes. Every request has a
+    connect and a read timeout, so a hung connection fails instead of freezing the watchdog.
+    Connection errors, timeouts and the RETRY_STATUSES answers are attempted again up to `retries`
+    times, after a jittered exponential backoff or the `Retry-After` delay of a 429 answer.
+    Requests that still fail are counted by `breaker`, which refuses the next ones with
+    `CircuitOpenError` while Onionoo is down.
+
+    Usage:
+        response = onionoo_client.get(ONIONOO_DETAILS, params={"lookup": fingerprint})
+        response.raise_for_status()
+    """
+
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, retries=RETRIES, backoff=BACKOFF,
+                 backoff_max=BACKOFF_MAX, pool_size=POOL_SIZE, breaker=None):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker()
+        self.session = requests.Session()
+        self._mount(pool_size)
+
+    def configure(self, connect_timeout=None, read_timeout=None, retries=None, backoff=None, pool_size=None,
+                  failure_threshold=None, reset_timeout=None):
+        """
+        Changes the settings of the client and of its circuit breaker.
+        """
+        if connect_timeout is not None:
+            self.connect_timeout = connect_timeout
+        if read_timeout is not None:
+            self.read_timeout = read_timeout
+        if retries is not None:
+            self.retries = retries
+        if backoff is not None:
+            self.backoff = backoff
+        if pool_size is not None:
+            self._mount(pool_size)
+        if failure_threshold is not None:
+            self.breaker.threshold = failure_threshold
+        if reset_timeout is not None:
+            self.breaker.reset_timeout = reset_timeout
+
+    def get(self, url, params=None, headers=None, stream=False, timeout=None):
+        """
+        Sends a GET request to Onionoo, attempting it again on transient failures.
+
+        Args:
+            url (str): The URL of the Onionoo document.
+            params (dict): The query parameters.
+            headers (dict): The request headers, such as `If-Modified-Since`.
+            stream (bool): Whether the body is read by the caller as a stream.
+            timeout (float or tuple): The timeout of the request, the client's connect and read timeouts by default.
+
+        Returns:
+            requests.Response: The response, whose status the caller checks with `raise_for_status`.
+            It is the last one received when every attempt has been answered with one of RETRY_STATUSES.
+
+        Raises:
+            CircuitOpenError: If the circuit is open, without sending any request.
+            requests.RequestException: If the last attempt failed without an answer, such as on a timeout.
+
+        Note:
+            A 4xx answer other than 429 means that Onionoo is up, it is returned at once and closes the circuit.
+            The backoff blocks the calling thread, at most `retries * backoff_max` seconds in total.
+        """
+        if not self.breaker.allow():
+            REJECTED.inc()
+            raise CircuitOpenError(f"Onionoo circuit open, next attempt in {self.breaker.retry_after():.0f} seconds")
+
+        timeout = timeout or (self.connect_timeout, self.read_timeout)
+        for attempt in range(self.retries + 1):
+            error = response = delay = None
+            try:
+                response = self.session.get(url, params=params, headers=headers, stream=stream, timeout=timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    self.breaker.record_success()
+                    return response
+                delay = retry_after(response)
+
+            if attempt == self.retries:
+                break
+            RETRIES_TOTAL.inc("timeout" if isinstance(error, requests.Timeout) else "connection" if error else str(response.status_code))
+            if response is not None:
+                response.close()
+            time.sleep(self.delay(attempt, delay))
+
+        self.breaker.record_failure()
+        if error is not None:
+            raise error
+        return response
+
+    def delay(self, attempt, retry_after=None):
+        """
+        Returns the seconds to wait before attempting a request again, with full jitter, or the delay asked by Onionoo.
+        """
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff * 2 ** attempt))
+
+    def _mount(self, pool_size):
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+
+def retry_after(response):
+    """
+    Returns the seconds of the `Retry-After` header of a response, or None if it has none or it is a date.
+    """
+    try:
+        return max(0.0, float(response.headers["Retry-After"]))
+    except (KeyError, ValueError):
+        return None
+
+
+# Shared by every thread of a process, so that they reuse its connections and trip the same circuit
+onionoo_client = OnionooClient()
+CIRCUIT_OPEN.set_function(lambda: int(onionoo_client.breaker.state != CLOSED))
@@ -0,0 +1,531 @@
+import sys
+import threading
+from array import array
+from bisect import bisect_left
+
+import database
+
+
+class IntSet:
+    """
+    Set of integers stored as a sorted array of 64-bit values.
+
+    It takes 8 bytes per member instead of the ~60 bytes of a Python set entry and its int object,
+    at the price of O(n) insertions and removals, which is fine for the subscribers of one relay.
+    """
+
+    __slots__ = ("_values",)
+
+    def __init__(self, values=()):
+        self._values = array("q", sorted(set(values)))
+
+    def add(self, value):
+        """
+        Adds a value, returning False if it was already there.
+        """
+        i = bisect_left(self._values, value)
+        if i < len(self._values) and self._values[i] == value:
+            return False
+        self._values.insert(i, value)
+        return True
+
+    def discard(self, value):
+        """
+        Removes a value, returning False if it was not there.
+        """
+        i = bisect_left(self._values, value)
+        if i == len(self._values) or self._values[i] != value:
+            return False
+        del self._values[i]
+        return True
+
+    def difference(self, other):
+        """
+        Returns the values missing from the IntSet `other`, in order.
+        """
+        if self._values == other._values:
+            return []
+        return [value for value in self._values if value not in other]
+
+    def __contains__(self, value):
+        i = bisect_left(self._values, value)
+        return i < len(self._values) and self._values[i] == value
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+
+def relay_digest(running, last_restarted):
+    """
+    Returns a digest of the fields of a relay kept in 'relay_state', equal for two sweeps that found it unchanged.
+    """
+    return hash((running, last_restarted))
+
+
+class RelayState:
+    """
+    Last known state of a watched relay, mirroring a row of the 'relay_state' table.
+
+    The `last_restarted` timestamp is only kept as part of `digest`, which the sweeps compare
+    with the digest of the fetched record to skip an unchanged relay.
+    """
+
+    __slots__ = ("running", "last_seen", "digest", "consensus")
+
+    def __init__(self, running=None, last_seen=None, last_restarted=None, consensus=None):
+        self.running = running
+        self.last_seen = last_seen
+        self.digest = relay_digest(running, last_restarted)
+        self.consensus = consensus
+
+
+class RelayIndex:
+    """
+    In-memory index of the subscriptions and of the watched relays.
+
+    It maps every watched fingerprint to its `RelayState` and to the IDs of its subscribers, and every
+    registered user to the fingerprints they watch. It is loaded from the database at startup, then `sync`
+    replays the changes every process has logged in 'subscription_log' since, so that the handlers and
+    the sweeps read it instead of SQLite whichever process has changed the subscriptions.
+    Fingerprints are upper case and shared between the maps, so each one is stored once.
+
+    Users may also watch a group of relays, a ('family', fingerprint) or a ('contact', text) pair, with a
+    single subscription. The members of every group are set by the process that expands it, and read
+    from 'relay_groups' by the others when they replay the change. A relay is watched by its own
+    subscribers and by those of the groups it belongs to.
+
+    In the index of a process that sweeps, created with `track_arrivals`, the users who started watching
+    a relay since it was last swept, by subscribing to it or to a group it belongs to, are kept until
+    the next sweep takes them with `pop_arrivals`, so that they are told when it is already down.
+    The other processes, such as a bot whose relays are swept by the standalone watchdog, keep none.
+    """
+
+    def __init__(self, track_arrivals=False):
+        self.track_arrivals = track_arrivals
+        self.consensus = None
+        self.version = 0
+        self.swept = None
+        self._subscribers = {}
+        self._states = {}
+        self._users = {}
+        self._groups = {}
+        self._user_groups = {}
+        self._members = {}
+        self._member_of = {}
+        self._accept = None
+        self._arrivals = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+        # Held while reading and applying the log, so that the changes are applied once and in order
+        self._sync_lock = threading.RLock()
+
+    def load(self, conn, accept=None):
+        """
+        Replaces the content of the index with the subscriptions, the group members and the relay states of the database.
+
+        Args:
+            conn (sqlite3.Connection): The connection to the database.
+            accept (callable): A function taking an upper-case fingerprint and returning whether
+                the index keeps it, such as the shard filter of a watchdog worker. All are kept by default.
+                It applies to the members of the groups too, while the group subscriptions are all kept.
+
+        Returns:
+            None
+
+        Raises:
+            sqlite3.Error: If the database cannot be read.
+
+        Note:
+            The version of the log is read first, so a change made while the tables are read is replayed
+            by the next `sync` even if the load has already seen it, which does no harm.
+        """
+        with self._sync_lock:
+            self._load(conn, accept, database.subscription_version(conn))
+
+    def _load(self, conn, accept, version):
+        users = {user_id: [] for user_id, in conn.execute('SELECT TelegramUserID FROM TorWatchdog')}
+        subscribers = {}
+
+        last, keep = None, True
+        for user_id, fingerprint in database.subscription_rows(conn):
+            # Rows come grouped by fingerprint, so each one is tested once
+            if accept is not None and fingerprint != last:
+                last, keep = fingerprint, accept(fingerprint)
+            if not keep:
+                continue
+            # Interned so that the forward and reverse maps share one string per relay
+            fingerprint = sys.intern(fingerprint)
+            users.setdefault(user_id, []).append(fingerprint)
+            subscribers.setdefault(fingerprint, []).append(user_id)
+
+        groups = {}
+        user_groups = {}
+        for user_id, kind, value in database.group_subscription_rows(conn):
+            groups.setdefault((kind, value), []).append(user_id)
+            user_groups.setdefault(user_id, []).append((kind, value))
+
+        members = {}
+        member_of = {}
+        for key, fingerprints in database.relay_groups(conn).items():
+            if key in groups:
+                members[key] = self._filter(fingerprints, accept)
+                for fingerprint in members[key]:
+                    member_of.setdefault(fingerprint, []).append(key)
+
+        states = {}
+        for fingerprint, running, last_seen, last_restarted, consensus in conn.execute(
+                'SELECT fingerprint, running, last_seen, last_restarted, consensus FROM relay_state'):
+            if fingerprint in subscribers or fingerprint in member_of:
+                running = None if running is None else bool(running)
+                states[sys.intern(fingerprint)] = RelayState(running, last_seen, last_restarted, consensus)
+
+        subscribers = {fingerprint: IntSet(ids) for fingerprint, ids in subscribers.items()}
+        groups = {key: IntSet(ids) for key, ids in groups.items()}
+
+        with self._lock:
+            # The subscriptions made by another process since the last load, such as the bot's for a watchdog worker
+            self._arrivals = self._reload_arrivals(subscribers, groups, member_of) if self._loaded and self.track_arrivals else {}
+            self._loaded = True
+            self.version = version
+            self._users = users
+            self._subscribers = subscribers
+            self._groups = groups
+            self._user_groups = user_groups
+            self._members = members
+            self._member_of = member_of
+            self._accept = accept
+            self._states = states
+            # The consensus of the relays kept, other shards may have been swept more recently
+            self.consensus = max((state.consensus for state in states.values() if state.consensus), default=None)
+
+    def sync(self, conn):
+        """
+        Applies the changes of the subscriptions logged since the last load or sync, by any process.
+
+        Args:
+            conn (sqlite3.Connection): The connection to the database.
+
+        Returns:
+            int: The number of changes read from the log.
+
+        Raises:
+            sqlite3.Error: If the log cannot be read.
+
+        Note:
+            Up to date, it costs one indexed read of the log, which finds nothing.
+            The changes are replayed in order and each of them is idempotent, so the changes this process has
+            already applied are replayed harmlessly. If the log has been pruned past the last change applied,
+            after a long idle, the whole index is loaded again instead.
+        """
+        with self._sync_lock:
+            changes = database.subscription_changes(conn, self.version)
+            if changes and changes[0][0] != self.version + 1:
+                self._load(conn, self._accept, database.subscription_version(conn))
+                return len(changes)
+
+            for seq, change, user_id, kind, value in changes:
+                if change == "register":
+                    self.register(user_id)
+                elif kind is None and self._accept is not None and not self._accept(value):
+                    # A relay of a shard that another watchdog worker sweeps
+                    pass
+                elif change == "add":
+                    self.add(user_id, value)
+                elif change == "remove":
+                    self.remove(user_id, value)
+                elif change == "add_group":
+                    self.add_group(user_id, kind, value)
+                elif change == "remove_group":
+                    self.remove_group(user_id, kind, value)
+                elif change == "members":
+                    # The members as they are now, a later change of the same group sets them again
+                    members = database.relay_group(conn, kind, value)
+                    if members is not None:
+                        self.set_members(kind, value, members)
+                self.version = seq
+            return len(changes)
+
+    def register(self, user_id):
+        """
+        Records a registered user without relays.
+        """
+        with self._lock:
+            self._users.setdefault(user_id, [])
+
+    def is_registered(self, user_id):
+        """
+        Returns whether the user has been registered with the /start command.
+        """
+        return user_id in self._users
+
+    def add(self, user_id, fingerprint):
+        """
+        Adds a subscription, returning False if it was already there.
+        """
+        fingerprint = sys.intern(fingerprint.upper())
+        with self._lock:
+            subscribers = self._subscribers.get(fingerprint)
+            if subscribers is None:
+                subscribers = self._subscribers[fingerprint] = IntSet()
+            if not subscribers.add(user_id):
+                return False
+            self._users.setdefault(user_id, []).append(fingerprint)
+            if self.track_arrivals and not self._watches_through_groups(user_id, fingerprint):
+                self._arrivals.setdefault(fingerprint, set()).add(user_id)
+            return True
+
+    def remove(self, user_id, fingerprint):
+        """
+        Removes a subscription, returning False if it was not there.
+        """
+        fingerprint = fingerprint.upper()
+        with self._lock:
+            subscribers = self._subscribers.get(fingerprint)
+            if subscribers is None or not subscribers.discard(user_id):
+                return False
+            if not subscribers:
+                del self._subscribers[fingerprint]
+                if fingerprint not in self._member_of:
+                    self._states.pop(fingerprint, None)
+                    self._arrivals.pop(fingerprint, None)
+            self._users[user_id].remove(fingerprint)
+            return True
+
+    def add_group(self, user_id, kind, value):
+        """
+        Adds a subscription to a family or contact group, returning False if it was already there.
+        """
+        key = (kind, value)
+        with self._lock:
+            users = self._groups.get(key)
+            if users is None:
+                users = self._groups[key] = IntSet()
+            if not users.add(user_id):
+                return False
+            self._user_groups.setdefault(user_id, []).append(key)
+            for fingerprint in self._members.get(key, ()) if self.track_arrivals else ():
+                if user_id not in self._subscribers.get(fingerprint, ()) and not self._watches_through_groups(user_id, fingerprint, key):
+                    self._arrivals.setdefault(fingerprint, set()).add(user_id)
+            return True
+
+    def remove_group(self, user_id, kind, value):
+        """
+        Removes a subscription to a family or contact group, returning False if it was not there.
+        """
+        key = (kind, value)
+        with self._lock:
+            users = self._groups.get(key)
+            if users is None or not users.discard(user_id):
+                return False
+            self._user_groups[user_id].remove(key)
+            if not users:
+                del self._groups[key]
+                self._set_members(key, ())
+            return True
+
+    def has_group(self, kind, value):
+        """
+        Returns whether anyone watches the group, in which case its members are already known.
+        """
+        return (kind, value) in self._groups
+
+    def groups(self):
+        """
+        Returns the (kind, value) groups watched by at least one user.
+        """
+        with self._lock:
+            return list(self._groups)
+
+    def set_members(self, kind, value, fingerprints):
+        """
+        Replaces the members of a watched group with the upper-case fingerprints found by a sweep.
+        """
+        key = (kind, value)
+        with self._lock:
+            if key in self._groups:
+                self._set_members(key, self._filter(fingerprints, self._accept))
+
+    def group_members(self, kind, value):
+        """
+        Returns the known members of a group.
+        """
+        with self._lock:
+            return self._members.get((kind, value), ())
+
+    def user_groups(self, user_id):
+        """
+        Returns the sorted (kind, value, members) groups watched by the user, with their number of members.
+        """
+        with self._lock:
+            return sorted((kind, value, len(self._members.get((kind, value), ())))
+                          for kind, value in self._user_groups.get(user_id, ()))
+
+    def user_relays(self, user_id):
+        """
+        Returns the sorted fingerprints watched by the user, directly or as members of their groups.
+        """
+        with self._lock:
+            fingerprints = set(self._users.get(user_id, ()))
+            for key in self._user_groups.get(user_id, ()):
+                fingerprints.update(self._members.get(key, ()))
+            return sorted(fingerprints)
+
+    def user_fingerprints(self, user_id):
+        """
+        Returns the sorted fingerprints watched by the user.
+        """
+        with self._lock:
+            return sorted(self._users.get(user_id, ()))
+
+    def fingerprints(self):
+        """
+        Returns the fingerprints watched by at least one user, directly or through a group.
+        """
+        with self._lock:
+            if not self._member_of:
+                return list(self._subscribers)
+            return list(self._subscribers.keys() | self._member_of.keys())
+
+    def subscribers(self, fingerprint):
+        """
+        Returns the IDs of the users watching the relay, directly or through a group.
+        """
+        with self._lock:
+            users = list(self._subscribers.get(fingerprint, ()))
+            groups = self._member_of.get(fingerprint)
+            if not groups:
+                return users
+            users = set(users)
+            for key in groups:
+                users.update(self._groups.get(key, ()))
+            return list(users)
+
+    def state(self, fingerprint):
+        """
+        Returns the last known `RelayState` of the relay, or None if it has never been swept.
+        """
+        return self._states.get(fingerprint)
+
+    def pop_arrivals(self, fetched):
+        """
+        Returns the users who started watching the fetched relays since they were last swept, forgetting them.
+
+        Args:
+            fetched (dict): The relays about to be swept, keyed by upper-case fingerprint.
+
+        Returns:
+            dict: The set of the IDs of the new watchers still watching each relay, for the relays that have some.
+        """
+        with self._lock:
+            arrivals = {}
+            for fingerprint in [fingerprint for fingerprint in self._arrivals if fingerprint in fetched]:
+                users = self._arrivals.pop(fingerprint) & self._watchers(fingerprint, self._subscribers, self._groups, self._member_of)
+                if users:
+                    arrivals[fingerprint] = users
+            return arrivals
+
+    def update_states(self, states, consensus=None, swept=None):
+        """
+        Stores the (fingerprint, running, last_seen, last_restarted, consensus) tuples of a sweep.
+
+        Args:
+            states (iterable): The states of the relays that have changed since the last sweep.
+            consensus (str): The Onionoo `relays_published` timestamp of the sweep, if known.
+            swept (str): The time of the sweep, which the next one reports as the `last_seen` of the relays going down.
+
+        Note:
+            A None `last_seen` keeps the one already known, like `database.save_relay_states`.
+        """
+        with self._lock:
+            for fingerprint, running, last_seen, last_restarted, state_consensus in states:
+                if fingerprint not in self._subscribers and fingerprint not in self._member_of:
+                    continue
+                state = self._states.get(fingerprint)
+                if state is None:
+                    state = self._states[fingerprint] = RelayState()
+                state.running = running
+                state.last_seen = last_seen or state.last_seen
+                state.digest = relay_digest(running, last_restarted)
+                state.consensus = state_consensus
+                self._advance(state_consensus)
+            # Recorded even when no relay has changed, so that the same consensus is not swept twice
+            self._advance(consensus)
+            if swept is not None:
+                self.swept = swept
+
+    def __len__(self):
+        """
+        Returns the number of subscriptions, counting a group subscription once.
+        """
+        with self._lock:
+            return (sum(len(subscribers) for subscribers in self._subscribers.values())
+                    + sum(len(users) for users in self._groups.values()))
+
+    def _watches_through_groups(self, user_id, fingerprint, exclude=None):
+        # Whether the user watches the relay as a member of a group other than `exclude`
+        return any(user_id in self._groups.get(key, ()) for key in self._member_of.get(fingerprint, ()) if key != exclude)
+
+    @staticmethod
+    def _watchers(fingerprint, subscribers, groups, member_of):
+        users = set(subscribers.get(fingerprint, ()))
+        for key in member_of.get(fingerprint, ()):
+            users.update(groups.get(key, ()))
+        return users
+
+    def _reload_arrivals(self, subscribers, groups, member_of):
+        # The new watchers a reload brings to the relays already watched, with those still waiting for a sweep
+        arrivals = {}
+        for fingerprint in subscribers.keys() | member_of.keys():
+            if fingerprint not in self._subscribers and fingerprint not in self._member_of:
+                # Watched here for the first time, such as in a shard just taken over: its state tells whether it is new
+                continue
+            if fingerprint in member_of or fingerprint in self._member_of:
+                watchers = self._watchers(fingerprint, subscribers, groups, member_of)
+                users = watchers - self._watchers(fingerprint, self._subscribers, self._groups, self._member_of)
+            else:
+                watchers = subscribers[fingerprint]
+                users = set(watchers.difference(self._subscribers[fingerprint]))
+            users.update(user_id for user_id in self._arrivals.get(fingerprint, ()) if user_id in watchers)
+            if users:
+                arrivals[fingerprint] = users
+        return arrivals
+
+    def _advance(self, consensus):
+        if consensus is not None and (self.consensus is None or consensus > self.consensus):
+            self.consensus = consensus
+
+    @staticmethod
+    def _filter(fingerprints, accept):
+        # Interned like the fingerprints of the direct subscriptions
+        return tuple(dict.fromkeys(sys.intern(fingerprint) for fingerprint in fingerprints if accept is None or accept(fingerprint)))
+
+    def _set_members(self, key, members):
+        previous = self._members.pop(key, ())
+        for fingerprint in previous:
+            groups = self._member_of[fingerprint]
+            groups.remove(key)
+            if not groups:
+                del self._member_of[fingerprint]
+        if members:
+            self._members[key] = members
+            for fingerprint in members:
+                self._member_of.setdefault(fingerprint, []).append(key)
+
+        # The users of the group start watching the relays joining it, unless they already did
+        joined = set(members).difference(previous) if self.track_arrivals else ()
+        for user_id in self._groups.get(key, ()) if joined else ():
+            for fingerprint in joined:
+                if user_id not in self._subscribers.get(fingerprint, ()) and not self._watches_through_groups(user_id, fingerprint, key):
+                    self._arrivals.setdefault(fingerprint, set()).add(user_id)
+
+        # Forgetting the state of the relays no longer watched by anyone
+        for fingerprint in previous:
+            if fingerprint not in self._member_of and fingerprint not in self._subscribers:
+                self._states.pop(fingerprint, None)
+                self._arrivals.pop(fingerprint, None)
+
+# Shared by the watchdog thread and the bot handlers
+relay_index = RelayIndex()
@@ -0,0 +1,291 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+
+# Characters with a meaning in MarkdownV2, escaped with a backslash outside of code spans
+MARKDOWN_SPECIAL = "_*[]()~`>#+-=|{}.!\\"
+MARKDOWN_ESCAPES = str.maketrans({character: "\\" + character for character in MARKDOWN_SPECIAL})
+# Rendered cards kept, one per relay
+CARDS_SIZE = 20000
+# Zero-padded hours, minutes and seconds of the uptimes, cheaper to index than to format
+TWO_DIGITS = tuple(f"{number:02d}" for number in range(60))
+# Onionoo timestamps are naive UTC times
+EPOCH = datetime(1970, 1, 1)
+
+
+def escape_markdown(text):
+    """
+    Escapes every MarkdownV2 special character of a text in a single pass.
+    """
+    return str(text).translate(MARKDOWN_ESCAPES)
+
+
+def describe_group(kind, value, capitalize=False):
+    """
+    Returns the MarkdownV2 name of a family or operator, such as "the family of `ABC...`",
+    starting with "The" when `capitalize` is True, without touching the fingerprint or the contact.
+    """
+    article = "The" if capitalize else "the"
+    if kind == "family":
+        return f"{article} family of `{value}`"
+    return f"{article} operator {escape_markdown(value)}"
+
+
+def convert_bandwidth(bandwidth_rate):
+    """
+    Converts the given bandwidth rate to a human-readable format.
+
+    Args:
+        bandwidth_rate (int): The bandwidth rate to be converted, in bytes per second.
+
+    Returns:
+        str: A string representing the converted bandwidth rate in a human-readable format.
+
+    Raises:
+        None
+
+    Note:
+        This function calculates the appropriate unit prefix (Bytes, KBytes, MBytes, GBytes)
+        for the given bandwidth rate and formats the result accordingly.
+    """
+    # Define prefixes for unit measurements
+    prefixes = {
+        0: 'Bytes',
+        1: 'KBytes',
+        2: 'MBytes',
+        3: 'GBytes'
+    }
+
+    # Initialize the prefix index
+    prefix_index = 0
+
+    # Calculate the correct prefix
+    while bandwidth_rate >= 1024 and prefix_index < 3:
+        bandwidth_rate /= 1024
+        prefix_index += 1
+
+    # Format the result
+    result = f"{bandwidth_rate:.2f} {prefixes[prefix_index]}"
+
+    return result
+
+
+def format_uptime(raw):
+    """
+    Formats an uptime given in seconds, such as "2 months, 3 days, 04:05:06".
+
+    Args:
+        raw (float): The uptime in seconds.
+
+    Returns:
+        str: A string representing the uptime in a human-readable format.
+
+    Raises:
+        None
+
+    Note:
+        It converts the time difference into days, hours, minutes, and seconds, and formats the result accordingly.
+        If the uptime exceeds one month, it also calculates the number of months.
+        The result holds no MarkdownV2 special character.
+    """
+    days, remaining = divmod(int(raw), 24 * 3600)
+    hours, remaining = divmod(remaining, 3600)
+    minutes, seconds = divmod(remaining, 60)
+
+    # Calculate the number of months
+    months, remaining_days = divmod(days, 30)
+
+    # Format the output
+    clock = f"{TWO_DIGITS[hours]}:{TWO_DIGITS[minutes]}:{TWO_DIGITS[seconds]}"
+    if months > 0:
+        return f"{months} months, {remaining_days} days, {clock}"
+    if days > 0:
+        return f"{remaining_days} days, {clock}"
+    return clock
+
+
+def get_uptime(last_restarted):
+    """
+    Calculates the uptime based on the last restart time.
+
+    Args:
+        last_restarted (str): The timestamp of the last restart in ISO 8601 format.
+
+    Returns:
+        str: A string representing the uptime in a human-readable format.
+
+    Raises:
+        ValueError: If the timestamp is not in ISO 8601 format.
+
+    Note:
+        This function calculates the uptime based on the difference between the current time and the last restart time,
+        both in UTC, and formats it with `format_uptime`.
+    """
+    return format_uptime(time.time() - (datetime.fromisoformat(last_restarted) - EPOCH).total_seconds())
+
+
+def restart_timestamp(last_restarted):
+    """
+    Returns the POSIX timestamp of an Onionoo `last_restarted` UTC time, or None if it is missing or malformed.
+    """
+    try:
+        return (datetime.fromisoformat(last_restarted) - EPOCH).total_seconds()
+    except (TypeError, ValueError):
+        return None
+
+
+def render_card(fingerprint, relay):
+    """
+    Renders the part of a relay status card that only changes with the relay data.
+
+    Args:
+        fingerprint (str): The fingerprint of the relay.
+        relay (dict): The Onionoo record of the relay.
+
+    Returns:
+        tuple: The MarkdownV2 card up to the "Uptime: " label, and the restart timestamp the uptime is
+        computed from, None if the record has none.
+
+    Raises:
+        None
+    """
+    bandwidth_rate = relay.get('bandwidth_rate')
+    bandwidth = 'N/A' if bandwidth_rate is None else f"{convert_bandwidth(bandwidth_rate)} bytes/s"
+
+    card = f"Fingerprint: `{fingerprint}`\n" \
+           f"Status: {'Running ✅' if relay.get('running') else 'Offline ❌'}\n" \
+           f"Nickname: {escape_markdown(relay.get('nickname', 'N/A'))}\n" \
+           f"Country: {escape_markdown(relay.get('country_name', 'N/A'))}\n" \
+           f"Bandwidth: {escape_markdown(bandwidth)}\n" \
+           f"Uptime: "
+    return card, restart_timestamp(relay.get('last_restarted'))
+
+
+def format_history(fingerprint, history, now=None):
+    """
+    Renders the availability of a relay and its recent outages, as returned by `history.relay_history`.
+
+    Args:
+        fingerprint (str): The fingerprint of the relay.
+        history (dict): The sums of the rollups of every period and the (started, ended) times of the outages.
+        now (float): The current POSIX time the ongoing outage is measured at, the system clock by default.
+
+    Returns:
+        str: The MarkdownV2 message to send to the user.
+
+    Raises:
+        None
+
+    Note:
+        The availability is the share of the sweeps that found the relay running, and the bandwidth
+        the average of the observed bandwidths reported by Onionoo over the same sweeps.
+    """
+    if not history["windows"][-1][1]:
+        return f"No history available for fingerprint: `{fingerprint}`\n" \
+               r"Only the relays watched by someone are recorded, once per sweep\."
+
+    now = time.time() if now is None else now
+    lines = [f"Availability of `{fingerprint}`"]
+
+    for label, observations, running, bandwidth, _ in history["windows"]:
+        if observations:
+            average = convert_bandwidth(bandwidth / observations)
+            lines.append(escape_markdown(f"Last {label}: {running / observations:.1%} up, "
+                                         f"{average}/s on average ({observations} checks)"))
+        else:
+            lines.append(escape_markdown(f"Last {label}: no data"))
+
+    lines.append("")
+    if history["outages"]:
+        lines.append("Outages:")
+    else:
+        lines.append("No outage in the last 30 days")
+    for started, ended in history["outages"]:
+        start = f"{EPOCH + timedelta(seconds=started):%Y-%m-%d %H:%M}"
+        if ended is None:
+            outage = f"since {start} UTC, ongoing ({format_uptime(now - started)})"
+        else:
+            outage = f"{start} to {EPOCH + timedelta(seconds=ended):%Y-%m-%d %H:%M} UTC ({format_uptime(ended - started)})"
+        lines.append(rf"\- {escape_markdown(outage)}")
+    return "\n".join(lines)
+
+
+class RelayCards:
+    """
+    Cache of the rendered status cards of the relays, keyed by fingerprint.
+
+    A card is rendered once per relay and consensus version, the `relays_published` timestamp of the
+    data it comes from, with its text already escaped for MarkdownV2. Only the uptime, which changes
+    with every request, is appended when the card is served, so answering "Status Nodes" for a relay
+    watched by many users is a dictionary lookup and a string concatenation.
+    At most `max_size` cards are kept, evicting the oldest ones. A cache hit takes no lock, the counters
+    are only indicative.
+
+    Usage:
+        text = relay_cards.render(fingerprint, relay, published)
+    """
+
+    def __init__(self, max_size=CARDS_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._cards = OrderedDict()
+        self._lock = threading.Lock()
+
+    def render(self, fingerprint, relay, version=None, now=None):
+        """
+        Returns the MarkdownV2 status card of a relay.
+
+        Args:
+            fingerprint (str): The fingerprint of the relay.
+            relay (dict): The Onionoo record of the relay, or None if Onionoo has no information about it.
+            version (str): The consensus version of the record, such as its `relays_published` timestamp.
+                None when it is unknown, in which case the card is rendered without being cached.
+            now (float): The current POSIX time the uptime is computed at, the system clock by default.
+
+        Returns:
+            str: A string containing the status information of the relay in a formatted manner.
+
+        Raises:
+            None
+        """
+        if relay is None:
+            return f"No information available for fingerprint: `{fingerprint}`"
+
+        if version is None:
+            card, restarted = render_card(fingerprint, relay)
+        else:
+            entry = self._cards.get(fingerprint)
+            if entry is not None and entry[0] == version:
+                self.hits += 1
+            else:
+                entry = (version,) + render_card(fingerprint, relay)
+                with self._lock:
+                    self.misses += 1
+                    # A new consensus renders the card again in place, keeping its position
+                    self._cards[fingerprint] = entry
+                    while len(self._cards) > self.max_size:
+                        self._cards.popitem(last=False)
+            _, card, restarted = entry
+
+        if restarted is None:
+            return card + "N/A"
+        return card + format_uptime((now if now is not None else time.time()) - restarted)
+
+    def clear(self):
+        """
+        Drops every card and resets the counters.
+        """
+        with self._lock:
+            self._cards.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._cards)
+
+
+# Shared by the bot handlers of a process
+relay_cards = RelayCards()
@@ -0,0 +1,116 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+
+from onionoo import parse_published
+
+
+# Onionoo publishes new relay data once per hour, a few minutes after the consensus
+CONSENSUS_INTERVAL = 3600
+PUBLICATION_DELAY = 300
+# Sweeps never run closer than this, even when Onionoo is late
+MIN_INTERVAL = 300
+# Waits after a failed sweep, doubled at each consecutive failure
+RETRY_DELAY = 60
+MAX_RETRY_DELAY = 3600
+
+
+class SweepScheduler:
+    """
+    Runs the watchdog sweeps aligned to Onionoo's hourly publication instead of on a fixed sleep.
+
+    The next sweep is due one `interval` plus `delay` after the consensus of the last sweep, so
+    outages are reported within about an hour and the sweep duration does not shift the schedule.
+    After a downtime the consensus of the last sweep is already old, so a catch-up sweep runs at once.
+    A failed sweep is logged and retried with exponential backoff instead of stopping the watchdog.
+    The scheduler can be stopped from any thread with `stop`.
+
+    Usage:
+        scheduler = SweepScheduler(lambda: index.consensus)
+        await scheduler.run(sweep)
+    """
+
+    def __init__(self, last_consensus, interval=CONSENSUS_INTERVAL, delay=PUBLICATION_DELAY,
+                 min_interval=MIN_INTERVAL, retry_delay=RETRY_DELAY, max_retry_delay=MAX_RETRY_DELAY):
+        self.last_consensus = last_consensus
+        self.interval = interval
+        self.delay = delay
+        self.min_interval = min_interval
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.failures = 0
+        self.last_sweep = None
+        self._stopped = False
+        self._loop = None
+        self._stop = None
+
+    def next_delay(self, now=None):
+        """
+        Returns the number of seconds to wait before the next sweep.
+
+        Args:
+            now (datetime): The current aware time, the system clock by default.
+
+        Returns:
+            float: The delay, 0 if a sweep is overdue.
+
+        Raises:
+            None
+        """
+        now = now or datetime.now(timezone.utc)
+
+        if self.failures:
+            return min(self.retry_delay * 2 ** (self.failures - 1), self.max_retry_delay)
+
+        try:
+            published = parse_published(self.last_consensus())
+        except Exception as e:
+            logging.error("Error reading the consensus of the last sweep: %s", e)
+            published = None
+        due = now if published is None else published + timedelta(seconds=self.interval + self.delay)
+        if self.last_sweep is not None:
+            due = max(due, self.last_sweep + timedelta(seconds=self.min_interval))
+
+        return max(0.0, (due - now).total_seconds())
+
+    async def run(self, sweep):
+        """
+        Runs `sweep`, a coroutine function, on schedule until `stop` is called.
+
+        Args:
+            sweep (callable): The coroutine function performing one sweep.
+
+        Returns:
+            None
+
+        Raises:
+            None
+
+        Note:
+            Every exception raised by a sweep is logged and retried; only a cancellation ends the loop early.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+
+        while not self._stopped:
+            try:
+                await asyncio.wait_for(self._stop.wait(), self.next_delay())
+                break
+            except asyncio.TimeoutError:
+                pass
+
+            try:
+                await sweep()
+                self.failures = 0
+            except Exception as e:
+                self.failures += 1
+                logging.error("Error during the sweep, retrying in %s seconds: %s", self.next_delay(), e)
+            self.last_sweep = datetime.now(timezone.utc)
+
+    def stop(self):
+        """
+        Asks the scheduler to stop once the running sweep, if any, has finished. Safe from any thread.
+        """
+        self._stopped = True
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._stop.set)
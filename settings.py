@@ -0,0 +1,49 @@
+import configparser
+
+from mirror import relay_mirror
+from onionoo import relay_cache
+from onionoo_client import onionoo_client
+
+
+# Read by the bot and by the watchdog workers unless another path is given
+CONFIG_PATH = 'config.ini'
+
+
+def read_config(path=CONFIG_PATH):
+    """
+    Reads the configuration file, a missing file leaving every setting to its fallback.
+    """
+    config = configparser.ConfigParser()
+    config.read(path)
+    return config
+
+
+def configure_onionoo(config):
+    """
+    Applies the [onionoo] and [mirror] settings to the shared relay cache, Onionoo client and relay mirror.
+
+    Args:
+        config (configparser.ConfigParser): The configuration read by `read_config`.
+
+    Returns:
+        None
+
+    Raises:
+        ValueError: If a setting is not a number.
+    """
+    # Shared relay cache settings, Onionoo refreshes its data once per hour
+    relay_cache.configure(
+        ttl=config.getint('onionoo', 'cache_ttl', fallback=3600),
+        max_size=config.getint('onionoo', 'cache_size', fallback=10000),
+    )
+    # Timeouts, retries and circuit breaker of the requests to Onionoo
+    onionoo_client.configure(
+        connect_timeout=config.getfloat('onionoo', 'connect_timeout', fallback=10),
+        read_timeout=config.getfloat('onionoo', 'read_timeout', fallback=60),
+        retries=config.getint('onionoo', 'retries', fallback=3),
+        backoff=config.getfloat('onionoo', 'backoff', fallback=1),
+        failure_threshold=config.getint('onionoo', 'failure_threshold', fallback=5),
+        reset_timeout=config.getfloat('onionoo', 'reset_timeout', fallback=300),
+    )
+    # Seconds after Onionoo's publication past which the mirrored data is reported as stale
+    relay_mirror.configure(max_age=config.getint('mirror', 'max_age', fallback=10800))
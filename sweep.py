@@ -0,0 +1,299 @@
+import logging
+import time
+from datetime import datetime, timezone
+
+import requests
+
+import database
+import history
+import metrics
+from mirror import relay_mirror
+from onionoo import relay_cache
+from relay_index import relay_digest, relay_index
+
+
+SWEEP_SECONDS = metrics.histogram("torwatchdog_sweep_seconds", "Duration of the watchdog sweeps.")
+SWEEP_FINGERPRINTS = metrics.gauge("torwatchdog_sweep_fingerprints", "Distinct fingerprints checked by the last sweep.")
+TRANSITIONS = metrics.counter("torwatchdog_relay_transitions_total", "Relay state changes found by the sweeps.", ("state",))
+SWEEP_CHANGED = metrics.gauge("torwatchdog_sweep_changed_relays", "Relays whose stored state the last sweep has changed.")
+SWEEP_OFFLINE = metrics.gauge("torwatchdog_sweep_offline_relays", "Watched relays found offline by the last sweep.")
+
+
+def transition_message(fingerprint, running):
+    """
+    Builds the alert message for a relay whose state has changed.
+
+    Args:
+        fingerprint (str): The upper-case fingerprint of the relay.
+        running (bool): The new `running` flag of the relay, or None if Onionoo no longer knows it.
+
+    Returns:
+        str: The MarkdownV2 message to send to the user.
+
+    Raises:
+        None
+    """
+    if running is None:
+        return f"No information available for fingerprint: `{fingerprint}`"
+    if running:
+        return f"The relay with fingerprint `{fingerprint}` is back online"
+    return f"The relay with fingerprint `{fingerprint}` is offline"
+
+
+def evaluate_relays(index, relays, now, published=None, arrivals=None):
+    """
+    Compares the fetched relays with their last known state.
+
+    Args:
+        index (RelayIndex): The in-memory index of the last known relay states.
+        relays (dict): The Onionoo records of the fetched fingerprints, None for the unknown ones.
+        now (str): The time of the sweep, the `last_seen` of the relays found running.
+        published (str): The Onionoo `relays_published` timestamp of the fetched data, if known.
+        arrivals (dict): The IDs of the users who started watching each relay since the last sweep,
+            as returned by `RelayIndex.pop_arrivals`.
+
+    Returns:
+        tuple: The (fingerprint, running) transitions, the (fingerprint, running, last_seen, last_restarted, consensus)
+        states of the relays that have changed since the last sweep, and the (fingerprint, running, user_ids) of the
+        relays already down or unknown to their new watchers.
+
+    Raises:
+        None
+
+    Note:
+        A relay whose digest equals the one of its known state, and that nobody has started watching, is skipped.
+        A relay seen for the first time is treated as previously running.
+    """
+    arrivals = arrivals or {}
+
+    transitions = []
+    states = []
+    welcomes = []
+    for key, relay in relays.items():
+        running = None if relay is None else bool(relay.get("running", False))
+        last_restarted = relay.get("last_restarted") if relay else None
+        state = index.state(key)
+        # The dirty set: relays never swept, whose digest has changed, or with new watchers
+        changed = state is None or state.digest != relay_digest(running, last_restarted)
+        if not changed and key not in arrivals:
+            continue
+        if running != (True if state is None else state.running):
+            transitions.append((key, running))
+        elif key in arrivals and running is not True:
+            # No transition tells the new watchers of a relay that was already down
+            welcomes.append((key, running, arrivals[key]))
+        if changed:
+            last_seen = now if running else index.swept if state is not None and state.running else None
+            states.append((key, running, last_seen, last_restarted, published))
+
+    return transitions, states, welcomes
+
+
+def apply_sweep(conn, index, relays, notify, published=None, fence=None):
+    """
+    Compares the fetched relays with their last known state, notifying and storing the transitions.
+
+    Args:
+        conn (sqlite3.Connection): The connection to the database.
+        index (RelayIndex): The in-memory index of the subscriptions and of the last known relay states.
+        relays (dict): The Onionoo records of the fetched fingerprints, None for the unknown ones.
+            Fingerprints missing from the dictionary could not be fetched and keep their state.
+        notify (callable): A function taking (user_id, message) that delivers a MarkdownV2 message.
+        published (str): The Onionoo `relays_published` timestamp of the fetched data, if known.
+        fence (callable): A function taking the connection and returning whether this process may still write
+            the results, called first in their transaction, such as the lease check of a watchdog worker.
+
+    Returns:
+        list: The (fingerprint, running) transitions found by the sweep, empty when the fence has failed.
+
+    Raises:
+        sqlite3.Error: If the relay states cannot be stored.
+
+    Note:
+        Users are only notified when a relay goes from up to down or from down to up, or when
+        Onionoo stops knowing about it, and when they start watching a relay that is already down or unknown,
+        whether they are its first watcher or not.
+        The sweep is incremental: a relay whose digest of `running` and `last_restarted` equals the one
+        of its known state is skipped, so only the relays that have changed and those whose watchers have changed
+        since the last sweep are written to 'relay_state' and looked up for alerts. The `last_seen` of a relay
+        going down is the time of the last sweep, the last one that found it running.
+        When `published` equals the consensus of the last sweep nothing has changed upstream,
+        so only the relays with new watchers are checked, and nothing else is read or written.
+        The previous states and the subscribers are read from the index; the database is only written,
+        and the index is updated once the new states have been committed.
+        The fetched relays are appended to their uptime history in the same transaction as their states.
+        Unlike the states, the history takes one observation of every fetched relay per consensus,
+        so it costs one write per watched relay and sweep. The changes of the subscriptions older than
+        SUBSCRIPTION_LOG_RETENTION are pruned from 'subscription_log' at the same time.
+        When the fence fails, nothing is written or notified, and the process that has taken over compares the relays again.
+    """
+    arrivals = index.pop_arrivals(relays)
+    partial = published is not None and published == index.consensus
+    if partial:
+        if not arrivals:
+            return []
+        relays = {key: relays[key] for key in arrivals}
+
+    now = datetime.now(timezone.utc).isoformat(timespec="seconds")
+    transitions, states, welcomes = evaluate_relays(index, relays, now, published, arrivals)
+    for _, running in transitions:
+        TRANSITIONS.inc("unknown" if running is None else "online" if running else "offline")
+
+    with conn:
+        if fence is not None and not fence(conn):
+            logging.error("Sweep results dropped, the relays are now watched by another process")
+            return []
+        database.save_relay_states(conn, states)
+        if not partial:
+            history.record_sweep(conn, relays, published)
+            database.prune_subscription_log(conn, time.time() - database.SUBSCRIPTION_LOG_RETENTION)
+    # A partial sweep has not seen every relay running, it is not the `last_seen` of the others
+    index.update_states(states, published, None if partial else now)
+    if not partial:
+        SWEEP_CHANGED.set(len(states))
+        SWEEP_OFFLINE.set(sum(1 for relay in relays.values() if relay is not None and not relay.get("running", False)))
+
+    for key, running in transitions:
+        for user_id in index.subscribers(key):
+            notify(user_id, transition_message(key, running))
+    for key, running, user_ids in welcomes:
+        for user_id in user_ids:
+            notify(user_id, transition_message(key, running))
+
+    return transitions
+
+
+def expand_groups(conn, index, resolve, accept=None):
+    """
+    Refreshes the members of the watched families and operators, once per group.
+
+    Args:
+        conn (sqlite3.Connection): The connection to the database.
+        index (RelayIndex): The in-memory index of the subscriptions, whose group members are replaced.
+        resolve (callable): A function taking (kind, value) and returning the fingerprints of the members,
+            or None when they cannot be known yet.
+        accept (callable): A function taking the value of a group and returning whether this process expands it,
+            such as the shard filter of a watchdog worker. All groups are expanded by default.
+
+    Returns:
+        int: The number of groups whose members have changed.
+
+    Raises:
+        sqlite3.Error: If the members cannot be stored.
+
+    Note:
+        A group is expanded once however many users watch it, and its members are stored in 'relay_groups',
+        so the handlers and the other processes use them until the next sweep.
+        If the expansion of a group fails, the error is logged and its last known members are kept.
+    """
+    changed = 0
+
+    for kind, value in index.groups():
+        if accept is not None and not accept(value):
+            continue
+        try:
+            members = resolve(kind, value)
+        except (requests.RequestException, ValueError) as e:
+            logging.error("Error expanding the %s %s: %s", kind, value, e)
+            continue
+        if members is None:
+            continue
+
+        with conn:
+            changed += database.save_relay_group(conn, kind, value, members)
+        index.set_members(kind, value, members)
+
+    return changed
+
+
+def run_sweep(conn, notify, fetch=relay_cache.lookup_all, index=relay_index, published=None, fence=None):
+    """
+    Checks the status of every subscribed relay and notifies the users of the transitions.
+
+    Args:
+        conn (sqlite3.Connection): The connection to the database.
+        notify (callable): A function taking (user_id, message) that delivers a MarkdownV2 message.
+        fetch (callable): A function taking the upper-case fingerprints and returning their relay records.
+        index (RelayIndex): The in-memory index of the subscriptions, the shared one by default.
+        published (str): The Onionoo `relays_published` timestamp of the fetched data, if known in advance.
+        fence (callable): The check made before the results are written, see `apply_sweep`.
+
+    Returns:
+        int: The number of distinct fingerprints checked during the sweep.
+
+    Raises:
+        sqlite3.Error: If the relay states cannot be stored.
+
+    Note:
+        The fingerprints are deduplicated across all users and the relay state is fetched in bulk
+        once per sweep through the shared relay cache, then every subscription is answered from it.
+        If the bulk fetch fails, the error is logged and the relay states are left untouched.
+    """
+    fingerprints = index.fingerprints()
+    if not fingerprints:
+        return 0
+
+    with SWEEP_SECONDS.time():
+        try:
+            relays = fetch(fingerprints)
+        except (requests.RequestException, ValueError) as e:
+            logging.error("Error fetching the relay details: %s", e)
+            return len(fingerprints)
+
+        apply_sweep(conn, index, relays, notify, published, fence)
+
+    SWEEP_FINGERPRINTS.set(len(fingerprints))
+    return len(fingerprints)
+
+
+def refresh_mirror(conn, mirror=relay_mirror):
+    """
+    Refreshes the local relay mirror from Onionoo, logging the error if the download fails.
+
+    Returns:
+        int: The number of relay records that have changed, 0 if Onionoo has no new data or cannot be reached.
+
+    Raises:
+        sqlite3.Error: If the records cannot be stored.
+    """
+    try:
+        return mirror.refresh(conn)
+    except (requests.RequestException, ValueError) as e:
+        logging.error("Error refreshing the relay mirror: %s", e)
+        return 0
+
+
+def run_mirror_sweep(conn, notify, mirror=relay_mirror, index=relay_index, refresh=True, fence=None):
+    """
+    Refreshes the local relay mirror, expands the watched groups from it, then checks every subscribed relay against it.
+
+    Args:
+        conn (sqlite3.Connection): The connection to the database.
+        notify (callable): A function taking (user_id, message) that delivers a MarkdownV2 message.
+        mirror (RelayMirror): The local mirror of Onionoo's relays, the shared one by default.
+        index (RelayIndex): The in-memory index of the subscriptions, the shared one by default.
+        refresh (bool): Whether to refresh the mirror from Onionoo first, False when it is loaded from a file.
+        fence (callable): The check made before the results are written, see `apply_sweep`.
+
+    Returns:
+        int: The number of distinct fingerprints checked during the sweep, 0 while the mirror is empty.
+
+    Raises:
+        sqlite3.Error: If the mirror cannot be read or the relay states cannot be stored.
+
+    Note:
+        If the refresh fails, the error is logged and the sweep finds the same data as the last one,
+        so `apply_sweep` stops at once and the relay states are left untouched.
+        The families and operators are expanded without any request to Onionoo.
+    """
+    if refresh:
+        refresh_mirror(conn, mirror)
+
+    published = mirror.published(conn)
+    if published is None:
+        return 0
+
+    expand_groups(conn, index, lambda kind, value: mirror.group_members(conn, kind, value))
+
+    return run_sweep(conn, notify, fetch=lambda fingerprints: mirror.lookup_many(conn, fingerprints),
+                     index=index, published=published, fence=fence)
@@ -0,0 +1,81 @@
+import re
+
+
+# Fingerprint Pattern
+FINGERPRINT_REGEX = "^[A-Za-z0-9]{40}$"
+FINGERPRINT_PATTERN = re.compile(FINGERPRINT_REGEX)
+# Separators between the fingerprints of one message, and the characters around them in a pasted family list
+FINGERPRINT_SEPARATORS = re.compile(r"[\s,;]+")
+FINGERPRINT_DECORATIONS = "$\"'[]"
+# Subscription to every relay of a family or of an operator, such as "family: <fingerprint>" or "contact: <text>"
+GROUP_PATTERN = re.compile(r"^\s*(family|contact)\s*:\s*(.*?)\s*$", re.IGNORECASE | re.DOTALL)
+CONTACT_LENGTH = 200
+
+
+def parse_fingerprints(text):
+    """
+    Splits a message into relay fingerprints.
+
+    Args:
+        text (str): The text of the message, with the fingerprints separated by spaces, new lines, commas
+            or semicolons. A pasted Onionoo family list, such as ["$ABC...","$DEF..."], is accepted as well.
+
+    Returns:
+        tuple: The distinct upper-case fingerprints matching FINGERPRINT_PATTERN, in the order they were written,
+        and the entries that do not match it.
+
+    Raises:
+        None
+    """
+    fingerprints = []
+    invalid = []
+
+    for entry in FINGERPRINT_SEPARATORS.split(text):
+        entry = entry.strip(FINGERPRINT_DECORATIONS)
+        if not entry:
+            continue
+        if FINGERPRINT_PATTERN.match(entry):
+            fingerprints.append(entry.upper())
+        else:
+            invalid.append(entry)
+
+    return list(dict.fromkeys(fingerprints)), invalid
+
+
+def parse_fingerprint(text):
+    """
+    Returns the upper-case fingerprint written in a message, or None if it does not match FINGERPRINT_PATTERN.
+    """
+    fingerprint = text.strip().strip(FINGERPRINT_DECORATIONS)
+    return fingerprint.upper() if FINGERPRINT_PATTERN.match(fingerprint) else None
+
+
+def parse_group(text):
+    """
+    Recognizes a subscription to a whole family, 'family: <fingerprint>', or operator, 'contact: <text>'.
+
+    Args:
+        text (str): The text of the message.
+
+    Returns:
+        tuple: The (kind, value) pair of the group, with an upper-case fingerprint or the contact text with
+        its spaces normalized, or None if the message does not name a group.
+
+    Raises:
+        None
+    """
+    match = GROUP_PATTERN.match(text)
+    if match is None:
+        return None
+
+    kind, value = match.group(1).lower(), match.group(2)
+    if kind == "family":
+        return kind, value.strip(FINGERPRINT_DECORATIONS).upper()
+    return kind, " ".join(value.split())[:CONTACT_LENGTH]
+
+
+def is_valid_group(kind, value):
+    """
+    Returns whether a family names a well-formed fingerprint, or a contact holds some text.
+    """
+    return bool(FINGERPRINT_PATTERN.match(value)) if kind == "family" else bool(value)
@@ -0,0 +1,294 @@
+"""
+Standalone watchdog, running the relay sweeps in worker processes separate from the Telegram bot.
+
+The fingerprint space is split into hash shards leased to the workers through the database, so the
+sweeps use several cores and keep running while the bot restarts. The alerts are queued in the
+database outbox, and sent by the bot within its rate limits. Set `embedded = false` in the
+[watchdog] section of 'config.ini' so that the bot stops sweeping by itself.
+
+Usage:
+    python watchdog.py [workers]
+    python main.py watchdog [--workers N] [--config config.ini]
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import sqlite3
+import sys
+import zlib
+
+import database
+import metrics
+import settings
+from async_sweep import AsyncSweeper
+from mirror import relay_mirror
+from onionoo import fetch_group_members
+from relay_index import RelayIndex
+from scheduler import SweepScheduler
+from sweep import expand_groups, refresh_mirror, run_mirror_sweep
+
+
+# Number of hash shards of the fingerprint space, the same for every worker
+SHARDS = 64
+# Seconds a lease lasts without renewal, after which the shard of a crashed worker is taken over
+LEASE_TTL = 120
+LEASE_RENEW = 30
+# Seconds a new worker waits after announcing itself, so that workers started together share the shards at once
+JOIN_DELAY = 2
+
+
+def shard_of(fingerprint, shards=SHARDS):
+    """
+    Returns the shard of a fingerprint, computed with a hash that is stable across processes.
+    """
+    return zlib.crc32(fingerprint.upper().encode()) % shards
+
+
+class ShardLeases:
+    """
+    The shards leased to one watchdog worker.
+
+    Every `refresh` renews the worker's leases and its heartbeat, then brings the number of its shards
+    to its fair share of the live workers: the surplus is released for a worker that has just joined,
+    and free or expired shards, such as those of a crashed worker, are claimed.
+
+    Usage:
+        leases = ShardLeases(owner="host:1234")
+        leases.join(conn)
+        shards = leases.refresh(conn)
+    """
+
+    def __init__(self, owner, shards=SHARDS, ttl=LEASE_TTL):
+        self.owner = owner
+        self.shards = shards
+        self.ttl = ttl
+        self.owned = frozenset()
+
+    def join(self, conn):
+        """
+        Announces the worker without claiming any shard yet.
+        """
+        with conn:
+            database.heartbeat_worker(conn, self.owner, self.ttl)
+
+    def refresh(self, conn):
+        """
+        Renews, releases and claims shards in one transaction, returning the shards now owned.
+        """
+        with conn:
+            workers = database.heartbeat_worker(conn, self.owner, self.ttl)
+            owned = database.renew_shards(conn, self.owner, self.ttl)
+            fair = -(-self.shards // workers)
+
+            if len(owned) > fair:
+                database.release_shards(conn, self.owner, owned[fair:])
+                owned = owned[:fair]
+            elif len(owned) < fair:
+                owned += database.claim_shards(conn, self.owner, fair - len(owned), self.ttl, self.shards)
+
+        self.owned = frozenset(owned)
+        return self.owned
+
+    def accepts(self, fingerprint):
+        """
+        Returns whether the fingerprint belongs to one of the owned shards.
+        """
+        return shard_of(fingerprint, self.shards) in self.owned
+
+    def snapshot(self):
+        """
+        Returns a function telling whether a fingerprint belongs to the shards owned right now,
+        which unlike `accepts` does not follow the later refreshes.
+        """
+        owned, shards = self.owned, self.shards
+        return lambda fingerprint: shard_of(fingerprint, shards) in owned
+
+    def fence(self, conn, shards):
+        """
+        Renews the leases in the caller's transaction and returns whether all the `shards` are still owned.
+
+        Note:
+            Called first in the transaction writing the results of a sweep, it takes the write lock,
+            so no other worker can claim the shards before the results have been committed.
+        """
+        return shards <= frozenset(database.renew_shards(conn, self.owner, self.ttl))
+
+    def release(self, conn):
+        """
+        Gives up every shard, so that the other workers take them over without waiting for the leases to expire.
+        """
+        with conn:
+            database.release_shards(conn, self.owner)
+        self.owned = frozenset()
+
+
+async def watch_shards(leases, concurrency, timeout, min_interval, mirror=None, refresh=True):
+    """
+    Sweeps the relays of the shards leased to this worker until a termination signal is received.
+
+    Args:
+        leases (ShardLeases): The shard leases of the worker.
+        concurrency (int): The maximum number of concurrent Onionoo requests.
+        timeout (float): The timeout of every Onionoo request in seconds.
+        min_interval (float): The minimum number of seconds between two sweeps.
+        mirror (RelayMirror): The local relay mirror the relays are checked against, None to query Onionoo directly.
+        refresh (bool): Whether every sweep refreshes the mirror from Onionoo first.
+
+    Returns:
+        None
+
+    Raises:
+        sqlite3.Error: If the leases cannot be written when the worker starts or stops.
+
+    Note:
+        The subscriptions of the owned shards are only loaded when the worker starts and when its shards
+        change, after which the first sweep compares every relay, since those of the shards just taken over
+        may not have been swept at the last consensus. Before the other sweeps the changes logged by
+        the bot are replayed with `RelayIndex.sync`. The leases are renewed every `LEASE_RENEW` seconds
+        in the meantime.
+        Every worker refreshes the shared mirror, but with `If-Modified-Since`, so once one of them has
+        stored the new document the others only get an empty 304 response. The refresh runs in a thread
+        before the shards are taken, so a slow download neither lets the leases expire nor sweeps shards
+        another worker has taken over in the meantime.
+        The results of a sweep are only written if the worker still owns all the shards it has swept,
+        otherwise they are dropped, and the worker that has taken them over compares the relays again.
+        The alerts are queued in the outbox, for the bot to send them.
+    """
+    conn = database.get_connection()
+    index = RelayIndex(track_arrivals=True)
+    scheduler = SweepScheduler(lambda: index.consensus, min_interval=min_interval)
+
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, scheduler.stop)
+
+    async def keep_leases():
+        while True:
+            await asyncio.sleep(LEASE_RENEW)
+            try:
+                leases.refresh(conn)
+            except sqlite3.Error as e:
+                logging.error("Error renewing the shard leases of %s: %s", leases.owner, e)
+
+    # The shards the index has been loaded for
+    loaded = None
+
+    async with AsyncSweeper(concurrency=concurrency, timeout=timeout, index=index) as sweeper:
+        async def sweep():
+            nonlocal loaded
+
+            if mirror is not None and refresh:
+                # Downloading in a thread with its own connection, so that `keep_leases` goes on renewing the leases
+                await asyncio.to_thread(lambda: refresh_mirror(database.get_connection(), mirror))
+
+            # Sweeping the subscriptions of the shards owned right now
+            leases.refresh(conn)
+            if leases.owned != loaded:
+                index.load(conn, accept=leases.snapshot())
+                index.consensus = None
+                loaded = leases.owned
+            else:
+                index.sync(conn)
+            alerts = []
+            fence = lambda conn: leases.fence(conn, loaded)
+            if mirror is not None:
+                run_mirror_sweep(conn, lambda user_id, message: alerts.append((user_id, message)),
+                                 mirror=mirror, index=index, refresh=False, fence=fence)
+            else:
+                # Each group is expanded by the worker owning the shard of its name, the others read its members next time
+                expand_groups(conn, index, fetch_group_members, accept=leases.accepts)
+                await sweeper.run(conn, lambda user_id, message: alerts.append((user_id, message)), fence=fence)
+
+            # Queueing the alerts at once, so that every user gets a single message per sweep
+            if alerts:
+                with conn:
+                    database.queue_messages(conn, alerts)
+
+        leases.join(conn)
+        await asyncio.sleep(JOIN_DELAY)
+        leases.refresh(conn)
+        renewal = asyncio.create_task(keep_leases())
+        try:
+            await scheduler.run(sweep)
+        finally:
+            renewal.cancel()
+            leases.release(conn)
+
+
+def run_worker(number, config_path=settings.CONFIG_PATH):
+    """
+    Runs one watchdog worker process.
+
+    Args:
+        number (int): The number of the worker, used in its identifier.
+        config_path (str): The path of the configuration file.
+
+    Returns:
+        None
+
+    Raises:
+        None
+
+    Note:
+        Errors are logged using the logging module to 'error.log'.
+    """
+    logging.basicConfig(filename='error.log', level=logging.ERROR)
+
+    config = settings.read_config(config_path)
+
+    # Every worker serves its own metrics, on the ports following the bot's
+    if config.getboolean('metrics', 'enabled', fallback=False):
+        metrics.start_server(config.getint('metrics', 'port', fallback=9464) + 1 + number,
+                             config.get('metrics', 'listen', fallback='127.0.0.1'))
+    settings.configure_onionoo(config)
+
+    leases = ShardLeases(
+        f"{socket.gethostname()}:{os.getpid()}:{number}",
+        shards=config.getint('watchdog', 'shards', fallback=SHARDS),
+    )
+
+    try:
+        asyncio.run(watch_shards(
+            leases,
+            concurrency=config.getint('watchdog', 'concurrency', fallback=10),
+            timeout=config.getfloat('watchdog', 'request_timeout', fallback=30),
+            min_interval=config.getint('watchdog', 'min_interval', fallback=300),
+            mirror=relay_mirror if config.getboolean('mirror', 'enabled', fallback=True) else None,
+            # A mirror loaded from a file by the bot is never refreshed
+            refresh=not config.get('mirror', 'dump', fallback=''),
+        ))
+    except Exception as e:
+        logging.error("Error in watchdog worker %s: %s", leases.owner, e)
+    finally:
+        database.close_connection()
+
+
+def main(workers, config_path=settings.CONFIG_PATH):
+    """
+    Starts `workers` watchdog processes reading `config_path` and waits for them, forwarding SIGTERM.
+    """
+    database.init_database()
+    database.close_connection()
+
+    processes = [multiprocessing.Process(target=run_worker, args=(number, config_path), name=f"watchdog-{number}")
+                 for number in range(workers)]
+    for process in processes:
+        process.start()
+
+    def terminate(signum, frame):
+        for process in processes:
+            process.terminate()
+
+    signal.signal(signal.SIGTERM, terminate)
+    # Ctrl+C reaches the whole process group, the workers stop by themselves
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count() or 1)
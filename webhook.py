@@ -0,0 +1,259 @@
+import json
+import logging
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telebot import types
+
+import metrics
+
+
+# Webhook server defaults
+LISTEN = "127.0.0.1"
+PORT = 8443
+PATH = "/telegram"
+WORKERS = 8
+# Updates waiting for a worker; beyond this the server answers 503 and Telegram delivers them again later
+MAX_PENDING = 10000
+# Telegram opens at most this many connections to the webhook at once
+MAX_CONNECTIONS = 40
+# Secret sent back by Telegram in every request, see `setWebhook`
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def chat_key(update):
+    """
+    Returns the ID of the chat an update belongs to, or its update ID if it has no chat.
+    """
+    for message in (update.message, update.edited_message, update.callback_query and update.callback_query.message):
+        if message is not None:
+            return message.chat.id
+    return update.update_id
+
+
+class UpdateDispatcher:
+    """
+    Bounded pool of worker threads processing the updates of many chats in parallel.
+
+    Updates are kept in a queue per chat and a chat is handed to one worker at a time, so the
+    updates of a chat are processed one after the other in the order they arrived, so the answer
+    to a prompt is never handled before the prompt, while a slow update only delays its own chat.
+    At most `max_pending` updates wait for a worker; `submit` refuses the others.
+
+    Usage:
+        dispatcher = UpdateDispatcher(lambda update: bot.process_new_updates([update])).start()
+        dispatcher.submit(chat_key(update), update)
+    """
+
+    def __init__(self, process, workers=WORKERS, max_pending=MAX_PENDING):
+        self.process = process
+        self.workers = workers
+        self.max_pending = max_pending
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self._pending = {}
+        self._count = 0
+        self._ready = deque()
+        self._in_flight = set()
+        self._condition = threading.Condition()
+        self._threads = []
+        self._stopped = False
+
+    def start(self):
+        """
+        Starts the worker threads.
+        """
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"updates-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        """
+        Stops the worker threads once the updates being processed are done.
+        """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def submit(self, key, update):
+        """
+        Queues an update for the chat `key`, returning False if too many updates are already waiting.
+        """
+        with self._condition:
+            if self._count >= self.max_pending:
+                self.rejected += 1
+                return False
+            updates = self._pending.setdefault(key, deque())
+            updates.append(update)
+            self._count += 1
+            if len(updates) == 1 and key not in self._in_flight:
+                self._ready.append(key)
+                self._condition.notify()
+            return True
+
+    def depth(self):
+        """
+        Returns the number of updates waiting for a worker.
+        """
+        with self._condition:
+            return self._count
+
+    def wait_idle(self, timeout=None):
+        """
+        Blocks until every queued update has been processed, returning False on timeout.
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._count and not self._in_flight, timeout)
+
+    def _take(self):
+        # Waits for a ready chat and takes its oldest update, or returns None once stopped
+        with self._condition:
+            while not self._ready:
+                if self._stopped:
+                    return None
+                self._condition.wait()
+            if self._stopped:
+                return None
+
+            key = self._ready.popleft()
+            self._in_flight.add(key)
+            self._count -= 1
+            return key, self._pending[key].popleft()
+
+    def _work(self):
+        while True:
+            item = self._take()
+            if item is None:
+                return
+            key, update = item
+
+            error = None
+            try:
+                self.process(update)
+            except Exception as e:
+                error = e
+                logging.error("Error processing an update of chat %s: %s", key, e)
+
+            with self._condition:
+                self._in_flight.discard(key)
+                if error is None:
+                    self.processed += 1
+                else:
+                    self.failed += 1
+
+                # The next update of the chat, if any, goes to the back of the line
+                if self._pending[key]:
+                    self._ready.append(key)
+                else:
+                    del self._pending[key]
+                self._condition.notify_all()
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """
+    HTTP server receiving Telegram updates on `path` and handing them to an `UpdateDispatcher`.
+
+    Each request is answered as soon as its update is queued, so Telegram never waits for a handler.
+    Requests without the expected secret token get a 403, malformed updates a 400, and updates
+    refused by a full dispatcher a 503, which Telegram retries.
+
+    Usage:
+        server = WebhookServer(("127.0.0.1", 8443), dispatcher, secret_token="secret")
+        server.serve_forever()
+    """
+
+    daemon_threads = True
+    # Telegram opens up to 40 connections at once, the default backlog of 5 would make them wait
+    request_queue_size = 1024
+
+    def __init__(self, address, dispatcher, path=PATH, secret_token=None):
+        super().__init__(address, WebhookHandler)
+        self.dispatcher = dispatcher
+        self.webhook_path = path
+        self.secret_token = secret_token
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    # Keeps the connections of Telegram open between updates
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        if self.path != server.webhook_path:
+            return self._reply(404)
+        if server.secret_token and self.headers.get(SECRET_HEADER) != server.secret_token:
+            return self._reply(403)
+
+        try:
+            update = types.Update.de_json(json.loads(body))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            logging.error("Malformed webhook update: %s", e)
+            return self._reply(400)
+
+        self._reply(200 if server.dispatcher.submit(chat_key(update), update) else 503)
+
+    def _reply(self, status):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        # Requests are not logged, errors go through the logging module
+        pass
+
+
+def run_webhook(bot, url, listen=LISTEN, port=PORT, path=PATH, secret_token=None,
+                workers=WORKERS, max_pending=MAX_PENDING, max_connections=MAX_CONNECTIONS):
+    """
+    Receives the updates of the bot through a webhook until interrupted, instead of polling.
+
+    Args:
+        bot (telebot.TeleBot): The bot whose handlers process the updates.
+        url (str): The public HTTPS URL forwarded to the local server, registered with Telegram.
+        listen (str): The address the local server listens on.
+        port (int): The port the local server listens on.
+        path (str): The path of the webhook on the local server.
+        secret_token (str): The secret Telegram sends with every update, checked by the server.
+        workers (int): The number of worker threads processing the updates.
+        max_pending (int): The maximum number of updates waiting for a worker.
+        max_connections (int): The maximum number of connections Telegram opens to the webhook.
+
+    Returns:
+        None
+
+    Raises:
+        telebot.apihelper.ApiException: If Telegram refuses the webhook.
+        OSError: If the server cannot listen on the address.
+
+    Note:
+        TLS is expected to be terminated by a reverse proxy in front of the local server.
+        The bot runs its handlers in the calling worker instead of its own thread pool, otherwise
+        the updates of a chat could be handled out of order.
+        The webhook is removed on exit, so the bot can go back to polling.
+    """
+    bot.threaded = False
+    dispatcher = UpdateDispatcher(lambda update: bot.process_new_updates([update]), workers, max_pending).start()
+    metrics.QUEUE_DEPTH.set_function(dispatcher.depth, "updates")
+    server = WebhookServer((listen, port), dispatcher, path, secret_token)
+
+    bot.remove_webhook()
+    bot.set_webhook(url=url, secret_token=secret_token, max_connections=max_connections)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        bot.remove_webhook()
+        dispatcher.wait_idle(timeout=30)
+        dispatcher.stop()